@@ -1,22 +1,76 @@
+import os
+import cache
+import diameter_index
 import handler
 import plotter
 import solver
+import telemetry
 
 ## "particles_dist_clear.json" отладочный файл с расстояниями и временем как particle.json только другой формат distance
 ## "ВСЕ.txt" костыльный файл с сырыми данными каторые отпрявлял ВА, нужен только потому что я сразу не писал комментарии в particles.json, а только в тхт
+## "Траектории частиц опыта rNN final.txt" исходные файлы опытов, helpers.main_from_experiments() читает их напрямую (параллельно, без "ВСЕ.txt")
 ## "particles_dist_final.json" файл с образанными расстояниями и временем, получен обработкой сырого "particles.json" -> вытяныл данные из "ВСЕ.txt" -> "particles_dist_clear.json" -> "particles_dist_final.json"
+## "particles_dist_final.traj" то же самое что "particles_dist_final.json", но в бинарном хранилище (store.py), читается без разбора текста
 ## "selections.json" файл с выборками, получен обработкой "particles_dist_final.json" -> "selections.json"
 ## "results.json" файл с результатами, получен решением уравнений для каждой выборки "selections.json" -> "results.json"
-## TODO: все графики в один файл
+##                (только средние по выборкам; значения на каждом шаге - по запросу в detail_file .npz, см. solver.load_details)
+## Все графики в один файл: full_processing(report_file=...) строит их параллельно и собирает в многостраничный PDF
+## Новые опыты без пересчёта всего архива: incremental.py (закреплённые границы выборок, накопители по выборкам, пересчёт только изменившихся)
+
+def _code(*modules):
+    ## исходники модулей этапа - версия кода для ключа кэша
+    return [os.path.join(os.path.dirname(os.path.abspath(__file__)), name + '.py') for name in modules]
 
 def full_processing(
-        particles_intup_file='particles_dist_final.json',
+        particles_intup_file='particles_dist_final.traj',
         selections_file='selections.json', solver_results_file='results.json',
         use_hitted_particles=True,
         use_not_hitted_particles=True,
         bins=20,
-        show_plots=True
+        show_plots=True,
+        save_plots=True,
+        dt_poly=0.001,
+        bootstrap_replicates=0,
+        output_dir=None,
+        data=None,
+        use_cache=True,
+        headless=None,
+        report_file=None,
+        trace_file=None,
+        trace_summary=False,
+        detail_file=None,
+        per_particle=False,
+        inverse_fit=None,
+        speed_method='forward',
+        speed_options=None,
+        bin_edges=None,
+        bin_mode='equal',
+        use_index=False,
+        chunk_size=None,
+        compact_json=False
         ):
+    ## save_plots - строить и сохранять графики (False - только selections.json и results.json)
+    ## output_dir - отдельная папка для всех результатов запуска (selections, results и графики в output_dir/_RESULTS_PLOTS),
+    ##              чтобы несколько конфигураций не перезаписывали друг друга (см. sweep.py)
+    ## bootstrap_replicates - количество бутстреп-реплик для доверительных интервалов Cd и A (0 - не считать)
+    ## data - уже загруженные данные о частицах, тогда particles_intup_file не читается
+    ## headless - графики только в файлы через неинтерактивный backend (None - если show_plots=False);
+    ##            при save_plots=False matplotlib вообще не импортируется
+    ## report_file - PDF со всеми графиками и таблицей (графики строятся параллельно, см. plotter.render_report)
+    ## use_cache - не пересчитывать этапы, у которых не изменились входные файлы, параметры и код (см. cache.py)
+    ## detail_file - бинарный файл со значениями Cd, A, Re на каждом шаге решателя (None - не писать)
+    ## per_particle - дополнительно Cd и A каждой частицы: медиана и процентили по выборке в results.json (см. solver.particle_drag)
+    ## inverse_fit - 'constant' или 'inverse_re': дополнительно Cd из подбора решения уравнения движения к расстояниям (см. inverse.py, закон u²)
+    ## speed_method - как получать скорости из расстояний: 'forward' (разность соседних точек), 'central', 'savgol',
+    ##                'local_poly', 'spline'; speed_options - параметры метода, например {'window': 9} (см. differentiation.py)
+    ## bin_edges - закреплённые границы выборок по диаметру (мкм) вместо bins равных интервалов
+    ##             (например, те же, что у инкрементальной обработки, см. incremental.py)
+    ## bin_mode - 'equal' (bins равных интервалов) или 'quantile' (bins выборок с равным количеством частиц)
+    ## use_index - выборки и средние из индекса префиксных сумм по диаметрам (строится один раз рядом с particles_intup_file,
+    ##             см. diameter_index.py): смена bins, bin_mode и фильтра по ударам без прохода по траекториям
+    ## chunk_size - выборки по частям для архивов больше памяти: пакетами по chunk_size частиц (см. handler.stream_bins)
+    ## compact_json - selections.json без отступов и пробелов (формат тот же, см. jsonstream.py)
+    ## trace_file - JSON с временем, памятью и счётчиками каждого этапа (см. telemetry.py), trace_summary - сводка в консоль
     if use_hitted_particles and use_not_hitted_particles:
         print('\033[92mИспользуются все частицы\033[0m')
     elif use_hitted_particles:
@@ -26,27 +80,126 @@ def full_processing(
     elif not use_hitted_particles and not use_not_hitted_particles:
         print('\033[91mОшибка! Не используется ни одна частица!\033[0m')
         return
-    
-    handler.main(
-        input_file=particles_intup_file,
-        output_file=selections_file,
-        USE_HITTED_PARTICLES=use_hitted_particles,
-        USE_NOT_HITTED_PARTICLES=use_not_hitted_particles,
-        BINS=bins
-    ) ##Создание файла с выборками
-    ## selections.json уже содержит скорсости для каждой частицы, а так же осреднённые скорости и расстояния для каждой выборки
 
-    solver.main(
-        input_file=selections_file,
-        output_file=solver_results_file
-    ) ##Расчёт всех выборок и создание файла с результатами
+    plotter.set_headless(not show_plots if headless is None else headless)
+
+    tracing = (trace_file or trace_summary) and not telemetry.active()  # внутри уже начатого запуска пишем в его трассу
+    if tracing:
+        telemetry.start('full_processing')
+    try:
+        return _run_stages(particles_intup_file, selections_file, solver_results_file, use_hitted_particles,
+                           use_not_hitted_particles, bins, show_plots, save_plots, dt_poly, bootstrap_replicates,
+                           output_dir, data, use_cache, report_file, detail_file, per_particle, inverse_fit,
+                           speed_method, speed_options, bin_edges, bin_mode, use_index, chunk_size, compact_json)
+    finally:
+        if tracing:
+            telemetry.finish(trace_file, summary=trace_summary)
+
+def _run_stages(particles_intup_file, selections_file, solver_results_file, use_hitted_particles, use_not_hitted_particles,
+                bins, show_plots, save_plots, dt_poly, bootstrap_replicates, output_dir, data, use_cache, report_file, detail_file, per_particle, inverse_fit,
+                speed_method, speed_options, bin_edges, bin_mode, use_index, chunk_size, compact_json):
+    plots_dir = './_RESULTS_PLOTS'
+    if output_dir is not None:
+        plots_dir = os.path.join(output_dir, '_RESULTS_PLOTS')
+        selections_file = os.path.join(output_dir, os.path.basename(selections_file))
+        solver_results_file = os.path.join(output_dir, os.path.basename(solver_results_file))
+        os.makedirs(plots_dir if save_plots else output_dir, exist_ok=True)
+
+    if report_file is not None and output_dir is not None:
+        report_file = os.path.join(output_dir, os.path.basename(report_file))
+    if detail_file is not None and output_dir is not None:
+        detail_file = os.path.join(output_dir, os.path.basename(detail_file))
+    if not save_plots:
+        report_file = None
+
+    histogram_file = os.path.join(plots_dir, 'histogram.png') if save_plots else None
+    table_file = os.path.join(plots_dir, 'results_table.png') if save_plots and not report_file else None  # в отчёте таблица строится вместе с графиками
+
+    def run_handler():
+        with telemetry.stage('handler'):
+            index = diameter_index.open_index(particles_intup_file, speed_method, speed_options) if use_index else None
+            handler.main(
+                input_file=particles_intup_file,
+                output_file=selections_file,
+                USE_HITTED_PARTICLES=use_hitted_particles,
+                USE_NOT_HITTED_PARTICLES=use_not_hitted_particles,
+                BINS=bins,
+                histogram_file=histogram_file,
+                data=data,
+                speed_method=speed_method,
+                speed_options=speed_options,
+                edges=bin_edges,
+                bin_mode=bin_mode,
+                index=index,
+                chunk_size=chunk_size,
+                compact=compact_json
+            ) ##Создание файла с выборками
+        ## selections.json содержит осреднённые скорости и расстояния для каждой выборки и номера её частиц в particles_intup_file
+
+    def run_solver():
+        with telemetry.stage('solver'):
+            solver.main(
+                input_file=selections_file,
+                output_file=solver_results_file,
+                dt_poly=dt_poly,
+                bootstrap_replicates=bootstrap_replicates,
+                table_file=table_file,
+                detail_file=detail_file,
+                per_particle=per_particle,
+                inverse_fit=inverse_fit
+            ) ##Расчёт всех выборок и создание файла с результатами
+
+    def run_plotter():
+        with telemetry.stage('plotter'):
+            if report_file:
+                plotter.render_report(input_file=selections_file, results_file=solver_results_file, plots_dir=plots_dir,
+                                      report_file=report_file, show_plots=show_plots) ##Графики параллельно + PDF-отчёт
+            else:
+                plotter.main(input_file=selections_file, show_plots=show_plots, plots_dir=plots_dir) ##Графики для всех выборок
 
-    plotter.main(input_file='selections.json', show_plots=show_plots) ##Графики для всех выборок
+    if not use_cache:
+        run_handler()
+        run_solver()
+        if save_plots:
+            run_plotter()
+    else:
+        # Хэш источника - один на запуск для всех трёх этапов (и один на процесс для всего перебора sweep)
+        source = cache.path_digest(particles_intup_file)
+        cache.run_stage(
+            'handler', run_handler, [],
+            {'source': source, 'BINS': bins, 'hitted': use_hitted_particles, 'not_hitted': use_not_hitted_particles, 'histogram': bool(histogram_file),
+             'speed_method': speed_method, 'speed_options': speed_options, 'edges': bin_edges,
+             'bin_mode': bin_mode, 'index': use_index, 'chunk_size': chunk_size, 'compact': compact_json},
+            _code('handler', 'store', 'differentiation', 'diameter_index', 'jsonstream'),
+            {'selections': selections_file, 'histogram': histogram_file}
+        )
+        cache.run_stage(
+            'solver', run_solver, [selections_file],  # 'source': бутстреп читает траектории из источника
+            {'source': source, 'dt_poly': dt_poly, 'bootstrap': bootstrap_replicates, 'table': bool(table_file), 'details': bool(detail_file),
+             'per_particle': per_particle, 'inverse_fit': inverse_fit,
+             'constants': [solver.ro, solver.ro_g, solver.mu, solver.g]},
+            _code('solver', 'fitting', 'bootstrap', 'handler', 'store', 'inverse', 'differentiation', 'jsonstream'),
+            {'results': solver_results_file, 'table': table_file, 'details': detail_file}
+        )
+        if save_plots and show_plots:
+            run_plotter()  # окна с графиками из кэша не покажешь
+        elif save_plots:
+            outputs = {name: os.path.join(plots_dir, name + '.png') for name in plotter.PLOT_NAMES}
+            inputs = [selections_file]
+            if report_file:
+                outputs.update({'results_table': os.path.join(plots_dir, 'results_table.png'), 'report': report_file})
+                inputs.append(solver_results_file)
+            cache.run_stage(
+                'plotter', run_plotter, inputs, {'source': source, 'report': bool(report_file)}, _code('plotter', 'fitting', 'solver', 'handler', 'store', 'jsonstream'),
+                outputs
+            )
 
+    return {'selections_file': selections_file, 'results_file': solver_results_file, 'plots_dir': plots_dir if save_plots else None,
+            'report_file': report_file, 'detail_file': detail_file}
 
 if __name__ == "__main__":
     full_processing( 
-        particles_intup_file='particles_dist_final.json',
+        particles_intup_file='particles_dist_final.traj',
         selections_file='selections.json',
         solver_results_file='results.json',
         use_hitted_particles=False, ## True - использовать частицы с ударами, False - не использовать
@@ -0,0 +1,316 @@
+## Замеры времени и памяти этапов конвейера на синтетических данных (synthetic.py) разного объёма
+## Для каждого масштаба (1e3, 1e4, 1e5 частиц; 1e6 - по запросу) этапы запускаются по очереди:
+##   generate - генерация хранилища, helpers - предобработка сырых particles.json и txt с ударами (helpers.preprocess),
+##   load - загрузка хранилища, handler - выборки, solver - расчёт Cd, plotter - графики (по запросу)
+## Время - лучшее из repeat запусков (perf_counter), память - пик tracemalloc в отдельном запуске (tracemalloc замедляет код)
+## Результаты сравниваются с базовыми замерами _BENCH/baseline.json: регрессия - если этап стал медленнее в tolerance раз.
+## Перед замерами быстрые реализации сверяются с исходными (вложенные циклы, словари, цикл while + np.polyfit) на реальных данных,
+## обратная задача проверяется на пустой выборке, а solver - на синтетических траекториях с постоянным Cd
+import contextlib
+import io
+import json
+import math
+import os
+import time
+import tracemalloc
+import numpy as np
+import handler
+import helpers
+import inverse
+import plotter
+import solver
+import store
+import synthetic
+
+BENCH_DIR = '_BENCH'
+BASELINE_FILE = os.path.join(BENCH_DIR, 'baseline.json')
+SCALES = (1_000, 10_000, 100_000)
+STAGES = ('generate', 'helpers', 'load', 'handler', 'solver', 'plotter')
+
+
+def _paths(workdir, n):
+    prefix = os.path.join(workdir, f'synthetic_{n}')
+    return {
+        'store': prefix + '.traj',
+        'raw_json': prefix + '_raw.json',
+        'raw_txt': prefix + '_hits.txt',
+        'preprocessed_json': prefix + '_preprocessed.json',
+        'preprocessed_store': prefix + '_preprocessed.traj',
+        'selections': prefix + '_selections.json',
+        'results': prefix + '_results.json',
+    }
+
+
+def _stage(name, paths, n, bins, seed):
+    """
+    Функция без аргументов, выполняющая этап name над файлами paths.
+    """
+    if name == 'generate':
+        return lambda: synthetic.generate_store(paths['store'], n, seed=seed)
+    if name == 'helpers':
+        return lambda: helpers.preprocess(paths['raw_json'], paths['raw_txt'], paths['preprocessed_json'], paths['preprocessed_store'])
+    if name == 'load':
+        return lambda: store.load_data(paths['store'])
+    if name == 'handler':
+        return lambda: handler.main(paths['store'], paths['selections'], True, True, bins, histogram_file=None)
+    if name == 'solver':
+        return lambda: solver.main(paths['selections'], paths['results'], table_file=None)
+    if name == 'plotter':
+        return lambda: (plotter.main(paths['selections'], show_plots=False, plots_dir=None), plotter.pyplot().close('all'))
+    raise ValueError(f'Неизвестный этап: {name}')
+
+
+def measure(func, repeat=3, memory=True):
+    """
+    Лучшее время из repeat запусков (с) и пик памяти Python-объектов (байт) в отдельном запуске.
+    """
+    seconds = math.inf
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            seconds = min(seconds, time.perf_counter() - start)
+
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                func()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return {'seconds': seconds, 'peak_bytes': peak}
+
+
+def run_benchmarks(scales=SCALES, stages=STAGES[:-1], bins=20, repeat=3, memory=True, seed=0, workdir=BENCH_DIR):
+    """
+    Замеры всех этапов stages на всех масштабах scales. Возвращает {'<масштаб>/<этап>': {'seconds', 'peak_bytes'}}.
+    Этапы зависят от результатов предыдущих, поэтому порядок stages должен совпадать с STAGES.
+    """
+    os.makedirs(workdir, exist_ok=True)
+    if 'plotter' in stages:
+        plotter.set_headless(True)
+
+    results = {}
+    for n in scales:
+        paths = _paths(workdir, n)
+        if 'generate' not in stages:  # остальным этапам всё равно нужны данные
+            synthetic.generate_store(paths['store'], n, seed=seed)
+        if 'helpers' in stages:  # сырые файлы для предобработки, их запись не замеряется
+            synthetic.write_raw(paths['raw_json'], paths['raw_txt'], n, seed=seed)
+        for name in stages:
+            results[f'{n}/{name}'] = measure(_stage(name, paths, n, bins, seed), repeat=repeat, memory=memory)
+            print(f"{n:>9} {name:<9} {results[f'{n}/{name}']['seconds']:10.3f} c")
+    return results
+
+
+def compare(results, baseline, tolerance=1.5):
+    """
+    Этапы, ставшие медленнее базовых замеров больше чем в tolerance раз (или потребляющие больше памяти).
+    """
+    regressions = []
+    for key, current in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        for metric in ('seconds', 'peak_bytes'):
+            if current.get(metric) is None or not base.get(metric):
+                continue
+            ratio = current[metric] / base[metric]
+            if ratio > tolerance:
+                regressions.append({'stage': key, 'metric': metric, 'baseline': base[metric], 'current': current[metric],
+                                    'ratio': round(ratio, 2)})
+    return regressions
+
+
+def load_baseline(filename=BASELINE_FILE):
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_baseline(results, filename=BASELINE_FILE):
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    with open(filename, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=4)
+
+
+## === Исходные реализации для сверки быстрых путей ===
+
+def _reference_bins(data, bins_count, include_hitted, include_NOT_hitted):
+    """
+    Группировка по диаметрам вложенным циклом, как в исходном handler.histogram_D (границы как у plt.hist).
+    """
+    particles = [
+        p for p in data['particles']
+        if not (p.get('hit') is True and not include_hitted) and not (p.get('hit') is not True and not include_NOT_hitted)
+    ]
+    bins = np.histogram_bin_edges([p['diameter'] for p in particles], bins=bins_count)
+    bin_objects = [[] for _ in range(len(bins) - 1)]
+    for particle in particles:
+        d = particle['diameter']
+        for i in range(len(bins) - 1):
+            if bins[i] <= d < bins[i + 1] or (i == len(bins) - 2 and d == bins[-1]):
+                bin_objects[i].append(particle)
+                break
+    return bin_objects
+
+
+def _reference_averages(bin_list, dt=0.04):
+    """
+    Осреднённые расстояния и скорости выборки через словари по шагам времени, как в исходном handler.
+    """
+    sums, counts = {}, {}
+    speeds = {}
+    for particle in bin_list:
+        distances = particle['distance']
+        for i, x in enumerate(distances):
+            sums[i] = sums.get(i, 0) + x
+            counts[i] = counts.get(i, 0) + 1
+        for i in range(len(distances) - 1):
+            speeds.setdefault(round(i * dt, 5), []).append(round((distances[i + 1] - distances[i]) / dt, 5))
+    averaged_distances = [[i * 0.04, round(sums[i] / counts[i], 4)] for i in sorted(sums)]
+    averaged_speeds = [[round(t, 5), round(sum(v) / len(v), 5)] for t, v in sorted(speeds.items())]
+    return averaged_distances, averaged_speeds
+
+
+def _reference_avg_Cd(bin_entry, dt_poly=0.001):
+    """
+    Средние Cd по полиному (цикл while по времени) и по дискретным скоростям, как в исходном solver.solve_eq.
+    """
+    m, S, D = solver.get_mass_and_area(bin_entry)
+    speeds = bin_entry['averaged_speeds']
+    if len(speeds) <= 3:
+        return None, None
+    coeffs = np.polyfit([t for t, _ in speeds], [v for _, v in speeds], deg=3)
+
+    Cd_poly = []
+    t = speeds[0][0] + dt_poly
+    while t <= speeds[-1][0]:
+        u = np.polyval(coeffs, t) * 1e-2
+        u_prev = np.polyval(coeffs, t - dt_poly) * 1e-2
+        if u != 0:
+            Cd_poly.append(-2 * m / (S * solver.ro_g * u) * ((u - u_prev) / dt_poly - solver.g))
+        t += dt_poly
+
+    Cd_disc = []
+    for (t_prev, v_prev), (t, v) in zip(speeds[:-1], speeds[1:]):
+        u, u_prev = v * 1e-2, v_prev * 1e-2
+        if u != 0:
+            Cd_disc.append(-2 * m / (S * solver.ro_g * u) * ((u - u_prev) / (t - t_prev) - solver.g))
+    return (np.mean(Cd_poly) if Cd_poly else None), (np.mean(Cd_disc) if Cd_disc else None)
+
+
+def check_correctness(particles_file='particles_dist_final.traj', bins_list=(5, 10, 20), rtol=1e-9, workdir=BENCH_DIR):
+    """
+    Сверяет handler и solver с исходными реализациями на реальных данных. Возвращает список расхождений (пустой - всё совпало).
+    """
+    os.makedirs(workdir, exist_ok=True)
+    selections_file = os.path.join(workdir, 'check_selections.json')
+    results_file = os.path.join(workdir, 'check_results.json')
+    problems = []
+
+    for bins in bins_list:
+        for include_hitted, include_NOT_hitted in ((True, True), (True, False), (False, True)):
+            config = f'bins={bins}, hitted={include_hitted}, not_hitted={include_NOT_hitted}'
+            with contextlib.redirect_stdout(io.StringIO()):
+                handler.main(particles_file, selections_file, include_hitted, include_NOT_hitted, bins, histogram_file=None)
+                solver.main(selections_file, results_file, table_file=None)
+            with open(selections_file, 'r', encoding='utf-8') as f:
+                selection_data = json.load(f)
+            with open(results_file, 'r', encoding='utf-8') as f:
+                results = iter(json.load(f))
+
+            reference_bins = _reference_bins(store.load_data(particles_file), bins, include_hitted, include_NOT_hitted)
+            for i, (bin_entry, bin_list) in enumerate(zip(selection_data, reference_bins)):
+                source, rows = handler.bin_source(bin_entry)
+                names = source.name[rows].tolist()
+                if names != [p['name'] for p in bin_list]:
+                    problems.append(f'{config}, выборка {i + 1}: другой состав частиц')
+                    continue
+                if not bin_list:
+                    continue
+                distances, speeds = _reference_averages(bin_list)
+                if bin_entry['averaged_distances'] != distances:
+                    problems.append(f'{config}, выборка {i + 1}: averaged_distances')
+                if bin_entry['averaged_speeds'] != speeds:
+                    problems.append(f'{config}, выборка {i + 1}: averaged_speeds')
+
+                result = next(results)
+                for branch, expected in zip(('poly', 'disc'), _reference_avg_Cd(bin_entry)):
+                    actual = result['avgCd'][branch]
+                    if expected is None or actual is None:
+                        if expected is not actual:
+                            problems.append(f'{config}, выборка {i + 1}: avgCd {branch} {actual} != {expected}')
+                    elif not math.isclose(actual, expected, rel_tol=rtol):
+                        problems.append(f'{config}, выборка {i + 1}: avgCd {branch} {actual} != {expected}')
+    return problems + _check_empty_bins(particles_file) + _check_round_trip(workdir)
+
+
+def _check_round_trip(workdir, drag=(1.0, 5.0), rtol_poly=0.01, rtol_disc=0.05):
+    ## синтетические траектории с постоянным Cd (уравнение решателя, см. synthetic.py) -> тот же Cd у каждой частицы
+    ## (по полиному - у каждой, по дискретным скоростям - медиана: разность вперёд относит скорость интервала к его началу)
+    problems = []
+    path = os.path.join(workdir, 'check_round_trip.traj')
+    for Cd in drag:
+        columns = synthetic.generate_columns(200, seed=1, hit_fraction=0.0, noise_cm=0.0,
+                                             cd_law=lambda Re, D_um, Cd=Cd: np.full_like(Re, Cd))
+        store.write_columns(path, **columns)
+        bin_entry = {'source': path, 'particle_indices': list(range(200)), 'speeds': {'spf': columns['description']['spf']}}
+        means = solver.particle_drag(bin_entry)
+        poly = means['Cd_poly'][~np.isnan(means['Cd_poly'])]
+        disc = means['Cd_disc'][~np.isnan(means['Cd_disc'])]
+        if len(poly) != 200 or np.abs(poly / Cd - 1).max() > rtol_poly:
+            problems.append(f'Cd={Cd}: по синтетическим траекториям Cd poly от {poly.min():.4g} до {poly.max():.4g}' if len(poly)
+                            else f'Cd={Cd}: по синтетическим траекториям Cd poly не посчитан')
+        if not len(disc) or abs(np.median(disc) / Cd - 1) > rtol_disc:
+            problems.append(f'Cd={Cd}: по синтетическим траекториям медиана Cd disc {np.median(disc) if len(disc) else None}')
+    return problems
+
+
+def _check_empty_bins(particles_file):
+    ## выборка без частиц: обратная задача возвращает пустые результаты, а не падает
+    problems = []
+    empty = {
+        'header': {'min_diameter': None, 'max_diameter': None, 'average_diameter': None, 'particle_count': 0},
+        'averaged_distances': [], 'averaged_speeds': [], 'source': particles_file, 'particle_indices': [],
+    }
+    for law in inverse.LAWS:
+        try:
+            if inverse.fit_bins([empty], law) != []:
+                problems.append(f'пустая выборка, {law}: fit_bins вернул результаты')
+            if any(len(values) for values in inverse.fit_particles(empty, law).values()):
+                problems.append(f'пустая выборка, {law}: fit_particles вернул результаты')
+        except Exception as error:
+            problems.append(f'пустая выборка, {law}: {type(error).__name__}: {error}')
+    return problems
+
+
+def main(scales=SCALES, with_plots=False, tolerance=1.5, update_baseline=False):
+    problems = check_correctness()
+    if problems:
+        print('\033[91mБыстрые реализации расходятся с исходными:\033[0m')
+        for problem in problems:
+            print('  ' + problem)
+        return
+
+    print('\033[92mСверка с исходными реализациями пройдена\033[0m')
+    results = run_benchmarks(scales, stages=STAGES if with_plots else STAGES[:-1])
+
+    baseline = load_baseline()
+    if update_baseline or not baseline:
+        save_baseline({**baseline, **results})
+        print(f'Базовые замеры сохранены в {BASELINE_FILE}')
+        return
+
+    regressions = compare(results, baseline, tolerance)
+    for r in regressions:
+        print(f"\033[91mРегрессия {r['stage']} ({r['metric']}): {r['baseline']} -> {r['current']} (x{r['ratio']})\033[0m")
+    if not regressions:
+        print('\033[92mРегрессий нет\033[0m')
+
+
+if __name__ == "__main__":
+    main()
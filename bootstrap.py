@@ -0,0 +1,93 @@
+## Бутстреп-доверительные интервалы для средних Cd и A по выборкам
+## Частицы каждой выборки многократно выбираются с возвращением, для каждой реплики заново считаются
+## осреднённые скорости, полином скорости и Cd/A. Реплики обрабатываются векторно (матрица кратностей
+## частиц в реплике), пачки реплик распределяются по процессам
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import fitting
+import handler
+import solver
+
+CHUNK_SIZE = 250  # реплик в одной пачке (ограничивает память на процесс)
+
+
+def _particle_speeds(bin_entry):
+    """
+    Скорости частиц выборки (тем же методом, что и averaged_speeds) -> (время шага (L,), скорости (n_particles, L)
+    с нулями вместо пропусков, маска).
+    """
+    values, offsets, dt = handler.bin_speeds(bin_entry)
+    lengths = np.diff(offsets)
+    n_steps = int(lengths.max()) if len(lengths) else 0
+
+    mask = np.arange(n_steps) < lengths[:, None]
+    speeds = np.zeros(mask.shape)
+    speeds[mask] = values
+    step_times = np.array([round(j * dt, 5) for j in range(n_steps)], dtype=np.float64)
+    return step_times, speeds, mask.astype(np.float64)
+
+
+def _replicate_means(task):
+    """
+    Одна пачка реплик одной выборки: средние по времени Cd и A (полином и дискретно) для каждой реплики.
+    """
+    step_times, speeds, mask, m, S, D, n_replicates, dt_poly, seed = task
+    rng = np.random.default_rng(seed)
+    n_particles = len(speeds)
+
+    # Кратности частиц в каждой реплике (n_replicates, n_particles)
+    weights = rng.multinomial(n_particles, np.full(n_particles, 1 / n_particles), size=n_replicates).astype(np.float64)
+    counts = weights @ mask
+    with np.errstate(invalid='ignore', divide='ignore'):
+        avg_speeds = (weights @ speeds) / counts  # осреднённые скорости каждой реплики
+    valid = counts > 0
+    avg_speeds[~valid] = np.nan
+    times = np.where(valid, step_times, np.nan)
+
+    coeffs = fitting.fit_polynomials(times, avg_speeds, valid, deg=3)
+    solution = solver.solve_curves(times, avg_speeds, coeffs, m, S, D, dt_poly=dt_poly)
+
+    with np.errstate(invalid='ignore'):
+        return {
+            f'{name}_{branch}': np.nanmean(solution[branch][name], axis=1)
+            for name in ('Cd', 'A') for branch in ('poly', 'disc')
+        }
+
+
+def bootstrap_intervals(selection_data, n_replicates=1000, level=95, dt_poly=0.001, seed=0, workers=None):
+    """
+    Перцентильные доверительные интервалы для avgCd и avgA каждой выборки (в порядке solver.solve_bins).
+    Возвращает список словарей {'Cd_poly': [низ, верх], ..., 'level', 'replicates'}.
+    """
+    bins = [bin_entry for bin_entry in selection_data if bin_entry['header']['average_diameter'] is not None]
+    seeds = np.random.SeedSequence(seed).spawn(len(bins))
+
+    tasks = []
+    owners = []
+    for i, bin_entry in enumerate(bins):
+        if not bin_entry['header']['particle_count']:
+            continue
+        m, S, D = solver.get_mass_and_area(bin_entry)
+        step_times, speeds, mask = _particle_speeds(bin_entry)
+        chunk_seeds = seeds[i].spawn(-(-n_replicates // CHUNK_SIZE))
+        for j, chunk_seed in enumerate(chunk_seeds):
+            size = min(CHUNK_SIZE, n_replicates - j * CHUNK_SIZE)
+            tasks.append((step_times, speeds, mask, m, S, D, size, dt_poly, chunk_seed))
+            owners.append(i)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunks = list(executor.map(_replicate_means, tasks))
+
+    low, high = (100 - level) / 2, 100 - (100 - level) / 2
+    intervals = []
+    for i in range(len(bins)):
+        parts = [chunk for chunk, owner in zip(chunks, owners) if owner == i]
+        interval = {'level': level, 'replicates': n_replicates}
+        for key in ('Cd_poly', 'Cd_disc', 'A_poly', 'A_disc'):
+            values = np.concatenate([part[key] for part in parts]) if parts else np.array([])
+            values = values[~np.isnan(values)]
+            interval[key] = np.percentile(values, [low, high]).tolist() if len(values) else [None, None]
+        intervals.append(interval)
+
+    print(f'\033[92mБутстреп: {n_replicates} реплик для {len(bins)} выборок\033[0m')
+    return intervals
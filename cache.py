@@ -0,0 +1,175 @@
+## Кэш результатов этапов handler / solver / plotter по содержимому входов
+## Ключ этапа - sha256 от содержимого входных файлов, параметров этапа и исходного кода модулей этапа.
+## Если ключ уже есть в кэше, выходные файлы этапа просто копируются из кэша, этап не запускается.
+## Размер кэша ограничен, при переполнении удаляются записи, которые дольше всего не использовались (LRU)
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import telemetry
+
+CACHE_DIR = '.stage_cache'
+MAX_CACHE_BYTES = 512 * 1024 ** 2
+_BLOCK = 1024 * 1024
+
+
+def _hash_file(h, path):
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_BLOCK), b''):
+            h.update(block)
+
+
+def _hash_path(h, path):
+    """
+    Содержимое файла или папки (например, хранилища траекторий .traj) в хэш.
+    """
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                full = os.path.join(root, name)
+                h.update(os.path.relpath(full, path).encode('utf-8'))
+                _hash_file(h, full)
+    else:
+        _hash_file(h, path)
+
+
+_digests = {}  # путь -> (размеры и времена изменения файлов, sha256 содержимого)
+
+
+def _stamps(path):
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return ((os.path.basename(path), stat.st_size, stat.st_mtime_ns),)
+    stamps = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            full = os.path.join(root, name)
+            stat = os.stat(full)
+            stamps.append((os.path.relpath(full, path), stat.st_size, stat.st_mtime_ns))
+    return tuple(stamps)
+
+
+def path_digest(path):
+    """
+    sha256 содержимого файла или папки (хранилища траекторий). В процессе считается один раз и пересчитывается,
+    только если у какого-то файла изменился размер или время изменения, - большой архив не перечитывается на каждом запуске.
+    """
+    key = os.path.abspath(path)
+    stamps = _stamps(path)
+    cached = _digests.get(key)
+    if cached is None or cached[0] != stamps:
+        h = hashlib.sha256()
+        _hash_path(h, path)
+        cached = _digests[key] = (stamps, h.hexdigest())
+    return cached[1]
+
+
+def _module_file(module):
+    return module if isinstance(module, str) else module.__file__
+
+
+def stage_key(stage, input_paths, params, modules):
+    """
+    Ключ этапа: имя, содержимое входов, параметры (JSON с сортировкой ключей) и код модулей (версия кода).
+    """
+    h = hashlib.sha256()
+    h.update(stage.encode('utf-8'))
+    for path in input_paths:
+        h.update(b'\0input\0')
+        _hash_path(h, path)
+    h.update(json.dumps(params, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8'))
+    for module in modules:
+        h.update(b'\0code\0')
+        _hash_file(h, _module_file(module))
+    return h.hexdigest()
+
+
+def _entry_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files)
+
+
+def evict(cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+    """
+    Удаляет самые давно использованные записи, пока кэш не станет меньше max_bytes.
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if os.path.isdir(path) and not name.startswith('.'):
+            entries.append((os.path.getmtime(path), _entry_size(path), path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        # Сначала переименование: запись сразу пропадает для fetch других процессов, а не удаляется у них из-под копирования
+        doomed = os.path.join(cache_dir, f'.evict-{os.getpid()}-{os.path.basename(path)}')
+        try:
+            os.rename(path, doomed)
+        except OSError:  # запись уже удалил другой процесс
+            continue
+        shutil.rmtree(doomed, ignore_errors=True)
+        total -= size
+
+
+def fetch(key, outputs, cache_dir=CACHE_DIR):
+    """
+    Копирует выходы этапа из кэша по путям outputs {роль: путь}. Возвращает True, если запись найдена.
+    Запись, удалённая другим процессом во время копирования, - промах: этап просто считается заново.
+    """
+    entry = os.path.join(cache_dir, key)
+    if not all(os.path.isfile(os.path.join(entry, role)) for role in outputs):
+        return False
+    try:
+        for role, path in outputs.items():
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            shutil.copyfile(os.path.join(entry, role), path)
+        os.utime(entry)  # отметка использования для LRU
+    except OSError:
+        return False
+    return True
+
+
+def put(key, outputs, cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+    """
+    Сохраняет выходы этапа в кэш (запись во временную папку и переименование - безопасно для параллельных запусков).
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = os.path.join(cache_dir, key)
+    if os.path.isdir(entry):
+        try:
+            os.utime(entry)
+            return
+        except OSError:  # запись как раз удаляется другим процессом - сохраняем заново
+            pass
+    tmp = tempfile.mkdtemp(prefix='.tmp-', dir=cache_dir)
+    for role, path in outputs.items():
+        shutil.copyfile(path, os.path.join(tmp, role))
+    try:
+        os.rename(tmp, entry)
+    except OSError:  # ту же запись уже сохранил другой процесс
+        shutil.rmtree(tmp, ignore_errors=True)
+    evict(cache_dir, max_bytes)
+
+
+def run_stage(stage, func, input_paths, params, modules, outputs, cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+    """
+    Запускает этап func() только если его результата нет в кэше.
+    outputs - {роль: путь} файлов, которые этап пишет. Возвращает True, если результат взят из кэша.
+    """
+    outputs = {role: path for role, path in outputs.items() if path}
+    key = stage_key(stage, input_paths, params, modules)
+    if fetch(key, outputs, cache_dir):
+        print(f'\033[94mЭтап {stage}: результат взят из кэша ({key[:12]})\033[0m')
+        telemetry.count('cache_hits')
+        return True
+    func()
+    put(key, outputs, cache_dir, max_bytes)
+    return False
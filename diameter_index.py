@@ -0,0 +1,216 @@
+## Индекс для мгновенной перегруппировки частиц по диаметрам без прохода по траекториям
+## Частицы с ударами и без ударов отдельно отсортированы по диаметру; для каждого различного диаметра хранятся
+## накопленные (префиксные) суммы и количества расстояний и скоростей по кадрам.
+## Средняя кривая любого интервала диаметров - две строки накопленных сумм и вычитание на каждом кадре,
+## номера частиц интервала - срез отсортированного массива. Границы: равные интервалы, равное количество частиц или свои.
+## Индекс строится один раз для каждого метода скоростей и сохраняется рядом с источником
+## ("particles_dist_final.traj.forward.index.npz", с параметрами метода - ещё и их хеш в имени), см. open_index
+import hashlib
+import json
+import os
+import numpy as np
+import differentiation
+import handler
+import store
+import telemetry
+
+INDEX_VERSION = 1
+SUBSETS = ('hit', 'not_hit')
+ARRAYS = ('diameters', 'starts', 'order', 'diameter_sum', 'distance_sum', 'distance_count', 'speed_sum', 'speed_count')
+
+
+class DiameterIndex:
+    """
+    Префиксные суммы по диаметрам для подмножеств частиц 'hit' и 'not_hit'.
+    У подмножества: diameters (u,) - различные диаметры по возрастанию, starts (u + 1,) - начала частиц каждого диаметра
+    в order (номера частиц источника), накопленные по диаметрам суммы (u + 1, кадры) со строкой нулей в начале.
+    """
+
+    def __init__(self, subsets, speeds, source_path=None):
+        self.subsets = subsets
+        self.speeds = speeds  # {'method', 'options', 'spf'} - как считались скорости
+        self.source_path = source_path
+        self.stamp = None  # время изменения источника, для которого построен индекс
+
+    @classmethod
+    def build(cls, source, speed_method=differentiation.DEFAULT_METHOD, speed_options=None):
+        """
+        Один проход по траекториям источника (store.TrajectoryStore).
+        """
+        speeds = {'method': speed_method, 'options': dict(speed_options or {}), 'spf': source.description.get('spf', 0.04)}
+        hitted = np.asarray(source.hit) == 1
+        n_frames = int(source.lengths.max()) if len(source) else 0
+
+        subsets = {}
+        for subset, mask in zip(SUBSETS, (hitted, ~hitted)):
+            rows = np.flatnonzero(mask)
+            diameters = np.asarray(source.diameter[rows], dtype=np.float64)
+            order = np.argsort(diameters, kind='stable')  # при равных диаметрах - исходный порядок частиц
+            rows, diameters = rows[order], diameters[order]
+            unique, groups, counts = np.unique(diameters, return_inverse=True, return_counts=True)
+
+            arrays = {'diameters': unique, 'order': rows}
+            arrays['starts'] = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+            arrays['diameter_sum'] = np.concatenate([[0.0], np.cumsum(unique * counts)])
+
+            distances, offsets = source.gather(rows)
+            dist_stats = handler.ragged_step_stats(distances, offsets, groups, len(unique))
+            values, offsets = handler.particle_speeds(source, rows, speeds['spf'], speed_method, speed_options)
+            speed_stats = handler.ragged_step_stats(values, offsets, groups, len(unique))
+            for prefix, stats in (('distance', dist_stats), ('speed', speed_stats)):
+                for name in ('sum', 'count'):
+                    table = np.zeros((len(unique) + 1, n_frames), dtype=np.float64 if name == 'sum' else np.int64)
+                    np.cumsum(stats[name], axis=0, out=table[1:, :stats[name].shape[1]])
+                    arrays[f'{prefix}_{name}'] = table
+            subsets[subset] = arrays
+
+        telemetry.count('particles', len(source))
+        return cls(subsets, speeds, getattr(source, 'path', None))
+
+    def save(self, filename, stamp=None):
+        meta = {'version': INDEX_VERSION, 'speeds': self.speeds, 'source': self.source_path, 'stamp': stamp}
+        arrays = {f'{subset}_{name}': self.subsets[subset][name] for subset in SUBSETS for name in ARRAYS}
+        # Сначала во временный файл, затем замена - параллельные процессы не прочитают недописанный индекс
+        temporary = f'{filename}.{os.getpid()}.tmp'
+        with open(temporary, 'wb') as f:
+            np.savez(f, meta=json.dumps(meta, ensure_ascii=False), **arrays)
+        os.replace(temporary, filename)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as npz:
+            meta = json.loads(str(npz['meta']))
+            if meta.get('version') != INDEX_VERSION:
+                raise ValueError(f'Неподдерживаемая версия индекса {meta.get("version")} в {filename}')
+            subsets = {subset: {name: npz[f'{subset}_{name}'] for name in ARRAYS} for subset in SUBSETS}
+        index = cls(subsets, meta['speeds'], meta['source'])
+        index.stamp = meta['stamp']
+        return index
+
+    def _selected(self, include_hitted, include_NOT_hitted):
+        return [self.subsets[subset] for subset, used in zip(SUBSETS, (include_hitted, include_NOT_hitted)) if used]
+
+    def edges(self, bins_count=10, mode='equal', include_hitted=True, include_NOT_hitted=True):
+        """
+        Границы выборок: 'equal' - bins_count равных интервалов (как у handler.select_bins),
+        'quantile' - примерно равное количество частиц в выборках (совпадающие границы объединяются).
+        """
+        subsets = self._selected(include_hitted, include_NOT_hitted)
+        if mode == 'equal':
+            present = np.concatenate([s['diameters'] for s in subsets]) if subsets else np.zeros(0)
+            return np.histogram_bin_edges(present, bins=bins_count)  # зависит только от минимума и максимума
+        if mode == 'quantile':
+            return handler.quantile_edges(np.concatenate([np.repeat(s['diameters'], np.diff(s['starts'])) for s in subsets]), bins_count)
+        raise ValueError(f'Неизвестный способ выбора границ: {mode}')
+
+    def select(self, edges, include_hitted=True, include_NOT_hitted=True):
+        """
+        Выборки с границами edges (правило включения как у handler.bin_diameters) без прохода по траекториям.
+        Возвращает (номера частиц источника по выборкам, статистика по выборкам как у handler.bin_stats,
+        суммы и количества расстояний, то же для скоростей) - суммы и количества в виде массивов (выборки, кадры).
+        """
+        edges = np.asarray(edges, dtype=np.float64)
+        n_bins = len(edges) - 1
+        parts = []
+        totals = {}
+        counts = np.zeros(n_bins, dtype=np.int64)
+        diameter_sums = np.zeros(n_bins)
+        minimums = np.full(n_bins, np.inf)
+        maximums = np.full(n_bins, -np.inf)
+
+        for s in self._selected(include_hitted, include_NOT_hitted):
+            low = np.searchsorted(s['diameters'], edges[:-1], side='left')
+            high = np.searchsorted(s['diameters'], edges[1:], side='left')
+            high[-1] = np.searchsorted(s['diameters'], edges[-1], side='right')  # правая граница - в последнем интервале
+            high = np.maximum(high, low)
+
+            for name in ('distance_sum', 'distance_count', 'speed_sum', 'speed_count'):
+                difference = s[name][high] - s[name][low]
+                totals[name] = totals[name] + difference if name in totals else difference
+            counts += s['starts'][high] - s['starts'][low]
+            diameter_sums += s['diameter_sum'][high] - s['diameter_sum'][low]
+            filled = high > low
+            minimums[filled] = np.minimum(minimums[filled], s['diameters'][low[filled]])
+            maximums[filled] = np.maximum(maximums[filled], s['diameters'][high[filled] - 1])
+            parts.append([s['order'][s['starts'][a]:s['starts'][b]] for a, b in zip(low.tolist(), high.tolist())])
+
+        # Номера частиц выборки - в исходном порядке, как у handler.select_bins
+        bin_rows = [np.sort(np.concatenate([part[i] for part in parts])) if parts else np.zeros(0, dtype=np.int64)
+                    for i in range(n_bins)]
+        stats_per_bin = []
+        for i in range(n_bins):
+            if counts[i] == 0:
+                stats_per_bin.append((None, None, None, 0))
+            else:
+                stats_per_bin.append((_number(minimums[i]), _number(maximums[i]),
+                                      round(diameter_sums[i].item() / counts[i].item(), 2), counts[i].item()))
+
+        n_frames = max((s['distance_sum'].shape[1] for s in self.subsets.values()), default=0)
+        if not totals:
+            totals = {name: np.zeros((n_bins, n_frames)) for name in ('distance_sum', 'distance_count', 'speed_sum', 'speed_count')}
+        dist_stats = {'sum': totals['distance_sum'], 'count': totals['distance_count']}
+        speed_stats = {'sum': totals['speed_sum'], 'count': totals['speed_count']}
+        return bin_rows, stats_per_bin, dist_stats, speed_stats
+
+    def bin_entries(self, edges, include_hitted=True, include_NOT_hitted=True, source_file=None):
+        """
+        Выборки в формате selections.json (как у handler.main) для границ edges.
+        """
+        bin_rows, stats_per_bin, dist_stats, speed_stats = self.select(edges, include_hitted, include_NOT_hitted)
+        all_distances, all_speeds = handler.averaged_curves(dist_stats, speed_stats, self.speeds['spf'])
+        return [{
+            'header': {'min_diameter': stats[0], 'max_diameter': stats[1], 'average_diameter': stats[2], 'particle_count': stats[3]},
+            'averaged_distances': all_distances[i],
+            'averaged_speeds': all_speeds[i],
+            'source': source_file or self.source_path,
+            'particle_indices': rows.tolist(),
+            'speeds': self.speeds,
+        } for i, (rows, stats) in enumerate(zip(bin_rows, stats_per_bin))]
+
+
+def _number(value):
+    ## целые диаметры - int, как в источнике
+    return int(value) if float(value).is_integer() else float(value)
+
+
+def _stamp(path):
+    return os.path.getmtime(os.path.join(path, 'meta.json') if store.is_store(path) else path)
+
+
+def index_filename(path, speed_method=differentiation.DEFAULT_METHOD, speed_options=None):
+    """
+    Файл индекса источника path для метода скоростей: у каждого метода и набора параметров - свой файл.
+    """
+    name = path.rstrip('/\\') + '.' + speed_method
+    if speed_options:
+        options = json.dumps(speed_options, sort_keys=True, ensure_ascii=False, default=str)
+        name += '-' + hashlib.sha1(options.encode('utf-8')).hexdigest()[:10]
+    return name + '.index.npz'
+
+
+_indexes = {}  # открытые индексы: файл индекса (свой для метода скоростей) -> индекс
+
+
+def open_index(path, speed_method=differentiation.DEFAULT_METHOD, speed_options=None):
+    """
+    Индекс источника path: читается из index_filename(...), если он построен для текущей версии источника и тем же
+    методом скоростей, иначе строится заново и сохраняется.
+    """
+    filename = index_filename(path, speed_method, speed_options)
+    speeds = {'method': speed_method, 'options': dict(speed_options or {})}
+    stamp = _stamp(path)
+
+    def current(index):
+        return index.stamp == stamp and {k: index.speeds[k] for k in speeds} == speeds
+
+    index = _indexes.get(filename)
+    if index is None and os.path.isfile(filename):
+        index = DiameterIndex.load(filename)
+    if index is None or not current(index):
+        with telemetry.stage('index'):
+            index = DiameterIndex.build(store.open_source(path), speed_method, speed_options)
+            index.source_path = path
+            index.stamp = stamp
+            index.save(filename, stamp)
+    _indexes[filename] = index
+    return index
@@ -0,0 +1,138 @@
+## Скорости частиц из расстояний: выбираемые методы дифференцирования, векторно по всем траекториям сразу
+## Траектории передаются рваным массивом (все расстояния подряд + смещения, как в store.py), результат - так же.
+## Методы:
+##   'forward'    - разность соседних точек / dt (прежний способ, скоростей на одну меньше, округление до 5 знаков)
+##   'central'    - центральные разности, на краях - односторонние (как np.gradient)
+##   'savgol'     - фильтр Савицкого-Голея: производная локального полинома order по окну window точек
+##   'local_poly' - локальная полиномиальная регрессия с весами tricube (LOESS) по окну window точек
+##   'spline'     - сглаживающий сплайн Уиттекера (штраф lam на вторые разности), затем центральные разности
+## Скорость j-го значения относится к времени j * dt, кроме 'forward' у всех методов столько же скоростей, сколько точек
+import numpy as np
+
+DEFAULT_METHOD = 'forward'
+
+
+def _ragged_positions(offsets, lengths):
+    """
+    Результат длиной lengths[i] у траектории i -> (смещения результата, номер траектории и номер точки в траектории
+    для каждого значения результата).
+    """
+    out_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=out_offsets[1:])
+    owner = np.repeat(np.arange(len(lengths)), lengths)
+    step = np.arange(out_offsets[-1], dtype=np.int64) - out_offsets[:-1][owner]
+    return out_offsets, owner, step
+
+
+def forward(values, offsets, dt, decimals=5):
+    ## decimals - округление скоростей (None - без округления, например для точного round() Python в handler.legacy_speeds)
+    lengths = np.maximum(np.diff(offsets) - 1, 0)
+    out_offsets, owner, step = _ragged_positions(offsets, lengths)
+    index = offsets[:-1][owner] + step
+    speeds = (values[index + 1] - values[index]) / dt
+    if decimals is not None:
+        speeds = np.round(speeds, decimals)
+    return speeds, out_offsets
+
+
+def central(values, offsets, dt):
+    lengths = np.diff(offsets)
+    lengths = np.where(lengths >= 2, lengths, 0)
+    out_offsets, owner, step = _ragged_positions(offsets, lengths)
+    start = offsets[:-1][owner]
+    left = start + np.maximum(step - 1, 0)
+    right = start + np.minimum(step + 1, lengths[owner] - 1)
+    return (values[right] - values[left]) / ((right - left) * dt), out_offsets
+
+
+def _local_fit_coefficients(window, order, dt, weighted):
+    """
+    Коэффициенты производной локального полинома: строка p - точка окна, в которой берётся производная.
+    """
+    k = np.arange(window)
+    coefficients = np.empty((window, window))
+    for p in range(window):
+        V = ((k - p) * dt)[:, None] ** np.arange(order + 1)
+        if weighted:
+            distance = np.abs(k - p) / (max(p, window - 1 - p) + 1)
+            w = (1 - distance ** 3) ** 3
+        else:
+            w = np.ones(window)
+        operator = np.linalg.pinv(V * w[:, None]) * w  # (order + 1, window): beta = operator @ y
+        coefficients[p] = operator[1]
+    return coefficients
+
+
+def _local_fit(values, offsets, dt, window, order, weighted):
+    lengths = np.diff(offsets)
+    lengths = np.where(lengths >= 2, lengths, 0)
+    out_offsets, owner, step = _ragged_positions(offsets, lengths)
+    speeds = np.empty(out_offsets[-1])
+
+    # Короткие траектории - с окном во всю длину; траектории группируются по размеру окна
+    windows = np.minimum(window, lengths)
+    for w in np.unique(windows[lengths > 0]).tolist():
+        coefficients = _local_fit_coefficients(w, min(order, w - 1), dt, weighted)
+        selected = np.flatnonzero(windows[owner] == w)
+        start = offsets[:-1][owner[selected]]
+        length = lengths[owner[selected]]
+        # Окно по центру точки, у краёв траектории - сдвинуто внутрь
+        window_start = np.clip(step[selected] - w // 2, 0, length - w)
+        position = step[selected] - window_start
+        gathered = values[(start + window_start)[:, None] + np.arange(w)]
+        speeds[selected] = np.einsum('nk,nk->n', coefficients[position], gathered)
+    return speeds, out_offsets
+
+
+def savgol(values, offsets, dt, window=7, order=2):
+    return _local_fit(values, offsets, dt, window, order, weighted=False)
+
+
+def local_poly(values, offsets, dt, window=9, order=2):
+    return _local_fit(values, offsets, dt, window, order, weighted=True)
+
+
+def spline(values, offsets, dt, lam=10.0):
+    """
+    Сглаживание Уиттекера: z = argmin |y - z|^2 + lam |D2 z|^2; все траектории одной длины - одним решением.
+    """
+    lengths = np.diff(offsets)
+    smoothed = np.asarray(values, dtype=np.float64).copy()
+    for length in np.unique(lengths[lengths >= 3]).tolist():
+        selected = np.flatnonzero(lengths == length)
+        D2 = np.diff(np.eye(length), n=2, axis=0)
+        system = np.eye(length) + lam * D2.T @ D2
+        index = offsets[selected][:, None] + np.arange(length)
+        smoothed[index] = np.linalg.solve(system, smoothed[index].T).T
+    return central(smoothed, offsets, dt)
+
+
+METHODS = {
+    'forward': forward,
+    'central': central,
+    'savgol': savgol,
+    'local_poly': local_poly,
+    'spline': spline,
+}
+
+
+def differentiate(values, offsets, dt, method=DEFAULT_METHOD, **options):
+    """
+    Скорости всех траекторий методом method -> (все скорости подряд, смещения).
+    options - параметры метода (window, order для 'savgol'/'local_poly', lam для 'spline').
+    """
+    if method not in METHODS:
+        raise ValueError(f'Неизвестный метод дифференцирования: {method} (есть: {", ".join(METHODS)})')
+    values = np.asarray(values, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    return METHODS[method](values, offsets, dt, **options)
+
+
+def compare_methods(source, rows=None, methods=tuple(METHODS), dt=None):
+    """
+    Скорости всех (или rows) частиц источника всеми методами за один проход: {метод: (скорости, смещения)}.
+    """
+    rows = np.arange(len(source)) if rows is None else rows
+    values, offsets = source.gather(rows)
+    dt = source.description.get('spf', 0.04) if dt is None else dt
+    return {method: differentiate(values, offsets, dt, method) for method in methods}
@@ -0,0 +1,100 @@
+## Общий сервис полиномиальной аппроксимации скоростей для solver и plotter
+## Все выборки (или частицы) аппроксимируются одним пакетным МНК, результат кэшируется,
+## поэтому один и тот же полином по averaged_speeds не считается два-три раза за запуск
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+CACHE_SIZE = 32
+_cache = OrderedDict()
+
+
+def pad_series(series_list):
+    """
+    Список рядов [[t, v], ...] разной длины -> массивы (n, max_length) времени и значений,
+    дополненные nan, и маска заполненных точек.
+    """
+    lengths = [len(series) for series in series_list]
+    max_length = max(lengths, default=0)
+    times = np.full((len(series_list), max_length), np.nan)
+    values = np.full((len(series_list), max_length), np.nan)
+    for i, series in enumerate(series_list):
+        if lengths[i]:
+            series = np.asarray(series, dtype=np.float64)
+            times[i, :lengths[i]] = series[:, 0]
+            values[i, :lengths[i]] = series[:, 1]
+    return times, values, ~np.isnan(values)
+
+
+def fit_polynomials(times, values, mask=None, deg=3, weights=None):
+    """
+    Пакетный МНК: полином степени deg для каждой строки times/values (n, L) одним решением.
+    mask - какие точки строки участвуют (для рядов разной длины), weights - веса точек
+    (как w в np.polyfit: умножают невязки). Коэффициенты - от старшей степени к младшей, как в np.polyfit.
+    Строки, где точек не больше deg, получают nan.
+    """
+    times = np.asarray(times, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    if mask is None:
+        mask = ~(np.isnan(times) | np.isnan(values))
+    w = mask.astype(np.float64)
+    if weights is not None:
+        w = w * np.asarray(weights, dtype=np.float64)
+
+    t = np.where(mask, times, 0.0)
+    y = np.where(mask, values, 0.0) * w
+    lhs = (t[..., None] ** np.arange(deg, -1, -1)) * w[..., None]  # (n, L, deg + 1)
+
+    # Масштабирование столбцов, как в np.polyfit, для обусловленности
+    scale = np.sqrt((lhs * lhs).sum(axis=1, keepdims=True))
+    scale[scale == 0] = 1.0
+    lhs = lhs / scale
+
+    valid = mask.sum(axis=1) > deg
+    coeffs = np.full((len(values), deg + 1), np.nan)
+    if valid.any():
+        q, r = np.linalg.qr(lhs[valid])
+        rhs = np.einsum('nlk,nl->nk', q, y[valid])
+        coeffs[valid] = np.linalg.solve(r, rhs[..., None])[..., 0] / scale[valid, 0]
+    return coeffs
+
+
+def _key(times, values, mask, deg, weights):
+    h = hashlib.sha1()
+    for array in (times, values, mask) + (() if weights is None else (np.asarray(weights, dtype=np.float64),)):
+        h.update(str(array.shape).encode())
+        h.update(np.ascontiguousarray(array).tobytes())
+    h.update(f'deg={deg};weights={weights is not None}'.encode())
+    return h.hexdigest()
+
+
+def fit_polynomials_cached(times, values, mask=None, deg=3, weights=None):
+    """
+    fit_polynomials с кэшем по содержимому входных массивов.
+    """
+    if mask is None:
+        mask = ~(np.isnan(times) | np.isnan(values))
+    key = _key(times, values, mask, deg, weights)
+    if key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key]
+
+    coeffs = fit_polynomials(times, values, mask, deg=deg, weights=weights)
+    coeffs.setflags(write=False)
+    _cache[key] = coeffs
+    if len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+    return coeffs
+
+
+def velocity_polynom_coeffs(selection_data, deg=3, weights=None):
+    """
+    Коэффициенты полинома скорости от времени (по averaged_speeds) для всех выборок сразу,
+    массив (n_bins, deg + 1). Одинаковые запросы solver и plotter берутся из кэша.
+    """
+    times, speeds, mask = pad_series([bin_entry['averaged_speeds'] for bin_entry in selection_data])
+    return fit_polynomials_cached(times, speeds, mask, deg=deg, weights=weights)
+
+
+def clear_cache():
+    _cache.clear()
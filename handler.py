@@ -1,44 +1,92 @@
 ## Группировка объектов по диаметрам и вычисление статистики для каждой группы вывод в selections.json
 ## Приеимает на вход файл particles_dist_final.json, в котором находятся данные о частицах уже обрезанные по времени удара
-import json
-import matplotlib.pyplot as plt
+## или хранилище траекторий particles_dist_final.traj с теми же данными (см. store.py)
+import numpy as np
+import differentiation
+import jsonstream
+import plotter
+import store
+import telemetry
 
-def histogram_D(data, bins_count=10, include_hitted=True, include_NOT_hitted=True):
-    plt.figure()
-    diameters = []
-    filtered_particles = []
-
-    # Фильтрация частиц и сбор диаметров
-    for particle in data['particles']:
-        hit = particle.get('hit', None)
-
-        if hit is True and not include_hitted:
-            continue
-        if (hit is False or hit is None) and not include_NOT_hitted:
-            continue
-
-        diameters.append(particle['diameter'])
-        filtered_particles.append(particle)
-
-    counts, bins, _ = plt.hist(diameters, bins=bins_count, color='blue', alpha=0.7)
+BIN_MODES = ('equal', 'quantile')
 
-    # Группировка отфильтрованных частиц по bin'ам
-    bin_objects = [[] for _ in range(len(bins) - 1)]
-    for particle in filtered_particles:
-        d = particle['diameter']
-        for i in range(len(bins) - 1):
-            if bins[i] <= d < bins[i + 1] or (i == len(bins) - 2 and d == bins[-1]):
-                bin_objects[i].append(particle)
-                break
+def quantile_edges(diameters, bins_count=10):
+    """
+    Границы bins_count выборок с примерно равным количеством частиц (совпадающие границы объединяются).
+    """
+    return np.unique(np.quantile(np.asarray(diameters, dtype=np.float64), np.linspace(0, 1, bins_count + 1)))
 
+def bin_diameters(diameters, bins_count=10, edges=None, mode='equal'):
+    """
+    Разбивает диаметры на интервалы без matplotlib.
+    Границы - как у plt.hist (np.histogram_bin_edges), по квантилям (mode='quantile', см. quantile_edges) или заданные edges
+    (закреплённые, частицы вне них не попадают ни в одну выборку), правило включения прежнее:
+    bins[i] <= d < bins[i + 1], а правая граница включается в последний интервал.
+    Возвращает (границы, список массивов индексов частиц для каждого интервала).
+    """
+    diameters = np.asarray(diameters, dtype=np.float64)
+    if edges is None and mode == 'quantile':
+        edges = quantile_edges(diameters, bins_count)
+    elif edges is None and mode == 'equal':
+        edges = np.histogram_bin_edges(diameters, bins=bins_count)
+    elif edges is None:
+        raise ValueError(f'Неизвестный способ выбора границ: {mode} (есть: {", ".join(BIN_MODES)})')
+    edges = np.asarray(edges, dtype=np.float64)
+    n_bins = len(edges) - 1
+
+    bin_index = np.searchsorted(edges, diameters, side='right') - 1
+    bin_index[diameters == edges[-1]] = n_bins - 1
+
+    inside = (bin_index >= 0) & (bin_index < n_bins)
+    particle_index = np.flatnonzero(inside)
+    bin_index = bin_index[inside]
+
+    order = np.argsort(bin_index, kind='stable')  # внутри интервала сохраняется исходный порядок частиц
+    splits = np.searchsorted(bin_index[order], np.arange(1, n_bins))
+    return edges, np.split(particle_index[order], splits)
+
+def render_histogram(diameters, edges, output_file='./_RESULTS_PLOTS/histogram.png', weights=None):
+    """
+    Сохраняет гистограмму распределения диаметров (необязательный шаг).
+    weights - количество частиц каждого диаметра, если diameters - только различные значения (см. scan_diameters).
+    """
+    plt = plotter.pyplot()
+    plt.figure()
+    plt.hist(diameters, bins=edges, weights=weights, color='blue', alpha=0.7)
     plt.title('Гистограмма распределения диаметров частиц')
     plt.xlabel('D (мкм)')
     plt.ylabel('Частота')
     plt.grid(True)
-    plt.xticks(bins, rotation=0)
-    plt.savefig('./_RESULTS_PLOTS/histogram.png', bbox_inches='tight')
+    plt.xticks(edges, rotation=0)
+    plt.savefig(output_file, bbox_inches='tight')
+
+def select_bins(source, bins_count=10, include_hitted=True, include_NOT_hitted=True, histogram_file='./_RESULTS_PLOTS/histogram.png',
+                edges=None, mode='equal'):
+    """
+    Отбор частиц источника траекторий (store.TrajectoryStore) по ударам и группировка по диаметрам
+    (edges - закреплённые границы выборок вместо bins_count интервалов, mode - см. bin_diameters).
+    Возвращает список массивов номеров частиц источника для каждой выборки.
+    """
+    # Фильтрация частиц и сбор диаметров
+    hitted = np.asarray(source.hit) == 1
+    selected = np.flatnonzero((hitted & include_hitted) | (~hitted & include_NOT_hitted))
+    diameters = np.asarray(source.diameter[selected], dtype=np.float64)
+
+    # Группировка отфильтрованных частиц по bin'ам
+    edges, bin_indices = bin_diameters(diameters, bins_count, edges, mode)
+
+    if histogram_file:
+        with telemetry.stage('render'):
+            render_histogram(diameters, edges, histogram_file)
 
-    return bin_objects
+    return [selected[indices] for indices in bin_indices]
+
+def histogram_D(data, bins_count=10, include_hitted=True, include_NOT_hitted=True, histogram_file='./_RESULTS_PLOTS/histogram.png'):
+    """
+    То же, что select_bins, для данных в формате particles.json: списки частиц каждой выборки.
+    """
+    bin_rows = select_bins(store.TrajectoryStore.from_data(data), bins_count, include_hitted, include_NOT_hitted, histogram_file)
+    return [[data['particles'][i] for i in rows] for rows in bin_rows]
 
 def get_bin_stats(bin_objects):
     stats_per_bin = []
@@ -56,121 +104,380 @@ def get_bin_stats(bin_objects):
 
     return stats_per_bin
 
-def average_distances_for_bin(bin_list):
-    # Проверяем, что есть хотя бы одна частица с данными о расстоянии
-    if not bin_list:
-        return []  # Если в бине нет частиц, возвращаем пустой список
+def bin_stats(source, bin_rows):
+    """
+    get_bin_stats для выборок, заданных номерами частиц источника.
+    """
+    stats_per_bin = []
+    for rows in bin_rows:
+        diameters = source.diameter[rows].tolist()
+        if not diameters:
+            stats_per_bin.append((None, None, None, 0))
+        else:
+            stats_per_bin.append((min(diameters), max(diameters), round(sum(diameters) / len(diameters), 2), len(diameters)))
+    return stats_per_bin
+
+def ragged_step_stats(values, offsets, groups=None, n_groups=None):
+    """
+    Ядро осреднения рваных массивов: values - все значения всех траекторий подряд,
+    offsets - начала траекторий (длина = число траекторий + 1), groups - номер выборки каждой траектории.
+    Шаг времени - целый номер кадра внутри траектории (без ключей по округлённому float времени).
+    За один вызов считает для всех выборок и всех шагов суммы, количества, средние и дисперсии,
+    массивы формы (n_groups, max_length); там, где данных нет, среднее и дисперсия - nan.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.diff(offsets)
+    if groups is None:
+        groups = np.zeros(len(lengths), dtype=np.int64)
+    groups = np.asarray(groups, dtype=np.int64)
+    if n_groups is None:
+        n_groups = int(groups.max()) + 1 if len(groups) else 0
+    max_length = int(lengths.max()) if len(lengths) else 0
+
+    # Ключ каждого значения: выборка * max_length + номер кадра
+    steps = np.arange(len(values), dtype=np.int64) - np.repeat(offsets[:-1], lengths)
+    keys = np.repeat(groups, lengths) * max_length + steps
+    size = n_groups * max_length
+
+    counts = np.bincount(keys, minlength=size).reshape(n_groups, max_length)
+    sums = np.bincount(keys, weights=values, minlength=size).reshape(n_groups, max_length)
+    sums_sq = np.bincount(keys, weights=values * values, minlength=size).reshape(n_groups, max_length)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+        variances = np.maximum(sums_sq / counts - means * means, 0.0)
+
+    return {'sum': sums, 'count': counts, 'sum_sq': sums_sq, 'mean': means, 'var': variances}
+
+def _ragged(arrays):
+    """
+    Список последовательностей -> (плоский массив, смещения).
+    """
+    lengths = np.fromiter((len(a) for a in arrays), dtype=np.int64, count=len(arrays))
+    offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    values = np.concatenate([np.asarray(a, dtype=np.float64) for a in arrays]) if len(arrays) else np.zeros(0)
+    return values, offsets
 
-    # Определяем максимальную длину расстояний среди всех частиц в текущем бине
-    max_length = max(len(p['distance']) for p in bin_list if p['distance'])  # Игнорируем пустые списки
+def particle_speeds(source, rows, dt=0.04, method=differentiation.DEFAULT_METHOD, options=None):
+    """
+    Скорости частиц rows источника методом method (см. differentiation.py; по умолчанию разность соседних расстояний / dt,
+    округление до 5 знаков, как раньше) -> (все скорости подряд, смещения). Ничего не записывает в источник.
+    """
+    distances, offsets = source.gather(rows)
+    return differentiation.differentiate(distances, offsets, dt, method, **(options or {}))
 
-    # Инициализируем список для хранения среднего расстояния на каждом шаге времени
-    averaged_distances = [(i * 0.04, 0) for i in range(max_length)]  # Список кортежей (время, среднее расстояние)
-    count_at_time = [0] * max_length  # Счётчик количества частиц, имеющих данные для этого времени
+def speed_settings(bin_entry):
+    """
+    Как считались скорости выборки: {'method', 'options', 'spf'} (у выборок без записи - прежняя разность при 0.04 с/кадр).
+    """
+    settings = {'method': differentiation.DEFAULT_METHOD, 'options': {}, 'spf': 0.04}
+    settings.update(bin_entry.get('speeds', {}))
+    return settings
 
-    # Проходим по каждой частице в бине
-    for particle in bin_list:
-        distances = particle.get('distance', [])
-        if distances:  # Если есть данные о расстоянии
-            for i in range(len(distances)):
-                averaged_distances[i] = (averaged_distances[i][0], averaged_distances[i][1] + distances[i])
-                count_at_time[i] += 1
+def bin_speeds(bin_entry, rows=None, source=None):
+    """
+    Скорости частиц выборки (или её частиц rows) тем же методом, что и averaged_speeds -> (скорости, смещения, spf).
+    source - уже полученный bin_source(bin_entry)[0] (при вызовах по частям источник не собирается заново), тогда нужны rows.
+    """
+    if source is None:
+        source, bin_rows = bin_source(bin_entry)
+        rows = bin_rows if rows is None else rows
+    settings = speed_settings(bin_entry)
+    speeds, offsets = particle_speeds(source, rows, settings['spf'], settings['method'], settings['options'])
+    return speeds, offsets, settings['spf']
+
+def average_bins(source, bin_rows, dt=0.04, method=differentiation.DEFAULT_METHOD, options=None):
+    """
+    Осреднённые расстояния и скорости для всех выборок за один вызов ядра ragged_step_stats.
+    bin_rows - номера частиц источника для каждой выборки (см. select_bins), dt - секунд на кадр,
+    method и options - способ получения скоростей из расстояний (см. differentiation.py).
+    Возвращает (список averaged_distances, список averaged_speeds) в прежнем формате.
+    """
+    rows = np.concatenate(bin_rows) if bin_rows else np.empty(0, dtype=np.int64)
+    groups = np.repeat(np.arange(len(bin_rows)), [len(r) for r in bin_rows])
 
-    # Теперь вычисляем среднее расстояние для каждого времени, деля на количество частиц
-    for i in range(max_length):
-        if count_at_time[i] > 0:
-            averaged_distances[i] = (averaged_distances[i][0],  round(averaged_distances[i][1] / count_at_time[i], 4))
+    distances, offsets = source.gather(rows)
+    dist_stats = ragged_step_stats(distances, offsets, groups, len(bin_rows))
 
-    return averaged_distances
+    speeds, offsets = particle_speeds(source, rows, dt, method, options)
+    speed_stats = ragged_step_stats(speeds, offsets, groups, len(bin_rows))
+    return averaged_curves(dist_stats, speed_stats, dt)
 
-def average_speeds_for_bin(bin_list):
+def averaged_curves(dist_stats, speed_stats, dt=0.04):
     """
-    Для каждой выборки (набора частиц) вычисляет осреднённые скорости на каждом шаге времени.
+    Суммы и количества по кадрам (как у ragged_step_stats, массивы (выборки, кадры)) -> (список averaged_distances,
+    список averaged_speeds) в формате selections.json.
     """
-    # Инициализация словаря для накопления скоростей по времени
-    time_speeds = {}
-
-    # Проходим по каждой частице
-    for particle in bin_list:
-        speeds = particle["speed"]
-        
-        # Проходим по каждой скорости частицы
-        for t, v in speeds:
-            if t not in time_speeds:
-                time_speeds[t] = []
-            time_speeds[t].append(v)
-    
-    # Теперь для каждого времени считаем среднее значение скорости
-    averaged_speeds = []
-    for t in sorted(time_speeds.keys()):
-        avg_speed = sum(time_speeds[t]) / len(time_speeds[t])
-        averaged_speeds.append([round(t, 5), round(avg_speed, 5)])
+    all_distances = []
+    all_speeds = []
+    for i in range(len(dist_stats['count'])):
+        steps = np.flatnonzero(dist_stats['count'][i])
+        means = dist_stats['sum'][i, steps] / dist_stats['count'][i, steps]
+        all_distances.append([(j * dt, round(m, 4)) for j, m in zip(steps.tolist(), means.tolist())])
 
-    return averaged_speeds
+        steps = np.flatnonzero(speed_stats['count'][i])
+        means = speed_stats['sum'][i, steps] / speed_stats['count'][i, steps]
+        all_speeds.append([[round(j * dt, 5), round(m, 5)] for j, m in zip(steps.tolist(), means.tolist())])
 
-def compute_particle_speeds(particles, dt=0.04):
+    return all_distances, all_speeds
+
+## === Обработка по частям: память ограничена размером пакета частиц, а не всего архива ===
+
+CHUNK_SIZE = 100_000  # частиц в одном пакете
+
+def _selected_chunk(source, start, stop, include_hitted, include_NOT_hitted):
+    hitted = np.asarray(source.hit[start:stop]) == 1
+    return start + np.flatnonzero((hitted & include_hitted) | (~hitted & include_NOT_hitted))
+
+def scan_diameters(source, include_hitted=True, include_NOT_hitted=True, chunk_size=CHUNK_SIZE):
     """
-    Вычисляет скорости для каждой частицы и записывает их в поле 'speed'.
-    Скорость считается как разность расстояний между соседними точками, делённая на dt.
+    Первый проход по частям: только колонки диаметров и ударов.
+    Возвращает (различные диаметры отобранных частиц, количество частиц каждого диаметра).
+    """
+    counts = {}
+    for start in range(0, len(source), chunk_size):
+        rows = _selected_chunk(source, start, min(start + chunk_size, len(source)), include_hitted, include_NOT_hitted)
+        unique, unique_counts = np.unique(np.asarray(source.diameter[rows], dtype=np.float64), return_counts=True)
+        for d, c in zip(unique.tolist(), unique_counts.tolist()):
+            counts[d] = counts.get(d, 0) + c
+    diameters = np.array(sorted(counts), dtype=np.float64)
+    return diameters, np.array([counts[d] for d in diameters.tolist()], dtype=np.int64)
+
+def weighted_edges(diameters, counts, bins_count=10, mode='equal'):
+    """
+    Границы выборок по различным диаметрам и их количествам - те же, что bin_diameters дал бы по всем диаметрам сразу.
+    """
+    if mode == 'equal':
+        return np.histogram_bin_edges(diameters, bins=bins_count)  # зависит только от минимума и максимума
+    if mode != 'quantile':
+        raise ValueError(f'Неизвестный способ выбора границ: {mode} (есть: {", ".join(BIN_MODES)})')
+    # Квантиль как у np.quantile (линейная интерполяция между k-м и (k+1)-м по порядку диаметрами), без развёртки в массив частиц
+    position = np.linspace(0, 1, bins_count + 1) * (counts.sum() - 1)
+    lower = np.floor(position)
+    cumulative = np.cumsum(counts)
+    below = diameters[np.searchsorted(cumulative, lower, side='right')]
+    above = diameters[np.minimum(np.searchsorted(cumulative, lower + 1, side='right'), len(diameters) - 1)]
+    t = position - lower
+    return np.unique(np.where(t >= 0.5, above - (above - below) * (1 - t), below + (above - below) * t))
+
+def stream_bins(source, edges, include_hitted=True, include_NOT_hitted=True, dt=0.04, method=differentiation.DEFAULT_METHOD,
+                options=None, chunk_size=CHUNK_SIZE):
+    """
+    Второй проход по частям: частицы пакета распределяются по выборкам с границами edges и сразу добавляются
+    в накопители по кадрам. Суммы накапливаются в порядке частиц (np.add.at), поэтому результат до бита совпадает
+    с select_bins + bin_stats + average_bins за один проход.
+    Возвращает (номера частиц по выборкам, статистика по выборкам как у bin_stats, суммы и количества расстояний, скоростей).
+    """
+    edges = np.asarray(edges, dtype=np.float64)
+    n_bins = len(edges) - 1
+    n_frames = int(source.lengths.max()) if len(source) else 0
+    dist_stats = {name: np.zeros(n_bins * n_frames) for name in ('sum', 'count', 'sum_sq')}
+    speed_stats = {name: np.zeros(n_bins * n_frames) for name in ('sum', 'count', 'sum_sq')}
+    counts = np.zeros(n_bins, dtype=np.int64)
+    diameter_sums = np.zeros(n_bins)
+    minimums = np.full(n_bins, np.inf)
+    maximums = np.full(n_bins, -np.inf)
+    parts = [[] for _ in range(n_bins)]
+
+    def accumulate(stats, values, offsets, groups):
+        lengths = np.diff(offsets)
+        keys = np.repeat(groups * n_frames, lengths) + np.arange(len(values), dtype=np.int64) - np.repeat(offsets[:-1], lengths)
+        np.add.at(stats['sum'], keys, values)
+        np.add.at(stats['count'], keys, 1)
+        np.add.at(stats['sum_sq'], keys, values * values)
+
+    for start in range(0, len(source), chunk_size):
+        rows = _selected_chunk(source, start, min(start + chunk_size, len(source)), include_hitted, include_NOT_hitted)
+        diameters = np.asarray(source.diameter[rows], dtype=np.float64)
+        groups = np.searchsorted(edges, diameters, side='right') - 1
+        groups[diameters == edges[-1]] = n_bins - 1
+        inside = (groups >= 0) & (groups < n_bins)
+        rows, diameters, groups = rows[inside], diameters[inside], groups[inside]
+
+        np.add.at(counts, groups, 1)
+        np.add.at(diameter_sums, groups, diameters)
+        np.minimum.at(minimums, groups, diameters)
+        np.maximum.at(maximums, groups, diameters)
+        order = np.argsort(groups, kind='stable')
+        for i, part in enumerate(np.split(rows[order], np.searchsorted(groups[order], np.arange(1, n_bins)))):
+            if len(part):
+                parts[i].append(part)
+
+        accumulate(dist_stats, *source.gather(rows), groups)
+        accumulate(speed_stats, *particle_speeds(source, rows, dt, method, options), groups)
+
+    bin_rows = [np.concatenate(part) if part else np.zeros(0, dtype=np.int64) for part in parts]
+    as_source = (lambda value: int(value)) if np.asarray(source.diameter[:0]).dtype.kind in 'iu' else float
+    stats_per_bin = [
+        (as_source(minimums[i]), as_source(maximums[i]), round(diameter_sums[i].item() / counts[i].item(), 2), counts[i].item())
+        if counts[i] else (None, None, None, 0)
+        for i in range(n_bins)
+    ]
+    for stats in (dist_stats, speed_stats):
+        for name in stats:
+            stats[name] = stats[name].reshape(n_bins, n_frames)
+    return bin_rows, stats_per_bin, dist_stats, speed_stats
+
+def bin_source(bin_entry):
+    """
+    Источник траекторий и номера частиц выборки из selections.json -> (store.TrajectoryStore, номера).
+    Поддерживаются и выборки старого формата с полными копиями частиц в 'particles', и выборки из нескольких
+    источников 'sources' (инкрементальная обработка, см. incremental.py) - тогда частицы собираются в одно хранилище в памяти.
+    """
+    if 'particles' in bin_entry:
+        return store.TrajectoryStore.from_data(bin_entry), np.arange(len(bin_entry['particles']))
+    if 'sources' in bin_entry:
+        parts = [(store.open_source(part['source']), part['particle_indices']) for part in bin_entry['sources']]
+        combined = store.combine(parts)
+        return combined, np.arange(len(combined))
+    return store.open_source(bin_entry['source']), np.asarray(bin_entry['particle_indices'], dtype=np.int64)
+
+def average_distances_for_bin(bin_list):
     """
-    for particle in particles:
-        distances = particle["distance"]
-        speeds = []
+    Осреднённые расстояния (время, среднее) на каждом шаге времени для одной выборки.
+    """
+    if not bin_list:
+        return []  # Если в бине нет частиц, возвращаем пустой список
 
-        for i in range(len(distances) - 1):
-            v = (distances[i+1] - distances[i]) / dt
-            t = i * dt
-            speeds.append([round(t, 5), round(v, 5)])
+    distances, offsets = _ragged([p.get('distance', []) for p in bin_list])
+    stats = ragged_step_stats(distances, offsets)
+    steps = np.flatnonzero(stats['count'][0])
+    return [(j * 0.04, round(m, 4)) for j, m in zip(steps.tolist(), stats['mean'][0, steps].tolist())]
 
-        particle["speed"] = speeds
+def legacy_speeds(distances, dt=0.04):
+    """
+    Прежние скорости по спискам расстояний: разность соседних точек с round() Python до 5 знаков (до бита как раньше).
+    """
+    speeds, offsets = differentiation.differentiate(*_ragged(distances), dt, 'forward', decimals=None)
+    return np.array([round(v, 5) for v in speeds.tolist()], dtype=np.float64), offsets
 
-def main(input_file='particles_dist_final.json', output_file='selections.json', USE_HITTED_PARTICLES=True, USE_NOT_HITTED_PARTICLES=True, BINS=20):
+def average_speeds_for_bin(bin_list, dt=0.04):
+    """
+    Для каждой выборки (набора частиц) вычисляет осреднённые скорости на каждом шаге времени.
+    """
+    if not bin_list:
+        return []
 
-    print(f'Обработка файла {input_file}...')
+    speeds, offsets = legacy_speeds([p['distance'] for p in bin_list], dt)
+    stats = ragged_step_stats(speeds, offsets)
+    steps = np.flatnonzero(stats['count'][0])
+    return [[round(j * dt, 5), round(m, 5)] for j, m in zip(steps.tolist(), stats['mean'][0, steps].tolist())]
 
-    data = json.load(open(input_file, 'r', encoding='utf-8'))
+def compute_particle_speeds(particles, dt=0.04):
+    """
+    Вычисляет скорости для каждой частицы: массив (n, 2) строк [t, v] на частицу (частицы не изменяются).
+    Скорость считается как разность расстояний между соседними точками, делённая на dt.
+    """
+    speeds, offsets = legacy_speeds([p['distance'] for p in particles], dt)
+    all_speeds = []
+    for start, stop in zip(offsets[:-1].tolist(), offsets[1:].tolist()):
+        times = np.array([round(j * dt, 5) for j in range(stop - start)], dtype=np.float64)
+        all_speeds.append(np.column_stack([times, speeds[start:stop]]))
+    return all_speeds
+
+def main(input_file='particles_dist_final.json', output_file='selections.json', USE_HITTED_PARTICLES=True, USE_NOT_HITTED_PARTICLES=True, BINS=20,
+         histogram_file='./_RESULTS_PLOTS/histogram.png', data=None, speed_method=differentiation.DEFAULT_METHOD, speed_options=None,
+         edges=None, bin_mode='equal', index=None, chunk_size=None, compact=False):
+    ## data - уже загруженные данные о частицах (например, общие для всех запусков перебора параметров), тогда input_file не читается,
+    ##        но записывается в выборки как источник траекторий, поэтому data должны быть загружены из input_file
+    ## В selections.json у выборки только заголовок, осреднённые кривые и номера частиц в input_file (particle_indices),
+    ## сами траектории и скорости частиц берутся из источника по запросу (см. bin_source, bin_speeds)
+    ## speed_method, speed_options - метод дифференцирования расстояний (см. differentiation.py), записывается в выборки,
+    ##        чтобы бутстреп и расчёт по частицам считали скорости так же; секунд на кадр - spf из description источника
+    ## edges - закреплённые границы выборок по диаметру (мкм) вместо BINS интервалов
+    ## bin_mode - 'equal' (BINS равных интервалов) или 'quantile' (BINS выборок с равным количеством частиц)
+    ## index - индекс по диаметрам (diameter_index.DiameterIndex) того же источника: выборки и средние берутся из его
+    ##         префиксных сумм без прохода по траекториям
+    ## chunk_size - обработка по частям для архивов больше памяти (нужен источник-хранилище .traj): первый проход по колонкам
+    ##         диаметров и ударов фиксирует границы, второй - пакетами по chunk_size частиц в накопители выборок (см. stream_bins)
+    ## compact - selections.json без отступов и пробелов (меньше и быстрее пишется); выборки пишутся в файл по одной (см. jsonstream.py)
 
-    bin_objects = histogram_D(data, bins_count=BINS, include_hitted=USE_HITTED_PARTICLES, include_NOT_hitted=USE_NOT_HITTED_PARTICLES)  # Группировка объектов по диаметрам
-    #гистрограмма распределения диаметров частиц будет сохранена в ./_RESULTS_PLOTS/histogram.png
+    print(f'Обработка файла {input_file}...')
 
-    stats_per_bin = get_bin_stats(bin_objects)
+    if data is None:
+        with telemetry.stage('load'):
+            source = store.open_source(input_file)
+    elif isinstance(data, store.TrajectoryStore):
+        source = data
+    else:
+        source = store.TrajectoryStore.from_data(data, input_file)
+    spf = source.description.get('spf', 0.04)  # секунд на кадр
+    speeds = {'method': speed_method, 'options': dict(speed_options or {}), 'spf': spf}
+
+    if index is not None and {k: index.speeds[k] for k in ('method', 'options')} != {k: speeds[k] for k in ('method', 'options')}:
+        raise ValueError(f'Индекс построен для скоростей {index.speeds}, а запрошены {speeds}')
+
+    with telemetry.stage('bin'):
+        if index is None and not chunk_size:
+            bin_rows = select_bins(source, bins_count=BINS, include_hitted=USE_HITTED_PARTICLES, include_NOT_hitted=USE_NOT_HITTED_PARTICLES,
+                                   histogram_file=histogram_file, edges=edges, mode=bin_mode)  # Группировка объектов по диаметрам
+            stats_per_bin = bin_stats(source, bin_rows)
+        elif index is None:
+            if edges is None or histogram_file:
+                diameters, counts = scan_diameters(source, USE_HITTED_PARTICLES, USE_NOT_HITTED_PARTICLES, chunk_size)
+                if edges is None:
+                    edges = weighted_edges(diameters, counts, BINS, bin_mode)
+                if histogram_file:
+                    with telemetry.stage('render'):
+                        render_histogram(diameters, edges, histogram_file, weights=counts)
+            with telemetry.stage('stream'):
+                bin_rows, stats_per_bin, dist_stats, speed_stats = stream_bins(
+                    source, edges, USE_HITTED_PARTICLES, USE_NOT_HITTED_PARTICLES, spf, speed_method, speed_options, chunk_size)
+        else:
+            if edges is None:
+                edges = index.edges(BINS, bin_mode, USE_HITTED_PARTICLES, USE_NOT_HITTED_PARTICLES)
+            bin_rows, stats_per_bin, dist_stats, speed_stats = index.select(edges, USE_HITTED_PARTICLES, USE_NOT_HITTED_PARTICLES)
+            if histogram_file:
+                with telemetry.stage('render'):
+                    render_histogram(np.asarray(source.diameter[np.sort(np.concatenate(bin_rows))], dtype=np.float64), edges,
+                                     histogram_file)
+    #гистрограмма распределения диаметров частиц будет сохранена в histogram_file (None - не строить)
     
     # Вычисление общего количества частиц
     allCount = sum(stats[3] for stats in stats_per_bin)
     print(f"Количество частиц для обработки: {allCount}")
+    telemetry.count('particles', allCount)
+    telemetry.count('bins', len(bin_rows))
 
     # Вывод статистики по каждой выборке
     for i, stats in enumerate(stats_per_bin):
         print(f"Bin {i+1}: ({stats[0]} - {stats[1]}), {stats[2]} | Count: {stats[3]}")
 
-    # Сохранение объектов в JSON файл
-    bin_data = []
-    for i, (bin_list, stats) in enumerate(zip(bin_objects, stats_per_bin)):
-
-        compute_particle_speeds(bin_list, dt=0.04)  # Вычисляем скорости для каждой частицы в бине
-
-        averaged_distances = average_distances_for_bin(bin_list)
-        average_speeds = average_speeds_for_bin(bin_list)
-
-    # Создание структуры с данными для каждой выборки
-        bin_entry = {
-        'header': {
-            'min_diameter': stats[0],
-            'max_diameter': stats[1],
-            'average_diameter': stats[2],
-            'particle_count': stats[3]
-        },
-        'averaged_distances': averaged_distances, # Усреднённые расстояния для каждого шага времени для этой выборки
-        'averaged_speeds': average_speeds,  # Усреднённые скорости для каждого шага времени для этой выборки
-        'particles': bin_list  # Список частиц для этой выборки
-        }
-        bin_data.append(bin_entry)
-
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(bin_data, f, ensure_ascii=False, indent=4)
+    with telemetry.stage('average'):
+        if index is None and not chunk_size:
+            all_distances, all_speeds = average_bins(source, bin_rows, dt=spf, method=speed_method, options=speed_options)  # Осреднение по всем выборкам за один проход
+            telemetry.count('samples', source.lengths[np.concatenate(bin_rows)].sum())
+        else:
+            all_distances, all_speeds = averaged_curves(dist_stats, speed_stats, spf)  # Из накопителей или префиксных сумм индекса
+
+    # Сохранение выборок в JSON файл
+    with telemetry.stage('write'), jsonstream.ArrayWriter(output_file, compact=compact) as writer:
+        for i, (rows, stats) in enumerate(zip(bin_rows, stats_per_bin)):
+
+            averaged_distances = all_distances[i]
+            average_speeds = all_speeds[i]
+
+        # Создание структуры с данными для каждой выборки
+            bin_entry = {
+            'header': {
+                'min_diameter': stats[0],
+                'max_diameter': stats[1],
+                'average_diameter': stats[2],
+                'particle_count': stats[3]
+            },
+            'averaged_distances': averaged_distances, # Усреднённые расстояния для каждого шага времени для этой выборки
+            'averaged_speeds': average_speeds,  # Усреднённые скорости для каждого шага времени для этой выборки
+            'source': input_file,  # Источник траекторий частиц (хранилище или JSON)
+            'particle_indices': rows.tolist(),  # Номера частиц этой выборки в источнике
+            'speeds': speeds  # Как из расстояний получены скорости (см. speed_settings)
+            }
+            writer.write(bin_entry)
 
     print(f'Выборки сохранены в {output_file}')
-    print(f'Гистограмма распределения диаметров частиц сохранена в ./_RESULTS_PLOTS/histogram.png')
+    if histogram_file:
+        print(f'Гистограмма распределения диаметров частиц сохранена в {histogram_file}')
     print("--"*20)
 
 if __name__ == "__main__":
@@ -1,5 +1,16 @@
+import array
+import bisect
+import codecs
+import contextlib
+import functools
+import glob
 import json
+import os
 import re
+from concurrent.futures import ProcessPoolExecutor
+import jsonstream
+import store
+import telemetry
 
 ##  to distance = [t, distance] from []
 def convert_distances(input_filename='particles.json', output_filename='particles_dist_clear.json'):
@@ -108,15 +119,359 @@ def cut_distances_by_hits_and_convert(input_json, hits, output_json):
     print(f'\033[92mГотово! Обрезаны траектории {changed_count} частиц с ударом, {not_changed_count} частиц потухли от удара. Данные сохранены в {output_json}\033[0m')
 
 
+def cut_particles_by_hits(data, hits):
+    """
+    Обрезает траектории частиц (distance - только расстояния) по времени удара в памяти.
+    Частица ищется по имени через словарь, граница обрезки - бинарным поиском по номеру кадра (см. cut_by_hit).
+    """
+    spf = data['description']['spf']
+    index = {}
+    for particle in data['particles']:
+        index.setdefault(particle['name'], particle)  # как и раньше, берётся первая частица с таким именем
+
+    changed_count = 0
+    not_changed_count = 0
+
+    for hit in hits:
+        particle = index.get(hit['particle'])
+        if particle is None:
+            continue
+        if cut_by_hit(particle, hit, spf):
+            changed_count += 1
+        else:
+            not_changed_count += 1
+
+    return changed_count, not_changed_count
+
+
+def cut_by_hit(particle, hit, spf):
+    """
+    Обрезает траекторию одной частицы по времени удара: остаются кадры i, для которых round(i * spf, 5) <= времени удара.
+    Возвращает True, если траектория стала короче (иначе частица потухла от удара).
+    """
+    hit_time = float(hit['hit'][0])
+    distances = particle['distance']
+    new_len = bisect.bisect_right(range(len(distances)), hit_time, key=lambda i: round(i * spf, 5))
+
+    particle['hit'] = True
+    if new_len != len(distances):
+        particle['distance'] = distances[:new_len]
+        return True
+    print(f'Частица {hit["particle"]} потухла от удара')
+    return False
+
+
+def preprocess(input_filename='particles.json', txt_filename='ВСЕ.txt', output_json_filename='particles_dist_final.json',
+               output_store_path='particles_dist_final.traj', debug_filename=None, compact=False):
+    """
+    Предобработка за один проход: частицы particles.json читаются по одной (см. jsonstream.py), обрезаются по ударам из txt
+    и сразу дописываются в итоговый JSON; для хранилища траекторий копятся только колонки.
+    debug_filename - если задан, дополнительно пишется отладочный файл с [t, distance] (как particles_dist_clear.json).
+    compact - JSON без отступов и пробелов (формат тот же).
+    Возвращает итоговые частицы как хранилище в памяти (store.TrajectoryStore).
+    """
+    with telemetry.stage('cut'):
+        hits = find_hits_from_txt(txt_filename) # находим удары из файла
+    telemetry.count('hits', len(hits))
+    hits_by_name = {}
+    for hit in hits:
+        hits_by_name.setdefault(hit['particle'], []).append(hit)
+
+    counts = {'changed': 0, 'not_changed': 0}
+    with contextlib.ExitStack() as files:
+        reader = files.enter_context(jsonstream.ArrayReader(input_filename, 'particles'))
+        description = reader.fields['description']
+        spf = description['spf']
+        writer = debug = None
+        if output_json_filename:
+            writer = files.enter_context(jsonstream.ArrayWriter(output_json_filename, 'particles', {'description': description}, compact))
+        if debug_filename:
+            debug = files.enter_context(jsonstream.ArrayWriter(debug_filename, 'particles', {'description': description}, compact))
+
+        def particles():
+            seen = set()
+            for particle in reader:
+                if debug is not None:
+                    debug.write(dict(particle, distance=[(round(i * spf, 5), d) for i, d in enumerate(particle['distance'])]))
+                if particle['name'] not in seen:  # как и раньше, удары относятся к первой частице с таким именем
+                    seen.add(particle['name'])
+                    for hit in hits_by_name.get(particle['name'], ()):
+                        counts['changed' if cut_by_hit(particle, hit, spf) else 'not_changed'] += 1
+                if writer is not None:
+                    writer.write(particle)
+                telemetry.count('particles')
+                yield particle
+
+        with telemetry.stage('stream'):
+            columns = store.particle_columns(particles(), description)
+
+    if output_store_path:
+        with telemetry.stage('write'):
+            store.write_columns(output_store_path, **columns)
+
+    print(f'\033[92mГотово! Обрезаны траектории {counts["changed"]} частиц с ударом, {counts["not_changed"]} частиц потухли от удара. '
+          f'Данные сохранены в {output_json_filename} и {output_store_path}\033[0m')
+    return store.TrajectoryStore.from_columns(path=output_store_path, **columns)
+
+
+## === Прямое чтение файлов опытов "Траектории частиц опыта rNN final.txt" ===
+## Отличия от particles_dist_final.json (получен вручную через ВСЕ.txt), проверено на r4-r36:
+##   r7_Частица №1 в ВСЕ.txt - это r9_Частица №1 (файла r7 нет); r15_Частица №7 и r22_Частица №6 в ВСЕ.txt не попали;
+##   r20_Частица №5 пропущена (нет кадра 11.08 с), в ВСЕ.txt строки взяты подряд;
+##   r35_Частица №1 и №6 - повтор времени, более поздняя строка заменяет кадр (в ВСЕ.txt обе строки подряд, на кадр длиннее);
+##   r22_Частица №2 - возврат времени 12.44 -> 12.32, кадры заменены следующими строками (длина совпадает с ВСЕ.txt);
+##   r11 №4, r18 №6, r22 №2, r28 №1, r31 №10 - в ВСЕ.txt часть расстояний исправлена вручную, здесь - как в файлах опытов;
+##   r36 №1 и №2 - "Диаметр: 467 или 501", берётся первый (в ВСЕ.txt у №2 выбран 501);
+##   r5_Частица №3 - диаметр записан в строке времени горения ("581 1.52"), берётся оттуда, как и в ВСЕ.txt.
+
+EXPERIMENT_FILES_PATTERN = 'Траектории частиц опыта r* final.txt'
+
+_experiment_re = re.compile(r'^\s*Опыт\s+(\S+)', re.IGNORECASE)
+_scale_re = re.compile(r'^\s*Масштаб:?\s*([\d.,]+)', re.IGNORECASE)
+_particle_re = re.compile(r'^\s*_+\s*(Частица\s*№\s*\d+)\s*_+', re.IGNORECASE)
+_burn_time_re = re.compile(r'^\s*Время горения:?\s*(?:(\d+)\s+)?([\d.,]+)', re.IGNORECASE)  # "581 1.52" - диаметр не в той строке
+_diameter_re = re.compile(r'^\s*Диаметр:?\s*(\d*)(?:\s*или\s*(\d+))?', re.IGNORECASE)  # "467 или 501" - берётся первый
+_row_re = re.compile(r'^\s*(\d+[.,]\d+)\s+(\d+(?:[.,]\d+)?)(.*)$')
+
+
+def _to_float(value):
+    return float(value.replace(',', '.'))
+
+
+def detect_encoding(filename, sample_size=64 * 1024):
+    """
+    Определяет кодировку файла опыта по началу файла: utf-8 (в т.ч. с BOM) или cp1251.
+    """
+    with open(filename, 'rb') as f:
+        sample = f.read(sample_size)
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'cp1251'
+
+
+def infer_spf(steps):
+    """
+    Секунд на кадр - медиана шагов времени между соседними строками таблиц (пропуски и возвраты на неё не влияют).
+    """
+    steps = sorted(step for step in steps if step > 0)
+    if not steps:
+        return None
+    return round(steps[len(steps) // 2] if len(steps) % 2 else (steps[len(steps) // 2 - 1] + steps[len(steps) // 2]) / 2, 5)
+
+
+def _place_samples(current, spf, warnings):
+    """
+    Расстояния частицы по кадрам: строка со временем t идёт в кадр round((t - t_first) / spf).
+    Повтор или возврат времени - более поздние строки заменяют записанные кадры (с предупреждением),
+    пропуск кадров - частица не берётся (None), т.к. distance - одно значение на каждый кадр.
+    """
+    times, values = current['times'], current['values']
+    distance = array.array('d')
+    for t, value in zip(times, values):
+        frame = round((t - times[0]) / spf)
+        if frame < len(distance):
+            warnings.append(f'{current["name"]}: время {t:g} с после {times[len(distance) - 1]:g} с (повтор или возврат), '
+                            f'кадры с {frame} заменены следующими строками')
+            del distance[frame:]
+        elif frame > len(distance):
+            warnings.append(f'{current["name"]}: пропущены кадры между {times[0] + (len(distance) - 1) * spf:g} и {t:g} с, частица пропущена')
+            return None
+        distance.append(value)
+    return distance
+
+
+def _finish_particle(current, particles, spf, warnings):
+    if current is None or not current['values'] or current['diameter'] is None:
+        return 0  # частица без траектории или без диаметра в обработку не идёт
+    distance = _place_samples(current, spf, warnings)
+    if distance is None:
+        return 0
+    particle = {
+        'name': current['name'],
+        'burn_time': current['burn_time'],
+        'diameter': current['diameter'],
+        'first_time': current['times'][0],  # время первого появления от начала съёмки (с)
+        'distance': distance,
+    }
+    if current['hit']:
+        particle['hit'] = True
+    particles.append(particle)
+    return 1
+
+
+def parse_experiment_file(filename, spf=None):
+    """
+    Построчно читает файл опыта и возвращает частицы в формате particles_dist_final.json:
+    траектория начинается с первого появления (first_time) и обрезана по первому удару о поддон,
+    расстояния расставлены по кадрам по столбцу времени (см. _place_samples).
+    distance - array('d') (8 байт на точку вместо float-объекта и указателя в списке), store.data_columns принимает его как список.
+    spf - секунд на кадр, None - по медиане шага времени в файле (см. infer_spf).
+    Возвращает словарь {'experiment', 'scale', 'file', 'spf', 'particles', 'skipped', 'warnings'}.
+    """
+    encoding = detect_encoding(filename)
+    experiment = None
+    scale = None
+    raw = []  # частицы со строками таблиц (время, расстояние) до расстановки по кадрам
+    steps = []
+    warnings = []
+    current = None
+
+    with open(filename, 'r', encoding=encoding) as f:
+        for line in f:
+            match = _particle_re.match(line)
+            if match:
+                if experiment is None:
+                    found = re.search(r'(r\d+)', os.path.basename(filename))
+                    experiment = found.group(1) if found else os.path.basename(filename)
+                particle_name = re.sub(r'\s+', ' ', match.group(1))
+                current = {
+                    'name': f'{experiment}_{particle_name}',
+                    'burn_time': None,
+                    'diameter': None,
+                    'misplaced_diameter': None,
+                    'times': array.array('d'),
+                    'values': array.array('d'),
+                    'hit': False,
+                    'cut': False,
+                    'last_time': None,
+                }
+                raw.append(current)
+                continue
+
+            if current is None:
+                match = _experiment_re.match(line)
+                if match:
+                    experiment = match.group(1)
+                    continue
+                match = _scale_re.match(line)
+                if match:
+                    scale = _to_float(match.group(1))
+                continue
+
+            match = _row_re.match(line)
+            if match:
+                t = _to_float(match.group(1))
+                if current['last_time'] is not None:
+                    steps.append(round(t - current['last_time'], 5))  # шаги всех строк таблицы - для spf
+                current['last_time'] = t
+                if current['cut']:
+                    continue  # после удара о поддон (или конца таблицы) траектория не нужна
+                current['times'].append(t)
+                current['values'].append(_to_float(match.group(2)))
+                comment = match.group(3).lower()
+                if '(удар о поддон)' in comment or '(удар о поддон, отскочила)' in comment:
+                    current['hit'] = True
+                    current['cut'] = True
+                continue
+
+            current['last_time'] = None
+            if current['values']:
+                current['cut'] = True  # таблица частицы закончилась (пустая строка или посторонний текст)
+                continue
+
+            match = _burn_time_re.match(line)
+            if match:
+                current['burn_time'] = _to_float(match.group(2))
+                current['misplaced_diameter'] = int(match.group(1)) if match.group(1) else None
+                continue
+            match = _diameter_re.match(line)
+            if match:
+                current['diameter'] = int(match.group(1)) if match.group(1) else None
+                if match.group(2):
+                    warnings.append(f'{current["name"]}: два диаметра ({match.group(1)} или {match.group(2)}), взят {match.group(1)}')
+                if current['diameter'] is None and current['misplaced_diameter'] is not None:
+                    current['diameter'] = current['misplaced_diameter']
+                    warnings.append(f'{current["name"]}: диаметр {current["diameter"]} взят из строки времени горения')
+
+    if spf is None:
+        spf = infer_spf(steps) or 0.04  # в файле нет ни одного шага времени - прежнее значение
+    particles = []
+    skipped = sum(1 - _finish_particle(current, particles, spf, warnings) for current in raw)
+
+    return {
+        'experiment': experiment,
+        'scale': scale,
+        'file': os.path.basename(filename),
+        'spf': spf,
+        'particles': particles,
+        'skipped': skipped,
+        'warnings': warnings,
+    }
+
+
+def print_warnings(experiment):
+    for warning in experiment['warnings']:
+        print(f'\033[93m{experiment["file"]}: {warning}\033[0m')
+
+
+def ingest_experiments(pattern=EXPERIMENT_FILES_PATTERN, spf=None, workers=None):
+    """
+    Читает все файлы опытов параллельно (один опыт на процесс) и собирает данные
+    в формате particles_dist_final.json.
+    spf - секунд на кадр, None - по шагу времени в файлах (у всех файлов он должен совпадать).
+    """
+    filenames = sorted(glob.glob(pattern), key=lambda name: [int(x) if x.isdigit() else x for x in re.split(r'(\d+)', name)])
+
+    with telemetry.stage('parse'), ProcessPoolExecutor(max_workers=workers) as executor:
+        experiments = list(executor.map(functools.partial(parse_experiment_file, spf=spf), filenames))
+    telemetry.count('files', len(filenames))
+
+    spfs = {e['spf'] for e in experiments}
+    if len(spfs) > 1:
+        raise ValueError('Шаг времени в файлах опытов различается: ' + ', '.join(f'{e["file"]}: {e["spf"]}' for e in experiments))
+    spf = spfs.pop() if spfs else (spf or 0.04)
+    for e in experiments:
+        print_warnings(e)
+
+    data = {
+        'description': {
+            'spf': spf,
+            'fps': round(1 / spf),
+            'experiments': [
+                {'experiment': e['experiment'], 'scale': e['scale'], 'file': e['file'], 'particles': len(e['particles'])}
+                for e in experiments
+            ],
+        },
+        'particles': [p for e in experiments for p in e['particles']],
+    }
+
+    hits_count = sum(1 for p in data['particles'] if p.get('hit'))
+    telemetry.count('particles', len(data['particles']))
+    skipped = sum(e['skipped'] for e in experiments)
+    print(f'\033[92mПрочитано {len(filenames)} опытов: {len(data["particles"])} частиц, из них {hits_count} с ударом о поддон, '
+          f'{skipped} частиц пропущено (нет диаметра или траектории, пропуски кадров)\033[0m')
+    return data
+
+
+def main_from_experiments(pattern=EXPERIMENT_FILES_PATTERN, output_json_filename='particles_dist_final.json',
+                          output_store_path='particles_dist_final.traj', workers=None, compact=False):
+    """
+    То же, что main(), но данные берутся прямо из файлов опытов, без ВСЕ.txt и particles.json.
+    compact - JSON без отступов и пробелов (формат тот же).
+    """
+    data = ingest_experiments(pattern, workers=workers)
+
+    with telemetry.stage('write'):
+        if output_json_filename:
+            jsonstream.write_particles(output_json_filename, data['description'], data['particles'], compact, default=store.json_default)
+        store.write_store(data, output_store_path)
+    print(f'Данные сохранены в {output_store_path}')
+
+
 def main():
     txt_filename = "ВСЕ.txt"
     particles_json_filename = "particles_dist_clear.json" ## это файл с расстояниями и временем как particle.json только другой формат distance
     output_json_filename = "particles_dist_final.json" ## это образанный файл с расстояниями и временем как particle.json
+    output_store_path = "particles_dist_final.traj" ## то же самое в бинарном хранилище (см. store.py), его читает handler
 
-    convert_distances('particles.json', particles_json_filename) # конвертируем в [t, distance]
-    hits = find_hits_from_txt(txt_filename) # находим удары из файла
-    cut_distances_by_hits_and_convert(particles_json_filename, hits, output_json_filename) # обрезаем по времени удара и сохраняем в новый файл
-    convert_distances_to_short(output_json_filename, output_json_filename) # конвертируем обратно в distance только
+    ## Раньше: convert_distances -> cut_distances_by_hits_and_convert -> convert_distances_to_short (4 чтения/записи JSON)
+    ## отладочный particles_dist_clear.json больше не пишется по умолчанию: debug_filename=particles_json_filename
+    preprocess('particles.json', txt_filename, output_json_filename, output_store_path,
+               debug_filename=None) # обрезаем по времени удара и сохраняем один раз
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,305 @@
+## Инкрементальная обработка: новый файл опыта добавляется (или убирается) без пересчёта всего архива
+## Границы выборок по диаметру закреплены при создании состояния, у каждой выборки - накопители по кадрам
+## (сумма, количество, сумма квадратов) для расстояний и скоростей и счётчики диаметров частиц.
+## Добавление или удаление опыта меняет накопители только его выборок и помечает их "грязными",
+## update() пишет selections.json из накопителей и пересчитывает в solver только грязные выборки.
+## Папка состояния:
+##   state.json        - границы, фильтр по ударам, метод скоростей, опыты и номера их частиц по выборкам, результаты выборок
+##   accumulators.npz  - накопители (выборки, кадры)
+##   experiments/      - траектории каждого опыта в своём хранилище (store.py), на них ссылаются выборки (см. handler.bin_source)
+## Средние совпадают с полным пересчётом handler.main с теми же границами до округления (суммы складываются в другом порядке)
+import glob
+import json
+import os
+import shutil
+import numpy as np
+import differentiation
+import handler
+import helpers
+import solver
+import store
+import telemetry
+
+STATE_VERSION = 1
+STATE_FILE = 'state.json'
+ACCUMULATORS_FILE = 'accumulators.npz'
+EXPERIMENTS_DIR = 'experiments'
+ACCUMULATORS = ('distance_sum', 'distance_count', 'distance_sum_sq', 'speed_sum', 'speed_count', 'speed_sum_sq')
+
+
+def edges_from_source(source, bins_count=10, include_hitted=True, include_NOT_hitted=True):
+    """
+    Границы bins_count равных интервалов по диаметрам частиц источника (как у handler.select_bins) - для закрепления.
+    """
+    hitted = np.asarray(source.hit) == 1
+    selected = (hitted & include_hitted) | (~hitted & include_NOT_hitted)
+    edges, _ = handler.bin_diameters(np.asarray(source.diameter[selected], dtype=np.float64), bins_count)
+    return edges.tolist()
+
+
+def create(state_dir, edges, include_hitted=True, include_NOT_hitted=True, spf=0.04,
+           speed_method=differentiation.DEFAULT_METHOD, speed_options=None):
+    """
+    Новое пустое состояние с закреплёнными границами выборок edges (мкм).
+    """
+    if os.path.exists(os.path.join(state_dir, STATE_FILE)):
+        raise FileExistsError(f'Состояние уже существует: {state_dir}')
+    os.makedirs(os.path.join(state_dir, EXPERIMENTS_DIR), exist_ok=True)
+    n_bins = len(edges) - 1
+    state = {
+        'version': STATE_VERSION,
+        'edges': [float(e) for e in edges],
+        'hitted': include_hitted,
+        'not_hitted': include_NOT_hitted,
+        'speeds': {'method': speed_method, 'options': dict(speed_options or {}), 'spf': spf},
+        'experiments': {},  # опыт -> {'file', 'source', 'bins': номера частиц опыта по выборкам}
+        'diameters': [[] for _ in range(n_bins)],  # пары [диаметр, количество частиц] по выборкам
+        'dirty': list(range(n_bins)),
+        'solver': None,  # параметры, с которыми посчитаны results
+        'results': [None] * n_bins,  # запись results.json каждой выборки (None - выборка пустая)
+    }
+    accumulators = {name: np.zeros((n_bins, 0)) for name in ACCUMULATORS}
+    _save(state_dir, state, accumulators)
+    return state
+
+
+def _load(state_dir):
+    with open(os.path.join(state_dir, STATE_FILE), 'r', encoding='utf-8') as f:
+        state = json.load(f)
+    if state.get('version') != STATE_VERSION:
+        raise ValueError(f'Неподдерживаемая версия состояния {state.get("version")} в {state_dir}')
+    with np.load(os.path.join(state_dir, ACCUMULATORS_FILE)) as npz:
+        accumulators = {name: npz[name] for name in ACCUMULATORS}
+    return state, accumulators
+
+
+def _save(state_dir, state, accumulators):
+    # Сначала во временные файлы, затем замена - прерванная запись не портит состояние
+    np.savez(os.path.join(state_dir, 'accumulators.tmp.npz'), **accumulators)
+    with open(os.path.join(state_dir, STATE_FILE + '.tmp'), 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=4)
+    os.replace(os.path.join(state_dir, 'accumulators.tmp.npz'), os.path.join(state_dir, ACCUMULATORS_FILE))
+    os.replace(os.path.join(state_dir, STATE_FILE + '.tmp'), os.path.join(state_dir, STATE_FILE))
+
+
+def _contribution(state, source):
+    """
+    Вклад частиц источника в выборки: номера частиц по выборкам, накопители (выборки, кадры) и диаметры по выборкам.
+    """
+    bin_rows = handler.select_bins(source, include_hitted=state['hitted'], include_NOT_hitted=state['not_hitted'],
+                                   histogram_file=None, edges=state['edges'])
+    rows = np.concatenate(bin_rows)
+    groups = np.repeat(np.arange(len(bin_rows)), [len(r) for r in bin_rows])
+    settings = state['speeds']
+
+    distances, offsets = source.gather(rows)
+    dist_stats = handler.ragged_step_stats(distances, offsets, groups, len(bin_rows))
+    speeds, offsets = handler.particle_speeds(source, rows, settings['spf'], settings['method'], settings['options'])
+    speed_stats = handler.ragged_step_stats(speeds, offsets, groups, len(bin_rows))
+
+    accumulators = {}
+    for prefix, stats in (('distance', dist_stats), ('speed', speed_stats)):
+        accumulators[prefix + '_sum'] = stats['sum']
+        accumulators[prefix + '_count'] = stats['count'].astype(np.float64)
+        accumulators[prefix + '_sum_sq'] = stats['sum_sq']
+    diameters = [source.diameter[r].tolist() for r in bin_rows]
+    return bin_rows, accumulators, diameters
+
+
+def _apply(state, accumulators, contribution, sign):
+    """
+    Прибавляет (sign=1) или вычитает (sign=-1) вклад опыта, помечает затронутые выборки грязными.
+    """
+    bin_rows, delta, diameters = contribution
+    for name in ACCUMULATORS:
+        current, change = accumulators[name], delta[name]
+        n_frames = max(current.shape[1], change.shape[1])
+        total = np.zeros((len(current), n_frames))
+        total[:, :current.shape[1]] += current
+        total[:, :change.shape[1]] += sign * change
+        accumulators[name] = total
+
+    # Где частиц не осталось - точные нули, а не остатки округления после вычитания
+    for prefix in ('distance', 'speed'):
+        empty = accumulators[prefix + '_count'] <= 0
+        for name in (prefix + '_sum', prefix + '_count', prefix + '_sum_sq'):
+            accumulators[name][empty] = 0.0
+
+    for i, values in enumerate(diameters):
+        if not values:
+            continue
+        counts = {d: c for d, c in state['diameters'][i]}
+        for d in values:
+            counts[d] = counts.get(d, 0) + sign
+        state['diameters'][i] = sorted([d, c] for d, c in counts.items() if c > 0)
+        if i not in state['dirty']:
+            state['dirty'].append(i)
+    state['dirty'].sort()
+    telemetry.count('dirty_bins', sum(1 for values in diameters if values))
+
+
+def add_experiment(state_dir, filename):
+    """
+    Добавляет файл опыта "Траектории частиц опыта rNN final.txt" (уже добавленный опыт заменяется).
+    Возвращает номера выборок, которые нужно пересчитать.
+    """
+    with telemetry.stage('parse'):
+        experiment = helpers.parse_experiment_file(filename)
+    helpers.print_warnings(experiment)
+    return add_data(state_dir, experiment['experiment'], experiment['particles'], experiment['file'], experiment['scale'],
+                    experiment['spf'])
+
+
+def add_data(state_dir, name, particles, file=None, scale=None, spf=None):
+    """
+    Добавляет опыт name из частиц в формате particles_dist_final.json (уже добавленный опыт заменяется).
+    spf - шаг времени опыта, если известен: должен совпадать с шагом обработки.
+    Возвращает номера выборок, которые нужно пересчитать.
+    """
+    state, accumulators = _load(state_dir)
+    if spf is not None and spf != state['speeds']['spf']:
+        raise ValueError(f'Шаг времени опыта {name} ({spf} с) не совпадает с шагом обработки ({state["speeds"]["spf"]} с)')
+    if name in state['experiments']:
+        _retract(state, accumulators, name)
+
+    spf = state['speeds']['spf']
+    data = {
+        'description': {
+            'spf': spf,
+            'fps': round(1 / spf),
+            'experiments': [{'experiment': name, 'scale': scale, 'file': file, 'particles': len(particles)}],
+        },
+        'particles': particles,
+    }
+    path = os.path.join(state_dir, EXPERIMENTS_DIR, f'{name}.traj')
+    with telemetry.stage('write'):
+        store.write_store(data, path)
+
+    with telemetry.stage('accumulate'):
+        contribution = _contribution(state, store.open_source(path))
+        _apply(state, accumulators, contribution, 1)
+    state['experiments'][name] = {'file': file, 'source': path, 'bins': [rows.tolist() for rows in contribution[0]]}
+    telemetry.count('particles', len(particles))
+    _save(state_dir, state, accumulators)
+    print(f'\033[92mОпыт {name} добавлен: {len(particles)} частиц, '
+          f'к пересчёту выборок: {len(state["dirty"])}\033[0m')
+    return list(state['dirty'])
+
+
+def _retract(state, accumulators, name):
+    path = state['experiments'][name]['source']
+    with telemetry.stage('accumulate'):
+        _apply(state, accumulators, _contribution(state, store.open_source(path)), -1)
+    del state['experiments'][name]
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def retract_experiment(state_dir, name):
+    """
+    Убирает опыт name (например 'r12') из накопителей. Возвращает номера выборок, которые нужно пересчитать.
+    """
+    state, accumulators = _load(state_dir)
+    if name not in state['experiments']:
+        raise KeyError(f'Опыт {name} не добавлен в {state_dir}')
+    _retract(state, accumulators, name)
+    _save(state_dir, state, accumulators)
+    print(f'\033[92mОпыт {name} убран, к пересчёту выборок: {len(state["dirty"])}\033[0m')
+    return list(state['dirty'])
+
+
+def _bin_entries(state, accumulators):
+    """
+    Выборки в формате selections.json из накопителей (без чтения траекторий).
+    """
+    dist_stats = {'sum': accumulators['distance_sum'], 'count': accumulators['distance_count']}
+    speed_stats = {'sum': accumulators['speed_sum'], 'count': accumulators['speed_count']}
+    all_distances, all_speeds = handler.averaged_curves(dist_stats, speed_stats, state['speeds']['spf'])
+
+    entries = []
+    for i, pairs in enumerate(state['diameters']):
+        count = sum(c for _, c in pairs)
+        header = {'min_diameter': None, 'max_diameter': None, 'average_diameter': None, 'particle_count': 0}
+        if count:
+            header = {
+                'min_diameter': pairs[0][0],
+                'max_diameter': pairs[-1][0],
+                'average_diameter': round(sum(d * c for d, c in pairs) / count, 2),
+                'particle_count': count,
+            }
+        entries.append({
+            'header': header,
+            'averaged_distances': all_distances[i],
+            'averaged_speeds': all_speeds[i],
+            'sources': [{'source': experiment['source'], 'particle_indices': experiment['bins'][i]}
+                        for experiment in state['experiments'].values() if experiment['bins'][i]],
+            'speeds': state['speeds'],
+        })
+    return entries
+
+
+def spread(state_dir):
+    """
+    Среднеквадратичный разброс расстояний и скоростей по частицам каждой выборки на каждом кадре (выборки, кадры).
+    """
+    _, accumulators = _load(state_dir)
+    result = {}
+    for prefix in ('distance', 'speed'):
+        count = accumulators[prefix + '_count']
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = accumulators[prefix + '_sum'] / count
+            result[prefix] = np.sqrt(np.maximum(accumulators[prefix + '_sum_sq'] / count - mean * mean, 0.0))
+    return result
+
+
+def update(state_dir, selections_file='selections.json', results_file='results.json', dt_poly=0.001, bootstrap_replicates=0,
+           per_particle=False, inverse_fit=None):
+    """
+    Пишет selections.json из накопителей и results.json, пересчитывая в solver только грязные выборки
+    (все - если изменились параметры решателя). Возвращает номера пересчитанных выборок.
+    """
+    state, accumulators = _load(state_dir)
+    entries = _bin_entries(state, accumulators)
+    with telemetry.stage('write'), open(selections_file, 'w', encoding='utf-8') as f:
+        json.dump(entries, f, ensure_ascii=False, indent=4)
+
+    params = {'dt_poly': dt_poly, 'bootstrap': bootstrap_replicates, 'per_particle': per_particle, 'inverse_fit': inverse_fit,
+              'constants': [solver.ro, solver.ro_g, solver.mu, solver.g]}
+    dirty = list(range(len(entries))) if state['solver'] != params else list(state['dirty'])
+
+    with telemetry.stage('solve'):
+        solved = [i for i in dirty if entries[i]['header']['average_diameter'] is not None]
+        results = []
+        if solved:
+            results, _ = solver.result_entries([entries[i] for i in solved], dt_poly, bootstrap_replicates,
+                                               per_particle=per_particle, inverse_fit=inverse_fit)
+    for i in dirty:
+        state['results'][i] = None
+    for i, result in zip(solved, results):
+        state['results'][i] = result
+    telemetry.count('bins', len(solved))
+
+    with telemetry.stage('write'), open(results_file, 'w', encoding='utf-8') as f:
+        json.dump([result for result in state['results'] if result is not None], f, ensure_ascii=False, indent=4)
+
+    state['dirty'] = []
+    state['solver'] = params
+    _save(state_dir, state, accumulators)
+    print(f'\033[92mПересчитано выборок: {len(solved)} из {len(entries)}, результаты сохранены в {results_file}\033[0m')
+    return solved
+
+
+def main(state_dir='_INCREMENTAL', pattern=helpers.EXPERIMENT_FILES_PATTERN, bins=10):
+    ## Первый запуск: границы закрепляются по текущему архиву; дальше добавляются только новые опыты
+    if not os.path.exists(os.path.join(state_dir, STATE_FILE)):
+        create(state_dir, edges_from_source(store.open_source('particles_dist_final.traj'), bins, False, True),
+               include_hitted=False, include_NOT_hitted=True)
+    state, _ = _load(state_dir)
+    known = {experiment['file'] for experiment in state['experiments'].values()}
+    for filename in sorted(glob.glob(pattern)):
+        if os.path.basename(filename) not in known:
+            add_experiment(state_dir, filename)
+    update(state_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+## Обратная задача: Cd подбирается так, чтобы решение уравнения движения совпало с измеренными расстояниями
+##   m du/dt = m g - 1/2 Cd ro_g S u|u|,  dx/dt = u
+## без дифференцирования зашумлённых расстояний. Закон здесь квадратичный, а в solver.py - линейный (½ Cd ro_g S u),
+## поэтому этот Cd - другая величина, чем avgCd решателя, и в таблицах подписан отдельно (u²).
+## Законы сопротивления: 'constant' - Cd = const, 'inverse_re' - Cd = A / Re.
+## Неизвестные каждой кривой: параметр закона p (Cd или A, подбирается log p - остаётся положительным),
+## начальные расстояние x0 и скорость u0.
+## Все кривые (выборки, частицы, стартовые кандидаты) интегрируются одним пакетным РК4 вместе с уравнениями
+## чувствительности (аналитический якобиан), параметры уточняются пакетным методом Левенберга-Марквардта
+import warnings
+import numpy as np
+import handler
+import solver
+
+LAWS = ('constant', 'inverse_re')
+CANDIDATES = {'constant': np.logspace(-0.5, 2.5, 13), 'inverse_re': np.logspace(0, 3, 13)}  # стартовые значения p
+SUBSTEPS = 4  # шагов РК4 на кадр
+
+
+def _rhs(u, logp, c, D, law):
+    """
+    du/dt и её производные по u и по log p. c = ro_g S / (2 m).
+    """
+    if law == 'constant':
+        k = c * np.exp(logp)  # Cd = p
+        f = solver.g - k * u * np.abs(u)
+        return f, -2 * k * np.abs(u), -k * u * np.abs(u)
+    if law == 'inverse_re':
+        k = c * np.exp(logp) * solver.mu / (solver.ro_g * D)  # Cd = A / Re = A mu / (ro_g |u| D), сила линейна по u
+        return solver.g - k * u, -k, -k * u
+    raise ValueError(f'Неизвестный закон сопротивления: {law}')
+
+
+def integrate(params, c, D, n_frames, spf=0.04, law='constant', sensitivities=True):
+    """
+    Пакетное интегрирование РК4 для всех строк params (n, 3) = [log p, x0, u0] (м, м/с).
+    Возвращает x, u (n, n_frames) в кадрах t = j * spf и, если sensitivities, dx/dparams (n, n_frames, 3).
+    """
+    n = len(params)
+    logp = params[:, 0]
+    x = params[:, 1].copy()
+    u = params[:, 2].copy()
+    sx = np.zeros((n, 3))
+    su = np.zeros((n, 3))
+    sx[:, 1] = 1.0
+    su[:, 2] = 1.0
+
+    def derivatives(u, su):
+        f, df_du, df_dlogp = _rhs(u, logp, c, D, law)
+        dsu = df_du[:, None] * su
+        dsu[:, 0] += df_dlogp
+        return f, dsu
+
+    xs = np.empty((n, n_frames))
+    us = np.empty((n, n_frames))
+    jac = np.empty((n, n_frames, 3)) if sensitivities else None
+    h = spf / SUBSTEPS
+    with np.errstate(over='ignore', invalid='ignore'):  # неудачные кандидаты (жёсткие или расходящиеся) дают inf/nan и отбрасываются
+        for frame in range(n_frames):
+            xs[:, frame] = x
+            us[:, frame] = u
+            if sensitivities:
+                jac[:, frame] = sx
+            if frame == n_frames - 1:
+                break
+            for _ in range(SUBSTEPS):
+                if sensitivities:
+                    a1, b1 = derivatives(u, su)
+                    a2, b2 = derivatives(u + h / 2 * a1, su + h / 2 * b1)
+                    a3, b3 = derivatives(u + h / 2 * a2, su + h / 2 * b2)
+                    a4, b4 = derivatives(u + h * a3, su + h * b3)
+                    sx = sx + h / 6 * (su + 2 * (su + h / 2 * b1) + 2 * (su + h / 2 * b2) + (su + h * b3))
+                    su = su + h / 6 * (b1 + 2 * b2 + 2 * b3 + b4)
+                else:
+                    a1 = _rhs(u, logp, c, D, law)[0]
+                    a2 = _rhs(u + h / 2 * a1, logp, c, D, law)[0]
+                    a3 = _rhs(u + h / 2 * a2, logp, c, D, law)[0]
+                    a4 = _rhs(u + h * a3, logp, c, D, law)[0]
+                x = x + h / 6 * (u + 2 * (u + h / 2 * a1) + 2 * (u + h / 2 * a2) + (u + h * a3))
+                u = u + h / 6 * (a1 + 2 * a2 + 2 * a3 + a4)
+    return xs, us, jac
+
+
+def _sse(x, distances, mask):
+    r = np.where(mask, x - distances, 0.0)
+    return (r * r).sum(axis=1)
+
+
+def fit_curves(distances, mask, D, law='constant', spf=0.04, max_iter=100, rtol=1e-10):
+    """
+    Подбор [log p, x0, u0] для каждой строки distances (n, L) в метрах (кадр j - время j * spf), mask - измеренные точки.
+    D - диаметры (n,) в метрах. Старт - лучший из кандидатов CANDIDATES (все строки x кандидаты одним интегрированием),
+    дальше пакетный Левенберг-Марквардт. Возвращает словарь массивов (n,).
+    """
+    D = np.asarray(D, dtype=np.float64)
+    if len(D) == 0:  # пустая выборка - пустые массивы (argmax по пустой маске невозможен)
+        result = {key: np.zeros(0) for key in ('param', 'x0', 'u0', 'Cd', 'A', 'rmse')}
+        result.update(iterations=np.zeros(0, dtype=np.int64), converged=np.zeros(0, dtype=bool))
+        return result
+    n, n_frames = distances.shape
+    m = solver.ro * np.pi / 6 * D**3
+    S = np.pi * D**2 / 4
+    c = solver.ro_g * S / (2 * m)
+
+    # Начальные x0, u0 - по первым двум измеренным точкам
+    counts = mask.sum(axis=1)
+    fitted = counts > 3
+    first = np.argmax(mask, axis=1)
+    second = np.argmax(mask & (np.arange(n_frames) > first[:, None]), axis=1)
+    rows = np.arange(n)
+    x0 = distances[rows, first]
+    u0 = np.where(second > first, (distances[rows, second] - x0) / ((second - first) * spf), 0.0)
+    x0 = x0 - u0 * first * spf  # к кадру 0
+
+    # Лучший стартовый кандидат p для каждой строки
+    candidates = np.log(CANDIDATES[law])
+    k = len(candidates)
+    trial = np.column_stack([np.tile(candidates, n), np.repeat(x0, k), np.repeat(u0, k)])
+    x, _, _ = integrate(trial, np.repeat(c, k), np.repeat(D, k), n_frames, spf, law, sensitivities=False)
+    sse = _sse(x, np.repeat(distances, k, axis=0), np.repeat(mask, k, axis=0)).reshape(n, k)
+    sse[np.isnan(sse)] = np.inf
+    params = np.column_stack([candidates[np.argmin(sse, axis=1)], x0, u0])
+
+    lam = np.full(n, 1e-3)
+    converged = ~fitted
+    iterations = np.zeros(n, dtype=np.int64)
+    for _ in range(max_iter):
+        if converged.all():
+            break
+        x, _, jac = integrate(params, c, D, n_frames, spf, law)
+        r = np.where(mask, x - distances, 0.0)
+        jac = jac * mask[..., None]
+        sse = (r * r).sum(axis=1)
+
+        jtj = np.einsum('nlp,nlq->npq', jac, jac)
+        grad = np.einsum('nlp,nl->np', jac, r)
+        damping = lam[:, None] * np.einsum('npp->np', jtj) + 1e-30
+        lhs = jtj + damping[:, :, None] * np.eye(3)
+        lhs[converged] = np.eye(3)  # закончившие строки не шагают
+        grad[converged] = 0.0
+        step = np.linalg.solve(lhs, -grad[..., None])[..., 0]
+
+        trial = params + step
+        trial[:, 0] = np.clip(trial[:, 0], -20, 20)
+        x_trial, _, _ = integrate(trial, c, D, n_frames, spf, law, sensitivities=False)
+        sse_trial = _sse(x_trial, distances, mask)
+
+        better = (sse_trial < sse) & ~converged
+        params[better] = trial[better]
+        iterations[~converged] += 1
+        lam = np.where(better, np.maximum(lam / 3, 1e-12), lam * 10)
+        converged |= (better & (sse - sse_trial <= rtol * sse)) | (lam > 1e12) | (sse <= 1e-30)
+
+    x, u, _ = integrate(params, c, D, n_frames, spf, law, sensitivities=False)
+    u_safe = np.where(np.abs(u) > 0, u, np.nan)
+    Re = solver.ro_g * np.abs(u_safe) * D[:, None] / solver.mu
+    if law == 'constant':
+        Cd = np.broadcast_to(np.exp(params[:, :1]), u.shape)
+    else:
+        Cd = np.exp(params[:, :1]) / Re
+    Cd = np.where(mask, Cd, np.nan)
+    Re = np.where(mask, Re, np.nan)
+
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # у кривых без точек среднее - nan
+        result = {
+            'param': np.exp(params[:, 0]),
+            'x0': params[:, 1] * 1e2,  # см
+            'u0': params[:, 2] * 1e2,  # см/с
+            'Cd': np.nanmean(Cd, axis=1),  # среднее по времени вдоль подобранной траектории
+            'A': np.nanmean(Re * Cd, axis=1),
+            'rmse': np.sqrt(_sse(x, distances, mask) / np.maximum(counts, 1)) * 1e2,  # см
+            'iterations': iterations,
+            'converged': converged & fitted,
+        }
+    for key in ('param', 'x0', 'u0', 'Cd', 'A', 'rmse'):
+        result[key] = np.where(fitted, result[key], np.nan)
+    return result
+
+
+def _padded(curves):
+    """
+    Список кривых расстояний (см) -> расстояния (n, L) в метрах и маска.
+    """
+    lengths = np.array([len(curve) for curve in curves], dtype=np.int64)
+    n_frames = int(lengths.max()) if len(lengths) else 0
+    mask = np.arange(n_frames) < lengths[:, None]
+    distances = np.zeros(mask.shape)
+    distances[mask] = np.concatenate(curves) * 1e-2 if len(curves) else []
+    return distances, mask
+
+
+def _entries(result, law):
+    entries = []
+    for i in range(len(result['param'])):
+        if np.isnan(result['param'][i]):
+            entries.append(None)
+            continue
+        entries.append({
+            'law': law,
+            'Cd': result['Cd'][i].item(),
+            'A': result['A'][i].item(),
+            'param': result['param'][i].item(),  # Cd (constant) или A (inverse_re)
+            'x0': result['x0'][i].item(),
+            'u0': result['u0'][i].item(),
+            'rmse': result['rmse'][i].item(),
+            'iterations': int(result['iterations'][i]),
+            'converged': bool(result['converged'][i]),
+        })
+    return entries
+
+
+def fit_bins(selection_data, law='constant', spf=None):
+    """
+    Обратная задача по averaged_distances всех выборок сразу (в порядке solver.solve_bins).
+    spf - секунд на кадр (None - как записано в выборках, см. handler.speed_settings).
+    Возвращает список словарей {'law', 'Cd', 'A', 'param', 'x0', 'u0', 'rmse', 'iterations', 'converged'} или None.
+    """
+    bins = [bin_entry for bin_entry in selection_data if bin_entry['header']['average_diameter'] is not None]
+    if spf is None:
+        spf = handler.speed_settings(bins[0])['spf'] if bins else 0.04
+    curves = []
+    for bin_entry in bins:
+        curve = np.full(int(round(bin_entry['averaged_distances'][-1][0] / spf)) + 1 if bin_entry['averaged_distances'] else 0, np.nan)
+        for t, x in bin_entry['averaged_distances']:
+            curve[int(round(t / spf))] = x
+        curves.append(curve)
+    distances, mask = _padded(curves)
+    mask &= ~np.isnan(distances)
+    distances = np.where(mask, distances, 0.0)
+    D = np.array([solver.get_mass_and_area(bin_entry)[2] for bin_entry in bins], dtype=np.float64)
+    return _entries(fit_curves(distances, mask, D, law, spf), law)
+
+
+def fit_particles(bin_entry, law='constant', spf=None, chunk_size=solver.PARTICLE_CHUNK_SIZE):
+    """
+    Обратная задача по траектории каждой частицы выборки (диаметр - свой у каждой частицы), пакетами.
+    Возвращает словарь массивов по частицам (см. fit_curves).
+    """
+    source, rows = handler.bin_source(bin_entry)
+    spf = handler.speed_settings(bin_entry)['spf'] if spf is None else spf
+    parts = []
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        values, offsets = source.gather(chunk)
+        distances, mask = _padded(np.split(np.asarray(values, dtype=np.float64), offsets[1:-1]))
+        D = np.asarray(source.diameter[chunk], dtype=np.float64) * 10**-6
+        parts.append(fit_curves(distances, mask, D, law, spf))
+    if not parts:
+        return fit_curves(np.zeros((0, 0)), np.zeros((0, 0), dtype=bool), np.zeros(0), law, spf)
+    return {key: np.concatenate([part[key] for part in parts]) for key in parts[0]}
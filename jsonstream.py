@@ -0,0 +1,212 @@
+## Потоковое чтение и запись JSON в прежних форматах (particles.json, particles_dist_final.json, selections.json)
+## Чтение: элементы массива (поле 'particles' или массив верхнего уровня) разбираются по одному через
+## json.JSONDecoder.raw_decode из буфера, который дочитывается из файла частями, - дерево всего файла не строится.
+## Запись: элементы дописываются в файл по мере получения. По умолчанию результат байт в байт совпадает с
+## json.dump(..., ensure_ascii=False, indent=4), compact=True - без отступов и пробелов (файл в несколько раз меньше).
+import json
+
+READ_SIZE = 1 << 20  # символов за одно чтение файла
+INDENT = 4
+
+_decoder = json.JSONDecoder()
+_whitespace = ' \t\n\r'
+
+
+class ArrayReader:
+    """
+    Файл, открытый для чтения массива key по элементам (key=None - массив верхнего уровня, как в selections.json).
+    Остальные поля объекта верхнего уровня - в fields: те, что стоят до массива (description), доступны сразу,
+    стоящие после - когда массив прочитан до конца.
+
+        with ArrayReader('particles.json') as particles:
+            spf = particles.fields['description']['spf']
+            for particle in particles:
+                ...
+    """
+
+    def __init__(self, filename, key='particles', read_size=READ_SIZE):
+        self.filename = filename
+        self.key = key
+        self.read_size = read_size
+        self.fields = {}
+        self._f = open(filename, 'r', encoding='utf-8')
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        self._started = False
+        try:
+            if key is None:
+                self._expect('[')
+            else:
+                self._expect('{')
+                self._read_fields()
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._f.close()
+
+    def __iter__(self):
+        if self._started:
+            raise RuntimeError(f'Массив {self.key or ""} из {self.filename} уже прочитан')
+        self._started = True
+        if self._peek() == ']':
+            self._pos += 1
+        else:
+            while True:
+                yield self._value()
+                if self._expect(',]') == ']':
+                    break
+        if self.key is not None:
+            if self._expect(',}') == ',':
+                self._read_fields()
+
+    def _read_fields(self):
+        ## поля объекта верхнего уровня до массива key (после него - до конца объекта)
+        if self._peek() == '}':
+            self._pos += 1
+            return self._check_found()
+        while True:
+            name = self._value()
+            self._expect(':')
+            if name == self.key:
+                self._expect('[')
+                return
+            self.fields[name] = self._value()
+            if self._expect(',}') == '}':
+                return self._check_found()
+
+    def _check_found(self):
+        if not self._started:
+            raise ValueError(f'В {self.filename} нет массива {self.key!r}')
+
+    def _fill(self):
+        ## дочитывает файл; разобранное начало буфера отбрасывается, длинный элемент - чтения растут вдвое
+        chunk = self._f.read(max(self.read_size, len(self._buffer) - self._pos))
+        if not chunk:
+            self._eof = True
+            return False
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _peek(self):
+        ## следующий значимый символ, '' - конец файла
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in _whitespace:
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, chars):
+        char = self._peek()
+        if not char or char not in chars:
+            raise ValueError(f'{self.filename}: ожидался один из символов {chars!r}, а найдено {char or "конец файла"!r}')
+        self._pos += 1
+        return char
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if self._fill():  # элемент оборвался на конце буфера
+                    continue
+                raise
+            if len(self._buffer) - end <= 2 and not self._eof and self._fill():
+                continue  # число на конце буфера могло оборваться ("2.", "2.5e+") - разбираем заново с продолжением
+            self._pos = end
+            return value
+
+
+def iter_items(filename, key='particles', read_size=READ_SIZE):
+    """
+    Элементы массива key из файла по одному (key=None - массив верхнего уровня).
+    """
+    with ArrayReader(filename, key, read_size) as reader:
+        yield from reader
+
+
+class ArrayWriter:
+    """
+    Файл, открытый для записи массива по элементам: write(item) сразу пишет элемент в файл.
+    key=None - массив верхнего уровня (selections.json), иначе объект {**fields, key: [...]} (particles.json).
+    default - как у json.dump (например, store.json_default для массивов numpy).
+    """
+
+    def __init__(self, filename, key=None, fields=None, compact=False, default=None):
+        self.key = key
+        self.compact = compact
+        self.default = default
+        self.count = 0
+        self._f = open(filename, 'w', encoding='utf-8')
+        self._level = 0 if key is None else 1  # вложенность элементов массива
+        if key is None:
+            self._f.write('[')
+            return
+
+        colon = ':' if compact else ': '
+        self._f.write('{')
+        for name, value in (fields or {}).items():
+            self._f.write(self._newline(1) + self._dumps(name) + colon + self._dumps(value, 1) + ',')
+        self._f.write(self._newline(1) + self._dumps(key) + colon + '[')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._f.close()  # недописанный файл не закрываем скобками
+
+    def _newline(self, level):
+        return '' if self.compact else '\n' + ' ' * (INDENT * level)
+
+    def _dumps(self, value, level=0):
+        if self.compact:
+            return json.dumps(value, ensure_ascii=False, separators=(',', ':'), default=self.default)
+        text = json.dumps(value, ensure_ascii=False, indent=INDENT, default=self.default)
+        return text.replace('\n', self._newline(level)) if level else text
+
+    def write(self, item):
+        self._f.write((',' if self.count else '') + self._newline(self._level + 1) + self._dumps(item, self._level + 1))
+        self.count += 1
+
+    def close(self):
+        if self._f.closed:
+            return
+        self._f.write((self._newline(self._level) if self.count else '') + ']')
+        if self.key is not None:
+            self._f.write(self._newline(0) + '}')
+        self._f.close()
+
+
+def write_array(filename, items, compact=False, default=None):
+    """
+    Массив верхнего уровня (selections.json) из итератора элементов.
+    """
+    with ArrayWriter(filename, compact=compact, default=default) as writer:
+        for item in items:
+            writer.write(item)
+    return writer.count
+
+
+def write_particles(filename, description, particles, compact=False, default=None):
+    """
+    {'description': description, 'particles': [...]} (particles.json) из итератора частиц.
+    """
+    with ArrayWriter(filename, 'particles', {'description': description}, compact=compact, default=default) as writer:
+        for particle in particles:
+            writer.write(particle)
+    return writer.count
@@ -1,10 +1,75 @@
 ## Обработчик для построения графиков из файла selections.json
 import math
 import json
-import matplotlib.pyplot as plt
+import os
+import pickle
+import sys
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
+import fitting
+import handler
+import telemetry
+
+PLOT_NAMES = ('dist_t_ALL', 'vel_t_ALL', 'init_vel_D_ALL', 'burnTimeD')  # файлы графиков plotter.main в plots_dir
+
+_headless = None  # None - определить автоматически (нет дисплея -> без окон)
+
+def set_headless(headless=True):
+    """
+    Режим без окон: графики только сохраняются в файлы, используется неинтерактивный backend Agg.
+    """
+    global _headless
+    _headless = headless
+
+def pyplot():
+    """
+    Ленивый импорт matplotlib.pyplot: matplotlib загружается только когда строится график,
+    поэтому запуски без графиков не тратят время на его импорт и GUI-backend.
+    """
+    import matplotlib
+    headless = _headless
+    if headless is None:
+        headless = sys.platform.startswith('linux') and not (os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+    if headless and 'matplotlib.pyplot' not in sys.modules:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    if headless and matplotlib.get_backend().lower() != 'agg':
+        plt.switch_backend('Agg')  # pyplot уже импортирован другим модулем с интерактивным backend
+    return plt
+
+def _bin_trajectories(bin_entry, max_points=None):
+    """
+    Траектории выборки -> плоские массивы времени и расстояния со смещениями траекторий.
+    Секунд на кадр - как у осреднённых кривых выборки (handler.speed_settings).
+    max_points - прореживание: не больше max_points точек на траекторию (первая и последняя сохраняются).
+    """
+    source, rows = handler.bin_source(bin_entry)
+    distances, offsets = source.gather(rows[source.lengths[rows] > 0])
+    lengths = np.diff(offsets)
+    steps = np.arange(offsets[-1], dtype=np.int64) - np.repeat(offsets[:-1], lengths)
+
+    if max_points and len(lengths) and lengths.max() > max_points:
+        keep = []
+        for start, length in zip(offsets[:-1].tolist(), lengths.tolist()):
+            if length > max_points:
+                keep.append(start + np.unique(np.linspace(0, length - 1, max_points).round().astype(np.int64)))
+            else:
+                keep.append(np.arange(start, start + length))
+        keep = np.concatenate(keep)
+        steps, distances = steps[keep], distances[keep]
+        offsets = np.searchsorted(keep, offsets)
+
+    return steps * handler.speed_settings(bin_entry)['spf'], np.asarray(distances, dtype=np.float64), offsets
+
+def plot_all_bins_DISTANCES(selection_data, plots_dir='./_RESULTS_PLOTS', mode='auto', max_points=None,
+                            density_threshold=2000):
+    ## mode: 'lines' - все траектории одной коллекцией линий на выборку, 'density' - 2D-гистограмма плотности точек,
+    ##       'auto' - плотность для выборок, где частиц больше density_threshold
+    ## max_points - прореживание траекторий (точек на траекторию) в режиме линий
+    plt = pyplot()
+    from matplotlib.collections import LineCollection
+    from matplotlib.colors import LogNorm
 
-def plot_all_bins_DISTANCES(selection_data):
     bin_count = len(selection_data)
     cols = 3
     rows = math.ceil(bin_count / cols)
@@ -15,13 +80,22 @@ def plot_all_bins_DISTANCES(selection_data):
 
     for i, bin_entry in enumerate(selection_data):
         ax = axes[i]
-        
-        # Графики для каждой частицы (тонкая черная линия)
-        for particle in bin_entry['particles']:
-            distances = particle['distance']
-            if distances:
-                times = [j * 0.04 for j in range(len(distances))]
-                ax.plot(times, distances, color='black', linewidth=0.8, alpha=0.4)
+
+        density = mode == 'density' or (mode == 'auto' and bin_entry['header']['particle_count'] > density_threshold)
+        spf = handler.speed_settings(bin_entry)['spf']
+        times, distances, offsets = _bin_trajectories(bin_entry, None if density else max_points)
+
+        if len(distances) and density:
+            # Плотность точек всех траекторий (логарифмическая шкала)
+            n_steps = int(round(times.max() / spf)) + 1
+            counts, t_edges, d_edges = np.histogram2d(times, distances, bins=(min(n_steps, 200), 100))
+            ax.pcolormesh(t_edges, d_edges, np.ma.masked_equal(counts.T, 0), cmap='Greys', norm=LogNorm(), shading='flat')
+        elif len(distances):
+            # Графики для каждой частицы (тонкая черная линия) - одна коллекция на выборку
+            points = np.column_stack((times, distances))
+            segments = np.split(points, offsets[1:-1])
+            ax.add_collection(LineCollection(segments, colors='black', linewidths=0.8, alpha=0.4))
+            ax.autoscale_view()
 
         # График для осреднённых расстояний (толстая красная линия)
         avg_distances = bin_entry['averaged_distances']
@@ -30,7 +104,7 @@ def plot_all_bins_DISTANCES(selection_data):
             distances_avg = [point[1] for point in avg_distances]
             ax.plot(times_avg, distances_avg, color='red', linewidth=2.0, label='Среднее')
 
-        ax.set_title( f"Dср={bin_entry['header']["average_diameter"]} мкм ({bin_entry['header']["min_diameter"]} - {bin_entry['header']["max_diameter"]})")
+        ax.set_title( f"Dср={bin_entry['header']['average_diameter']} мкм ({bin_entry['header']['min_diameter']} - {bin_entry['header']['max_diameter']})")
         ax.set_xlabel('Время (с)')
         ax.set_ylabel('Расстояние (см)')
         ax.grid(True)
@@ -40,9 +114,11 @@ def plot_all_bins_DISTANCES(selection_data):
         fig.delaxes(axes[j])
 
     plt.tight_layout()
-    plt.savefig('./_RESULTS_PLOTS/dist_t_ALL.png', bbox_inches='tight')
+    if plots_dir:
+        plt.savefig(os.path.join(plots_dir, 'dist_t_ALL.png'), bbox_inches='tight')
 
-def plot_all_bins_av_SPEED(selection_data):
+def plot_all_bins_av_SPEED(selection_data, plots_dir='./_RESULTS_PLOTS'):
+    plt = pyplot()
 
     bin_count = len(selection_data)
     cols = 3
@@ -53,6 +129,7 @@ def plot_all_bins_av_SPEED(selection_data):
     fig.suptitle('Графики скорости от времени для всех выборок', fontsize=16)
 
     initial_speeds_data = []  # сюда будем собирать (Dср, v0)
+    all_coeffs = fitting.velocity_polynom_coeffs(selection_data, deg=3)  # те же коэффициенты, что и в solver (из кэша)
 
     for i, bin_entry in enumerate(selection_data):
         ax = axes[i]
@@ -66,7 +143,11 @@ def plot_all_bins_av_SPEED(selection_data):
             ax.plot(times_avg, speeds_avg, color='black', linewidth=1.0, label='Среднее')
 
             # Аппроксимация полиномом 3-й степени
-            coeffs = np.polyfit(times_avg, speeds_avg, deg=3)
+            coeffs = all_coeffs[i]
+            if np.isnan(coeffs).any():  # точек меньше, чем нужно для полинома
+                ax.set_title(f"Dср={bin_entry['header']['average_diameter']} мкм")
+                ax.grid(True)
+                continue
             poly_times = np.linspace(min(times_avg), max(times_avg), 200)
             poly_speeds = np.polyval(coeffs, poly_times)
             ax.plot(poly_times, poly_speeds, color='red', linewidth=1.0, label='Полином 3 ст.')
@@ -88,11 +169,13 @@ def plot_all_bins_av_SPEED(selection_data):
         fig.delaxes(axes[j])
 
     plt.tight_layout(pad=1.0, h_pad=14.0, w_pad=1.0, rect=[0.05, 0.05, 0.95, 0.95])
-    plt.savefig('./_RESULTS_PLOTS/vel_t_ALL.png', bbox_inches='tight')
+    if plots_dir:
+        plt.savefig(os.path.join(plots_dir, 'vel_t_ALL.png'), bbox_inches='tight')
 
     return initial_speeds_data  # возвращаем список (Dср, v0)
 
 def OLD_plot_initial_speed_vs_diameter_from_DISCRETE(bin_data):
+    plt = pyplot()
     diameters = []
     initial_speeds = []
 
@@ -128,6 +211,7 @@ def OLD_plot_initial_speed_vs_diameter_from_DISCRETE(bin_data):
     plt.legend()
 
 def OLD_plot_initial_speed_vs_diameter_from_POLYNOMS(initial_speeds_data):
+    plt = pyplot()
     diameters = [item[0] for item in initial_speeds_data]
     initial_speeds = [item[1] for item in initial_speeds_data]
 
@@ -147,9 +231,19 @@ def OLD_plot_initial_speed_vs_diameter_from_POLYNOMS(initial_speeds_data):
     plt.legend()
     plt.tight_layout()
 
-def plot_combined_initial_speed_vs_diameter(discrete_bin_data, polynom_initial_speeds_data):
-    import numpy as np
-    import matplotlib.pyplot as plt
+def initial_speeds_from_polynoms(selection_data):
+    """
+    (Dср, v0) по полиномам скорости выборок - то же, что возвращает plot_all_bins_av_SPEED, но без построения графика.
+    """
+    all_coeffs = fitting.velocity_polynom_coeffs(selection_data, deg=3)
+    return [
+        (bin_entry['header']['average_diameter'], np.polyval(coeffs, 0))
+        for bin_entry, coeffs in zip(selection_data, all_coeffs)
+        if bin_entry['averaged_speeds'] and not np.isnan(coeffs).any()
+    ]
+
+def plot_combined_initial_speed_vs_diameter(discrete_bin_data, polynom_initial_speeds_data, plots_dir='./_RESULTS_PLOTS'):
+    plt = pyplot()
 
     # Данные из дискретных скоростей
     diameters_discrete = []
@@ -200,36 +294,110 @@ def plot_combined_initial_speed_vs_diameter(discrete_bin_data, polynom_initial_s
     plt.grid(True)
     plt.legend()
     plt.tight_layout()
-    plt.savefig('./_RESULTS_PLOTS/init_vel_D_ALL.png', bbox_inches='tight')
+    if plots_dir:
+        plt.savefig(os.path.join(plots_dir, 'init_vel_D_ALL.png'), bbox_inches='tight')
 
-def plot_burnTime_D(selection_data):
+def plot_burnTime_D(selection_data, plots_dir='./_RESULTS_PLOTS'):
+    plt = pyplot()
 
     burn_times = []
     diameters = []
 
     for i, bin_entry in enumerate(selection_data):
-        for particle in bin_entry['particles']:
-            burn_times.append(particle['burn_time'])
-            diameters.append(particle['diameter'])
+        source, rows = handler.bin_source(bin_entry)
+        burn_times.extend(source.burn_time[rows].tolist())
+        diameters.extend(source.diameter[rows].tolist())
     plt.figure(figsize=(8, 8))
     plt.scatter(diameters, burn_times, c='blue', alpha=0.5)
     plt.title('Зависимость времени горения от диаметра частицы')
     plt.xlabel('D (мкм)')
     plt.ylabel('Tгор (c)')
     plt.grid(True)
-    plt.savefig('./_RESULTS_PLOTS/burnTimeD.png', bbox_inches='tight')
+    if plots_dir:
+        plt.savefig(os.path.join(plots_dir, 'burnTimeD.png'), bbox_inches='tight')
 
-def main(input_file='selections.json', show_plots=True):
-    with open(input_file, 'r', encoding='utf-8') as f:
+def main(input_file='selections.json', show_plots=True, plots_dir='./_RESULTS_PLOTS'):
+    plt = pyplot()
+    with telemetry.stage('load'), open(input_file, 'r', encoding='utf-8') as f:
         selection_data = json.load(f)
 
-    plot_all_bins_DISTANCES(selection_data)
-    initial_speeds_data = plot_all_bins_av_SPEED(selection_data)
-    plot_combined_initial_speed_vs_diameter(selection_data, initial_speeds_data)
-    plot_burnTime_D(selection_data)
+    with telemetry.stage('render'):
+        plot_all_bins_DISTANCES(selection_data, plots_dir)
+        initial_speeds_data = plot_all_bins_av_SPEED(selection_data, plots_dir)
+        plot_combined_initial_speed_vs_diameter(selection_data, initial_speeds_data, plots_dir)
+        plot_burnTime_D(selection_data, plots_dir)
+    telemetry.count('figures', len(PLOT_NAMES))
+
+    if show_plots:
+        plt.show()
 
+## === Отчёт: графики строятся параллельно в отдельных процессах и собираются в один многостраничный PDF ===
+
+REPORT_FIGURES = PLOT_NAMES + ('results_table',)
+
+_selection_cache = {}
+
+def _load_selections(input_file):
+    if input_file not in _selection_cache:
+        with open(input_file, 'r', encoding='utf-8') as f:
+            _selection_cache[input_file] = json.load(f)
+    return _selection_cache[input_file]
+
+def _render_figure(task):
+    """
+    Строит один график в рабочем процессе, сохраняет PNG (если задан plots_dir)
+    и возвращает фигуру в виде pickle для страницы PDF.
+    """
+    name, input_file, results_file, plots_dir = task
+    set_headless(True)
+    plt = pyplot()
+
+    if name == 'results_table':
+        import solver
+        solver.plot_results_table(filename=results_file,
+                                  output_file=os.path.join(plots_dir, 'results_table.png') if plots_dir else None)
+    else:
+        selection_data = _load_selections(input_file)
+        if name == 'dist_t_ALL':
+            plot_all_bins_DISTANCES(selection_data, plots_dir)
+        elif name == 'vel_t_ALL':
+            plot_all_bins_av_SPEED(selection_data, plots_dir)
+        elif name == 'init_vel_D_ALL':
+            plot_combined_initial_speed_vs_diameter(selection_data, initial_speeds_from_polynoms(selection_data), plots_dir)
+        elif name == 'burnTimeD':
+            plot_burnTime_D(selection_data, plots_dir)
+
+    fig = plt.gcf()
+    data = pickle.dumps(fig)
+    plt.close('all')
+    return data
+
+def render_report(input_file='selections.json', results_file='results.json', plots_dir='./_RESULTS_PLOTS',
+                  report_file='./_RESULTS_PLOTS/report.pdf', show_plots=False, workers=None):
+    """
+    Все графики (и таблица результатов, если есть results_file) строятся параллельно;
+    PNG пишутся в plots_dir (None - не писать), все страницы собираются в report_file (None - без PDF).
+    """
+    names = [name for name in REPORT_FIGURES if name != 'results_table' or results_file]
+    tasks = [(name, input_file, results_file, plots_dir) for name in names]
+
+    with telemetry.stage('render'), ProcessPoolExecutor(max_workers=workers) as executor:
+        figures = [pickle.loads(data) for data in executor.map(_render_figure, tasks)]
+    telemetry.count('figures', len(figures))
+
+    if report_file:
+        from matplotlib.backends.backend_pdf import PdfPages
+        with telemetry.stage('write'), PdfPages(report_file) as pdf:
+            for fig in figures:
+                pdf.savefig(fig, bbox_inches='tight')
+        print(f'\033[92mОтчёт со всеми графиками сохранён в {report_file}\033[0m')
+
+    plt = pyplot()
     if show_plots:
         plt.show()
+    else:
+        for fig in figures:
+            plt.close(fig)
 
 if __name__ == "__main__":
     main()
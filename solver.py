@@ -1,7 +1,11 @@
 import math
 import json
-import matplotlib.pyplot as plt
+import warnings
 import numpy as np
+import fitting
+import handler
+import plotter
+import telemetry
 
 ### Константы
 ro = 2400  # Плотность частиц (кг/м^3)
@@ -17,12 +21,8 @@ def get_velosity_polynom_coeffs_for_bin(bin_entry):
 
     avg_speeds = bin_entry['averaged_speeds']
     if avg_speeds and len(avg_speeds) > 3:
-        # Извлекаем скорости и времена из данных
-        times = [entry[0] for entry in avg_speeds]
-        speeds = [entry[1] for entry in avg_speeds]
-
-        # Применяем полиномиальную регрессию для нахождения коэффициентов
-        coeffs = np.polyfit(times, speeds, deg=3)
+        # Полиномиальная регрессия через общий сервис (см. fitting.py)
+        coeffs = fitting.velocity_polynom_coeffs([bin_entry], deg=3)[0]
 
     return coeffs
  
@@ -37,72 +37,249 @@ def get_mass_and_area(bin_entry):
 
     return mass, area, diameter
 
-def solve_eq(selection_data, dt_poly=0.001, output_filename='results.json'):
-    results = []
-
-    for bin_entry in selection_data:
-        if bin_entry['header']['average_diameter'] is None:
-            continue
-
-        m, S, D = get_mass_and_area(bin_entry)
-        coeffs = get_velosity_polynom_coeffs_for_bin(bin_entry)
-
-        # Диапазон времени по averaged_speeds
-        times = [t for t, _ in bin_entry['averaged_speeds']]
-        t_min = min(times)
-        t_max = max(times)
-
-        ## === По полиному ===
-        Cd_poly = []
-        Re_poly = []
-        A_poly = []
-
-        t = t_min + dt_poly
-
-        while t <= t_max:
-            t_prev = t - dt_poly
+def polyval_rows(coeffs, t):
+    """
+    Значения полиномов по схеме Горнера для всех выборок сразу:
+    coeffs - (n_bins, deg + 1), t - (n_bins, n_steps) или (n_steps,).
+    """
+    coeffs = np.asarray(coeffs, dtype=np.float64)
+    values = np.zeros(np.broadcast_shapes((coeffs.shape[0], 1), np.shape(t)))
+    for k in range(coeffs.shape[1]):
+        values = values * t + coeffs[:, k:k + 1]
+    return values
 
-            u = np.polyval(coeffs, t) * 1e-2  # м/с
-            u_prev = np.polyval(coeffs, t_prev) * 1e-2  # м/с
+def drag_acceleration(u, Cd, m, S):
+    """
+    Ускорение du/dt частицы по уравнению решателя: m du/dt = m g - 1/2 Cd ro_g S u (сила сопротивления линейна по u).
+    drag_coefficients - обратное к нему: Cd по скоростям.
+    """
+    return g - Cd * ro_g * S * u / (2 * m)
 
-            if u == 0:
-                t += dt_poly
-                continue
+def drag_coefficients(u, u_prev, dt, m, S, D):
+    """
+    Cd, Re и A = Re * Cd по скоростям u (м/с) на соседних шагах (векторно), обращение drag_acceleration.
+    m, S, D - массивы формы (n_bins, 1). Там, где u == 0, результат - nan.
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        u_safe = np.where(u == 0, np.nan, u)
+        Cd = -2 * m / (S * ro_g * u_safe) * ((u_safe - u_prev) / dt - g)
+        Re = (ro_g * np.abs(u_safe) * D) / mu
+    return Cd, Re, Re * Cd
 
-            Cd_temp = -2 * m / (S * ro_g * u) * ((u - u_prev) / dt_poly - g)
-            Re_temp = (ro_g * abs(u) * D) / mu
-            A_temp = Re_temp * Cd_temp
+def solve_bins(selection_data, dt_poly=0.001):
+    """
+    Векторный расчёт Cd, Re и A для всех выборок сразу.
+    Сетка времени строится один раз для всех выборок: t = t_min + k * dt_poly, пока t <= t_max.
+    Возвращает словарь с отобранными выборками и массивами (n_bins, n_steps), дополненными nan:
+    'poly' - по полиному скорости, 'disc' - по дискретным averaged_speeds.
+    """
+    valid = [i for i, bin_entry in enumerate(selection_data) if bin_entry['header']['average_diameter'] is not None]
+    bins = [selection_data[i] for i in valid]
 
-            Cd_poly.append(Cd_temp)
-            Re_poly.append(Re_temp)
-            A_poly.append(A_temp)
+    mass_area = np.array([get_mass_and_area(bin_entry) for bin_entry in bins], dtype=np.float64).reshape(-1, 3)
+    m, S, D = (mass_area[:, j:j + 1] for j in range(3))
 
-            t += dt_poly
+    times, speeds, _ = fitting.pad_series([bin_entry['averaged_speeds'] for bin_entry in bins])
 
-        ## === По дискретным averaged_speeds ===
-        Cd_disc = []
-        Re_disc = []
-        A_disc = []
+    ## === По полиному ===
+    # Аппроксимация всех выборок одним вызовом; результат по тем же данным берут из кэша графики
+    with telemetry.stage('fit'):
+        coeffs = fitting.velocity_polynom_coeffs(selection_data, deg=3)[valid].reshape(len(bins), -1)
 
-        speeds = bin_entry['averaged_speeds']
-        for i in range(1, len(speeds)):
-            t = speeds[i][0]
-            t_prev = speeds[i-1][0]
-            dt_disc = t - t_prev
+    with telemetry.stage('solve'):
+        solution = solve_curves(times, speeds, coeffs, m, S, D, dt_poly=dt_poly)
+    solution['bins'] = bins
+    telemetry.count('time_steps', solution['poly']['mask'].sum())
+    telemetry.count('speed_points', solution['disc']['mask'].sum())
+    return solution
 
-            u = speeds[i][1] * 1e-2  # м/с
-            u_prev = speeds[i-1][1] * 1e-2  # м/с
+def solve_curves(times, speeds, coeffs, m, S, D, dt_poly=0.001):
+    """
+    Ядро solve_bins: times, speeds - кривые скорости (n, L) в см/с, дополненные nan,
+    coeffs - полиномы скорости (n, deg + 1), m, S, D - (n, 1) или скаляры.
+    Строками могут быть выборки, бутстреп-реплики или отдельные частицы.
+    """
+    ## === По полиному ===
+    with np.errstate(invalid='ignore'):
+        t_min = np.nanmin(times, axis=1, keepdims=True, initial=np.inf, where=~np.isnan(times))
+        t_max = np.nanmax(times, axis=1, keepdims=True, initial=-np.inf, where=~np.isnan(times))
+    span = np.where(np.isfinite(t_max - t_min), t_max - t_min, -1.0)
+    n_steps = int(np.floor(span.max(initial=0.0) / dt_poly)) + 2 if len(times) else 0
+
+    # Накопленная сумма повторяет прежнее t += dt_poly до последнего бита, поэтому и граница t <= t_max та же
+    t_poly = np.full((len(times), n_steps), dt_poly)
+    t_poly[:, :1] = t_min + dt_poly
+    np.cumsum(t_poly, axis=1, out=t_poly)
+    poly_mask = t_poly <= t_max
+
+    u = polyval_rows(coeffs, t_poly) * 1e-2  # м/с
+    u_prev = polyval_rows(coeffs, t_poly - dt_poly) * 1e-2  # м/с
+    Cd_poly, Re_poly, A_poly = drag_coefficients(u, u_prev, dt_poly, m, S, D)
+    poly_mask &= ~np.isnan(u) & (u != 0)  # nan - у выборки не хватает точек для полинома
+
+    ## === По дискретным скоростям ===
+    dt_disc = np.diff(times, axis=1)
+    u = speeds[:, 1:] * 1e-2  # м/с
+    u_prev = speeds[:, :-1] * 1e-2  # м/с
+    Cd_disc, Re_disc, A_disc = drag_coefficients(u, u_prev, dt_disc, m, S, D)
+    disc_mask = ~np.isnan(u) & (u != 0)
+
+    def masked(values, mask):
+        return np.where(mask, values, np.nan)
+
+    return {
+        'poly': {'t': masked(t_poly, poly_mask), 'Cd': masked(Cd_poly, poly_mask),
+                 'Re': masked(Re_poly, poly_mask), 'A': masked(A_poly, poly_mask), 'mask': poly_mask},
+        'disc': {'t': masked(times[:, 1:], disc_mask), 'Cd': masked(Cd_disc, disc_mask),
+                 'Re': masked(Re_disc, disc_mask), 'A': masked(A_disc, disc_mask), 'mask': disc_mask},
+    }
+
+## === Расчёт по отдельным частицам ===
+
+PARTICLE_QUANTILES = (5, 25, 50, 75, 95)
+PARTICLE_CHUNK_SIZE = 2000  # частиц в одном пакете (ограничивает размер сетки времени частицы x шаг)
+
+def particle_drag(bin_entry, dt_poly=0.001, deg=3, chunk_size=PARTICLE_CHUNK_SIZE):
+    """
+    Cd, A и Re каждой частицы выборки: скорость частицы аппроксимируется своим полиномом (пакетный МНК по всем частицам),
+    масса и площадь - по диаметру самой частицы, дальше то же ядро solve_curves, строки - частицы.
+    Скорости частиц - тем же методом, что и averaged_speeds выборки (см. handler.bin_speeds).
+    Возвращает средние по времени значения каждой частицы {'Cd_poly': (n,), 'Cd_disc': ..., 'A_...', 'Re_...'};
+    nan - у частицы не хватает точек.
+    """
+    source, rows = handler.bin_source(bin_entry)
+    names = [f'{name}_{branch}' for name in ('Cd', 'A', 'Re') for branch in ('poly', 'disc')]
+    means = {name: np.full(len(rows), np.nan) for name in names}
+
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        values, offsets, dt = handler.bin_speeds(bin_entry, chunk, source)  # источник выборки собран один раз
+        lengths = np.diff(offsets)
+        n_steps = int(lengths.max()) if len(lengths) else 0
+
+        mask = np.arange(n_steps) < lengths[:, None]
+        speeds = np.full(mask.shape, np.nan)
+        speeds[mask] = values
+        step_times = np.array([round(j * dt, 5) for j in range(n_steps)], dtype=np.float64)
+        times = np.where(mask, step_times, np.nan)
+
+        D = np.asarray(source.diameter[chunk], dtype=np.float64)[:, None] * 10**-6  # Приводим к метрам из мкм
+        m = ro * math.pi / 6 * D**3
+        S = math.pi * D**2 / 4
+
+        coeffs = fitting.fit_polynomials(times, speeds, mask, deg=deg)
+        solution = solve_curves(times, speeds, coeffs, m, S, D, dt_poly=dt_poly)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)  # у частиц без точек среднее - nan
+            for name in names:
+                quantity, branch = name.split('_')
+                means[name][start:start + len(chunk)] = np.nanmean(solution[branch][quantity], axis=1)
+
+    telemetry.count('particle_fits', len(rows))
+    return means
+
+def _distribution(values, quantiles=PARTICLE_QUANTILES):
+    """
+    Медиана и процентили значений частиц (без nan); None - если значений нет.
+    """
+    values = values[~np.isnan(values)]
+    if not len(values):
+        return None
+    percentiles = np.percentile(values, quantiles)
+    distribution = {'median': np.median(values).item()}
+    distribution.update({f'p{q:g}': p for q, p in zip(quantiles, percentiles.tolist())})
+    return distribution
+
+def particle_distributions(selection_data, dt_poly=0.001, quantiles=PARTICLE_QUANTILES, inverse_fit=None):
+    """
+    Распределения средних по времени Cd и A отдельных частиц для каждой выборки (в порядке solve_bins).
+    inverse_fit - закон сопротивления для обратной задачи по траектории каждой частицы (см. inverse.py), None - без неё.
+    """
+    distributions = []
+    for bin_entry in selection_data:
+        if bin_entry['header']['average_diameter'] is None:
+            continue
+        means = particle_drag(bin_entry, dt_poly=dt_poly)
+        distribution = {
+            'count': int(np.count_nonzero(~np.isnan(means['Cd_poly']))),
+            'Cd': {branch: _distribution(means['Cd_' + branch], quantiles) for branch in ('poly', 'disc')},
+            'A': {branch: _distribution(means['A_' + branch], quantiles) for branch in ('poly', 'disc')},
+        }
+        if inverse_fit:
+            import inverse
+            fit = inverse.fit_particles(bin_entry, law=inverse_fit)
+            distribution['Cd']['inverse'] = _distribution(fit['Cd'], quantiles)
+            distribution['A']['inverse'] = _distribution(fit['A'], quantiles)
+        distributions.append(distribution)
+    return distributions
+
+DETAIL_SERIES = ('Cd_poly', 'Cd_disc', 'A_poly', 'A_disc', 'Re_poly', 'Re_disc', 't_poly', 't_disc')
+
+def solve_eq(selection_data, dt_poly=0.001, output_filename='results.json', bootstrap_replicates=0, ci_level=95, workers=None,
+             detail_file=None, detail_dtype=np.float64, per_particle=False, inverse_fit=None):
+    ## bootstrap_replicates > 0 - дополнительно считаются бутстреп-доверительные интервалы avgCd и avgA (см. bootstrap.py)
+    ## output_filename - краткие результаты по выборкам (D, диапазон Re, avgCd, avgA), без значений на каждом шаге
+    ## detail_file - значения Cd, A, Re на каждом шаге в бинарном .npz (None - не писать), detail_dtype - например np.float32
+    ## per_particle - дополнительно Cd и A по каждой частице отдельно: медиана и процентили по выборке (см. particle_drag)
+    ## inverse_fit - 'constant' или 'inverse_re': Cd из подбора решения уравнения движения к averaged_distances (см. inverse.py);
+    ## это Cd квадратичного закона (сопротивление ½ Cd ro_g S u²), а не линейного, как avgCd
+    results, solution = result_entries(selection_data, dt_poly, bootstrap_replicates, ci_level, workers, per_particle, inverse_fit)
+
+    with telemetry.stage('write'), open(output_filename, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=4)
 
-            if u == 0:
-                continue
+    if detail_file:
+        with telemetry.stage('write_details'):
+            write_details(solution, detail_file, dtype=detail_dtype)
+        print(f'Значения Cd, A, Re на каждом шаге сохранены в {detail_file}')
 
-            Cd_temp = -2 * m / (S * ro_g * u) * ((u - u_prev) / dt_disc - g)
-            Re_temp = (ro_g * abs(u) * D) / mu
-            A_temp = Re_temp * Cd_temp
+    print(f'\033[92mРезультаты сохранены в {output_filename}\033[0m')
 
-            Cd_disc.append(Cd_temp)
-            Re_disc.append(Re_temp)
-            A_disc.append(A_temp)
+def result_entries(selection_data, dt_poly=0.001, bootstrap_replicates=0, ci_level=95, workers=None, per_particle=False,
+                   inverse_fit=None):
+    """
+    Записи results.json для непустых выборок selection_data (каждая выборка считается независимо от остальных,
+    поэтому можно пересчитывать только часть выборок, см. incremental.py) -> (записи, решение solve_bins).
+    """
+    results = []
+    solution = solve_bins(selection_data, dt_poly=dt_poly)
+    poly = solution['poly']
+    disc = solution['disc']
+
+    intervals = None
+    if bootstrap_replicates:
+        import bootstrap
+        with telemetry.stage('bootstrap'):
+            intervals = bootstrap.bootstrap_intervals(selection_data, n_replicates=bootstrap_replicates, level=ci_level,
+                                                      dt_poly=dt_poly, workers=workers)
+        telemetry.count('replicates', bootstrap_replicates)
+
+    distributions = None
+    if per_particle:
+        with telemetry.stage('particles'):
+            distributions = particle_distributions(selection_data, dt_poly=dt_poly, inverse_fit=inverse_fit)
+
+    fits = None
+    if inverse_fit:
+        import inverse
+        with telemetry.stage('inverse'):
+            fits = inverse.fit_bins(selection_data, law=inverse_fit)
+
+    for i, bin_entry in enumerate(solution['bins']):
+        Cd_poly = poly['Cd'][i, poly['mask'][i]]
+        Re_poly = poly['Re'][i, poly['mask'][i]]
+        A_poly = poly['A'][i, poly['mask'][i]]
+
+        Cd_disc = disc['Cd'][i, disc['mask'][i]]
+        Re_disc = disc['Re'][i, disc['mask'][i]]
+        A_disc = disc['A'][i, disc['mask'][i]]
+
+        Re_all = np.concatenate([Re_poly, Re_disc])
+        with np.errstate(invalid='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)  # среднее пустой ветки - nan, как и раньше
+            Cd_all = np.mean([np.mean(Cd_poly), np.mean(Cd_disc)])
+            A_all = np.mean([np.mean(A_poly), np.mean(A_disc)])
 
         ## Запись результата по выборке
         result_entry = {
@@ -112,37 +289,101 @@ def solve_eq(selection_data, dt_poly=0.001, output_filename='results.json'):
                 bin_entry['header']['average_diameter']
             ],
             "Re": [
-                min(Re_poly + Re_disc) if (Re_poly or Re_disc) else None,
-                max(Re_poly + Re_disc) if (Re_poly or Re_disc) else None
+                Re_all.min().item() if len(Re_all) else None,
+                Re_all.max().item() if len(Re_all) else None
             ],
             "avgCd": {
-                "poly": np.mean(Cd_poly) if Cd_poly else None,
-                "disc": np.mean(Cd_disc) if Cd_disc else None,
-                "all": np.mean([np.mean(Cd_poly), np.mean(Cd_disc)])
+                "poly": np.mean(Cd_poly).item() if len(Cd_poly) else None,
+                "disc": np.mean(Cd_disc).item() if len(Cd_disc) else None,
+                "all": Cd_all.item()
             },
             "avgA": {
-                "poly": np.mean(A_poly) if A_poly else None,
-                "disc": np.mean(A_disc) if A_disc else None,
-                "all": np.mean([np.mean(A_poly), np.mean(A_disc)])
-            },
-            "data": {
-                "Cd_poly": Cd_poly,
-                "Cd_disc": Cd_disc,
-                "A_poly": A_poly,
-                "A_disc": A_disc,
-                "Re_poly": Re_poly,
-                "Re_disc": Re_disc
+                "poly": np.mean(A_poly).item() if len(A_poly) else None,
+                "disc": np.mean(A_disc).item() if len(A_disc) else None,
+                "all": A_all.item()
             }
         }
+        if intervals is not None:
+            result_entry["ci"] = intervals[i]  # перцентильные интервалы {'Cd_poly': [низ, верх], ...}
+        if fits is not None:
+            result_entry["inverse"] = fits[i]  # {'law', 'Cd', 'A', 'param', 'x0', 'u0', 'rmse', ...} или None
+        if distributions is not None:
+            result_entry["particles"] = distributions[i]  # {'count', 'Cd': {'poly': {'median', 'p5', ...}, 'disc': ...}, 'A': ...}
 
         results.append(result_entry)
+    return results, solution
 
-    with open(output_filename, 'w', encoding='utf-8') as f:
-        json.dump(results, f, ensure_ascii=False, indent=4)
+def write_details(solution, filename, dtype=np.float64):
+    """
+    Значения на каждом шаге всех выборок (результат solve_bins) в .npz: для каждого ряда DETAIL_SERIES
+    один плоский массив всех выборок подряд и смещения offsets_poly / offsets_disc (как distance в store.py).
+    """
+    arrays = {}
+    for branch in ('poly', 'disc'):
+        mask = solution[branch]['mask']
+        offsets = np.zeros(len(mask) + 1, dtype=np.int64)
+        np.cumsum(mask.sum(axis=1), out=offsets[1:])
+        arrays['offsets_' + branch] = offsets
+        for name in ('Cd', 'A', 'Re', 't'):
+            arrays[f'{name}_{branch}'] = solution[branch][name][mask].astype(dtype)  # построчно, выборка за выборкой
+    arrays['D'] = np.array([bin_entry['header']['average_diameter'] for bin_entry in solution['bins']], dtype=np.float64)
+    with open(filename, 'wb') as f:  # np.savez сам добавил бы .npz к имени
+        np.savez(f, **arrays)
+
+class ResultDetails:
+    """
+    Значения на каждом шаге из файла write_details. Массивы читаются из файла только при обращении к ним.
+    """
 
-    print(f'\033[92mРезультаты сохранены в {output_filename}\033[0m')
+    def __init__(self, filename):
+        self._npz = np.load(filename)
+        self._arrays = {}
 
-def plot_results_table(filename='results.json'):
+    def __getitem__(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = self._npz[name]
+        return self._arrays[name]
+
+    def __len__(self):
+        return len(self['offsets_poly']) - 1
+
+    def series(self, name, i):
+        """
+        Ряд name (например 'Cd_poly') i-й выборки.
+        """
+        offsets = self['offsets_' + name.rsplit('_', 1)[1]]
+        return self[name][offsets[i]:offsets[i + 1]]
+
+    def bin(self, i, names=DETAIL_SERIES):
+        """
+        Все ряды i-й выборки - как прежнее поле "data" в results.json.
+        """
+        return {name: self.series(name, i) for name in names}
+
+    def close(self):
+        self._npz.close()
+
+def load_details(filename):
+    return ResultDetails(filename)
+
+def _ci_text(interval):
+    """
+    Доверительный интервал для ячейки таблицы, например ' [12.9; 13.8]'.
+    """
+    if not interval or interval[0] is None:
+        return ''
+    return f" [{round(interval[0], 2)}; {round(interval[1], 2)}]"
+
+def _median_text(distribution):
+    """
+    Медиана и межквартильный интервал значений частиц для ячейки таблицы.
+    """
+    if not distribution:
+        return '—'
+    return f"{round(distribution['median'], 4)} [{round(distribution['p25'], 2)}; {round(distribution['p75'], 2)}]"
+
+def plot_results_table(filename='results.json', output_file='./_RESULTS_PLOTS/results_table.png'):
+    plt = plotter.pyplot()
     with open(filename, 'r', encoding='utf-8') as f:
         results = json.load(f)
 
@@ -156,6 +397,13 @@ def plot_results_table(filename='results.json'):
         "A (дискретн.)"
     ]
 
+    inverse_fit = any(entry.get("inverse") for entry in results)
+    if inverse_fit:
+        columns.append("Cd (u², обратная задача)")  # другой закон сопротивления, см. подпись под таблицей
+    per_particle = any("particles" in entry for entry in results)
+    if per_particle:
+        columns.append("Cd по частицам (медиана [25%; 75%])")
+
     # Данные таблицы
     table_data = []
 
@@ -167,14 +415,21 @@ def plot_results_table(filename='results.json'):
         A_poly = entry["avgA"]["poly"]
         A_disc = entry["avgA"]["disc"]
 
+        ci = entry.get("ci", {})
+
         row = [
             f"{D_min}-{D_max}, {round(D_avg, 2) if D_avg is not None else '—'}",
             f"{round(Re_min, 2) if Re_min is not None else '—'} - {round(Re_max, 2) if Re_max is not None else '—'}",
-            f"{round(Cd_poly, 4) if Cd_poly is not None else '—'}",
-            f"{round(Cd_disc, 4) if Cd_disc is not None else '—'}",
-            f"{round(A_poly, 4) if A_poly is not None else '—'}",
-            f"{round(A_disc, 4) if A_disc is not None else '—'}"
+            f"{round(Cd_poly, 4) if Cd_poly is not None else '—'}{_ci_text(ci.get('Cd_poly'))}",
+            f"{round(Cd_disc, 4) if Cd_disc is not None else '—'}{_ci_text(ci.get('Cd_disc'))}",
+            f"{round(A_poly, 4) if A_poly is not None else '—'}{_ci_text(ci.get('A_poly'))}",
+            f"{round(A_disc, 4) if A_disc is not None else '—'}{_ci_text(ci.get('A_disc'))}"
         ]
+        if inverse_fit:
+            fit = entry.get("inverse")
+            row.append(f"{round(fit['Cd'], 4)} (rmse {round(fit['rmse'], 2)} см)" if fit else '—')
+        if per_particle:
+            row.append(_median_text(entry.get("particles", {}).get("Cd", {}).get("poly")))
 
         table_data.append(row)
     
@@ -193,7 +448,7 @@ def plot_results_table(filename='results.json'):
         f"{round(avgA_poly, 4) if avgA_poly is not None else '—'}",
         f"{round(avgA_disc, 4) if avgA_disc is not None else '—'}"
     ]
-    table_data.append(row_stat_1)
+    table_data.append(row_stat_1 + ["—"] * (inverse_fit + per_particle))
     row_stat_2 = [
         f"Средние",
         f"—",
@@ -202,7 +457,11 @@ def plot_results_table(filename='results.json'):
         f"{round(all_avg_A, 4) if all_avg_A is not None else '—'}",
         f"—"
     ]
-    table_data.append(row_stat_2)
+    table_data.append(row_stat_2 + ["—"] * (inverse_fit + per_particle))
+
+    if any("ci" in entry for entry in results):
+        level = next(entry["ci"]["level"] for entry in results if "ci" in entry)
+        columns = [column + (f" [{level}% ДИ]" if column.startswith(("Cd", "A ")) else "") for column in columns]
 
     # Построение таблицы с matplotlib
     fig, ax = plt.subplots(figsize=(14, len(table_data) * 0.6 + 1))
@@ -220,19 +479,30 @@ def plot_results_table(filename='results.json'):
     table.scale(1, 1.5)
 
     plt.title('Результаты расчёта по выборкам', fontsize=14, pad=20)
+    if inverse_fit:
+        fig.text(0.5, 0.01, 'Cd (u², обратная задача) - коэффициент квадратичного закона ½·Cd·ρg·S·u², '
+                 'в остальных столбцах Cd линейного закона ½·Cd·ρg·S·u: напрямую они не сравнимы',
+                 ha='center', fontsize=9)
     plt.tight_layout()
-    plt.savefig('./_RESULTS_PLOTS/results_table.png', bbox_inches='tight')
-    print(f'\033[92mТаблица результатов сохранена в ./_RESULTS_PLOTS/results_table.png\033[0m')
+    if output_file:
+        plt.savefig(output_file, bbox_inches='tight')
+        print(f'\033[92mТаблица результатов сохранена в {output_file}\033[0m')
 
 def plot_all_Cd_vs_time(selection_data, dt=0.001):
     """
     Строит графики Cd от времени для всех выборок на подграфиках,
     с расчётом, идентичным get_Cd_Re_A.
     """
+    plt = plotter.pyplot()
     valid_bins = [bin_entry for bin_entry in selection_data 
                   if bin_entry['header']['average_diameter'] is not None 
                   and len(bin_entry['averaged_speeds']) > 3]
 
+    all_coeffs = fitting.velocity_polynom_coeffs(selection_data, deg=3)
+    valid_coeffs = [all_coeffs[j] for j, bin_entry in enumerate(selection_data)
+                    if bin_entry['header']['average_diameter'] is not None
+                    and len(bin_entry['averaged_speeds']) > 3]
+
     bin_count = len(valid_bins)
     cols = 3
     rows = math.ceil(bin_count / cols)
@@ -244,8 +514,8 @@ def plot_all_Cd_vs_time(selection_data, dt=0.001):
         ax = axes[i]
 
         m, S, D = get_mass_and_area(bin_entry)
-        coeffs = get_velosity_polynom_coeffs_for_bin(bin_entry)
-        if len(coeffs) == 0:
+        coeffs = valid_coeffs[i]
+        if np.isnan(coeffs).any():
             ax.set_visible(False)
             continue
 
@@ -283,12 +553,17 @@ def plot_all_Cd_vs_time(selection_data, dt=0.001):
     fig.suptitle("Зависимость Cd от времени для всех выборок (по формуле get_Cd_Re_A)", fontsize=16)
     plt.tight_layout(pad=2.0, rect=[0.03, 0.03, 0.97, 0.95])
 
-def main(input_file='selections.json', output_file='results.json'):
-    with open(input_file, 'r', encoding='utf-8') as f:
+def main(input_file='selections.json', output_file='results.json', dt_poly=0.001, table_file='./_RESULTS_PLOTS/results_table.png',
+         bootstrap_replicates=0, detail_file=None, detail_dtype=np.float64, per_particle=False, inverse_fit=None):
+    with telemetry.stage('load'), open(input_file, 'r', encoding='utf-8') as f:
         selection_data = json.load(f)
 
-    solve_eq(selection_data, dt_poly=0.001, output_filename=output_file)
-    plot_results_table(filename=output_file)
+    solve_eq(selection_data, dt_poly=dt_poly, output_filename=output_file, bootstrap_replicates=bootstrap_replicates,
+             detail_file=detail_file, detail_dtype=detail_dtype, per_particle=per_particle,
+             inverse_fit=inverse_fit)
+    if table_file:
+        with telemetry.stage('render'):
+            plot_results_table(filename=output_file, output_file=table_file)
 
 
     ##plt.show()
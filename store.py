@@ -0,0 +1,379 @@
+## Бинарное колоночное хранилище траекторий частиц (замена промежуточных JSON с indent=4)
+## Хранилище - это папка (например "particles_dist_final.traj") с файлами:
+##   meta.json      - description (spf, fps), количество частиц, версия формата
+##   name.npy       - имена частиц (строки фиксированной длины)
+##   burn_time.npy  - время горения
+##   diameter.npy   - диаметр (мкм)
+##   hit.npy        - удар о поддон: 1 - был, 0 - не был, -1 - нет данных (в JSON поля 'hit' нет)
+##   offsets.npy    - смещения траекторий в distance.npy (длина = количество частиц + 1)
+##   distance.npy   - все расстояния всех частиц одним плоским массивом
+## Все .npy открываются через memory-map, текст не разбирается
+import array
+import json
+import os
+from collections.abc import Mapping, Sequence
+import numpy as np
+import jsonstream
+
+STORE_VERSION = 1
+COLUMNS = ('name', 'burn_time', 'diameter', 'hit', 'offsets', 'distance')
+PARTICLE_KEYS = ('name', 'burn_time', 'diameter', 'distance', 'hit')
+
+
+def is_store(path):
+    """
+    Проверяет, что путь указывает на папку с хранилищем траекторий.
+    """
+    return os.path.isdir(path) and os.path.isfile(os.path.join(path, 'meta.json'))
+
+
+def data_columns(data):
+    """
+    Колонки хранилища из данных в формате particles.json (distance - список расстояний).
+    """
+    particles = data['particles']
+    if isinstance(particles, ParticleList):  # представление другого хранилища - колонки берутся срезами, без словарей
+        source, rows = particles.source, particles.rows
+        distance, offsets = source.gather(rows)
+        return {
+            'name': np.asarray(source.name[rows]),
+            'burn_time': np.asarray(source.burn_time[rows], dtype=np.float64),
+            'diameter': np.asarray(source.diameter[rows]),
+            'hit': np.asarray(source.hit[rows], dtype=np.int8),
+            'offsets': offsets,
+            'distance': np.asarray(distance, dtype=np.float64),
+            'description': data.get('description', {}),
+        }
+
+    return particle_columns(particles, data.get('description', {}))
+
+
+def particle_columns(particles, description):
+    """
+    Колонки хранилища за один проход по частицам (словари как в particles.json, в том числе из итератора
+    jsonstream.iter_items): в памяти копятся только колонки, а не словари всех частиц.
+    """
+    names, diameters = [], []
+    burn_time = array.array('d')
+    hit = array.array('b')
+    lengths = array.array('q')
+    distance = array.array('d')
+    for p in particles:
+        names.append(p['name'])
+        burn_time.append(p['burn_time'])
+        diameters.append(p['diameter'])
+        hit.append(-1 if p.get('hit') is None else int(bool(p['hit'])))
+        lengths.append(len(p['distance']))
+        distance.extend(p['distance'])
+
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(np.frombuffer(lengths, dtype=np.int64), out=offsets[1:])
+    return {
+        'name': np.array(names, dtype=str),
+        'burn_time': np.frombuffer(burn_time, dtype=np.float64),
+        'diameter': np.array(diameters),  # int64, если все диаметры целые
+        'hit': np.frombuffer(hit, dtype=np.int8),
+        'offsets': offsets,
+        'distance': np.frombuffer(distance, dtype=np.float64),
+        'description': description,
+    }
+
+
+def read_columns(filename):
+    """
+    Колонки хранилища из JSON в формате particles.json: частицы читаются по одной (см. jsonstream.py).
+    """
+    with jsonstream.ArrayReader(filename, 'particles') as reader:
+        columns = particle_columns(reader, None)
+        columns['description'] = reader.fields.get('description', {})  # может стоять и после массива
+    return columns
+
+
+def write_store(data, path):
+    """
+    Записывает данные в формате particles.json (distance - список расстояний) в хранилище.
+    """
+    write_columns(path, **data_columns(data))
+
+
+def write_columns(path, name, burn_time, diameter, hit, offsets, distance, description):
+    """
+    Записывает готовые колонки в хранилище (без промежуточных словарей частиц).
+    """
+    os.makedirs(path, exist_ok=True)
+    columns = {
+        'name': name,
+        'burn_time': burn_time,
+        'diameter': diameter,
+        'hit': np.asarray(hit, dtype=np.int8),
+        'offsets': np.asarray(offsets, dtype=np.int64),
+        'distance': np.asarray(distance, dtype=np.float64),
+    }
+    for column, values in columns.items():
+        np.save(os.path.join(path, column + '.npy'), values)
+
+    meta = {
+        'version': STORE_VERSION,
+        'count': len(columns['offsets']) - 1,
+        'description': description,
+    }
+    with open(os.path.join(path, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=4)
+
+
+class TrajectoryStore:
+    """
+    Открытое хранилище траекторий. Колонки - массивы numpy, отображённые в память (только чтение).
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('version') != STORE_VERSION:
+            raise ValueError(f'Неподдерживаемая версия хранилища {meta.get("version")} в {path}')
+
+        self.path = path
+        self.description = meta['description']
+        for column in COLUMNS:
+            setattr(self, column, np.load(os.path.join(path, column + '.npy'), mmap_mode='r'))
+
+    @classmethod
+    def from_data(cls, data, path=None):
+        """
+        То же хранилище в памяти, из данных в формате particles.json (без записи на диск).
+        """
+        return cls.from_columns(path=path, **data_columns(data))
+
+    @classmethod
+    def from_columns(cls, name, burn_time, diameter, hit, offsets, distance, description, path=None):
+        """
+        Хранилище в памяти из готовых колонок (как у write_columns).
+        """
+        self = cls.__new__(cls)
+        self.path = path
+        self.description = description
+        for column, values in zip(COLUMNS, (name, burn_time, diameter, hit, offsets, distance)):
+            setattr(self, column, values)
+        return self
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def distances(self, i):
+        """
+        Расстояния i-й частицы (срез отображённого массива, без копирования).
+        """
+        return self.distance[self.offsets[i]:self.offsets[i + 1]]
+
+    def gather(self, rows):
+        """
+        Расстояния частиц rows подряд одним массивом -> (значения, смещения траекторий).
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        lengths = self.offsets[rows + 1] - self.offsets[rows]
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        index = np.repeat(self.offsets[rows] - offsets[:-1], lengths) + np.arange(offsets[-1], dtype=np.int64)
+        return self.distance[index], offsets
+
+    def particle(self, i):
+        """
+        i-я частица в виде словаря, как в particles_dist_final.json.
+        """
+        particle = {
+            'name': str(self.name[i]),
+            'burn_time': self.burn_time[i].item(),
+            'diameter': self.diameter[i].item(),
+            'distance': self.distances(i).tolist(),
+        }
+        if self.hit[i] >= 0:
+            particle['hit'] = bool(self.hit[i])
+        return particle
+
+    def to_data(self):
+        """
+        Все данные в формате particles_dist_final.json.
+        """
+        return {
+            'description': dict(self.description),
+            'particles': [self.particle(i) for i in range(len(self))],
+        }
+
+    def records(self, rows=None):
+        """
+        Метаданные частиц rows (всех - если None) одним структурированным массивом:
+        name, burn_time, diameter, hit, start и length траектории в distance.
+        """
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows, dtype=np.int64)
+        name = np.asarray(self.name[rows])
+        dtype = [('name', name.dtype), ('burn_time', np.float64), ('diameter', np.asarray(self.diameter).dtype),
+                 ('hit', np.int8), ('start', np.int64), ('length', np.int64)]
+        records = np.empty(len(rows), dtype=dtype)
+        records['name'] = name
+        records['burn_time'] = self.burn_time[rows]
+        records['diameter'] = self.diameter[rows]
+        records['hit'] = self.hit[rows]
+        records['start'] = self.offsets[rows]
+        records['length'] = self.offsets[rows + 1] - self.offsets[rows]
+        return records
+
+    @property
+    def particles(self):
+        """
+        Все частицы как последовательность представлений-словарей (ParticleView), без копирования траекторий.
+        """
+        return ParticleList(self, np.arange(len(self)))
+
+    def view(self):
+        """
+        Данные в формате particles_dist_final.json без создания словарей и списков: data['particles'][i]['distance'] -
+        массив numpy поверх колонок хранилища. Для json.dump - to_data() или json.dump(..., default=json_default).
+        """
+        return {'description': self.description, 'particles': self.particles}
+
+
+class ParticleView(Mapping):
+    """
+    Частица хранилища, которая читается как словарь из particles_dist_final.json (ключи name, burn_time, diameter,
+    distance и hit, если он известен). Хранит только хранилище и номер частицы, distance - срез колонки.
+    """
+    __slots__ = ('source', 'index')
+
+    def __init__(self, source, index):
+        self.source = source
+        self.index = index
+
+    def __getitem__(self, key):
+        source, i = self.source, self.index
+        if key == 'name':
+            return str(source.name[i])
+        if key == 'burn_time':
+            return source.burn_time[i].item()
+        if key == 'diameter':
+            return source.diameter[i].item()
+        if key == 'distance':
+            return source.distances(i)
+        if key == 'hit' and source.hit[i] >= 0:
+            return bool(source.hit[i])
+        raise KeyError(key)
+
+    def __iter__(self):
+        return (key for key in PARTICLE_KEYS if key != 'hit' or self.source.hit[self.index] >= 0)
+
+    def __len__(self):
+        return len(PARTICLE_KEYS) - (self.source.hit[self.index] < 0)
+
+    def __repr__(self):
+        return f'ParticleView({self["name"]!r}, diameter={self["diameter"]}, samples={len(self["distance"])})'
+
+
+class ParticleList(Sequence):
+    """
+    Частицы rows хранилища как список представлений ParticleView (создаются при обращении).
+    """
+    __slots__ = ('source', 'rows')
+
+    def __init__(self, source, rows):
+        self.source = source
+        self.rows = rows
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return ParticleList(self.source, self.rows[i])
+        return ParticleView(self.source, int(self.rows[i]))
+
+    def __len__(self):
+        return len(self.rows)
+
+
+def json_default(value):
+    """
+    default для json.dump: массивы и представления частиц -> списки и словари.
+    """
+    if isinstance(value, ParticleView):
+        return value.source.particle(value.index)
+    if isinstance(value, ParticleList):
+        return list(value)
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if hasattr(value, 'tolist'):  # array.array
+        return value.tolist()
+    raise TypeError(f'{type(value).__name__} не сериализуется в JSON')
+
+
+def combine(parts, description=None):
+    """
+    Частицы rows нескольких источников [(источник, rows), ...] одним хранилищем в памяти (порядок сохраняется).
+    """
+    columns = {column: [] for column in COLUMNS if column not in ('offsets', 'distance')}
+    distances = []
+    lengths = []
+    for source, rows in parts:
+        rows = np.asarray(rows, dtype=np.int64)
+        for column in columns:
+            columns[column].append(np.asarray(getattr(source, column)[rows]))
+        values, part_offsets = source.gather(rows)
+        distances.append(values)
+        lengths.append(np.diff(part_offsets))
+
+    offsets = np.zeros(sum(len(l) for l in lengths) + 1, dtype=np.int64)
+    if lengths:
+        np.cumsum(np.concatenate(lengths), out=offsets[1:])
+    if description is None:
+        description = dict(parts[0][0].description) if parts else {}
+    return TrajectoryStore.from_columns(
+        distance=np.concatenate(distances) if distances else np.zeros(0),
+        offsets=offsets,
+        description=description,
+        **{column: np.concatenate(values) if values else np.zeros(0) for column, values in columns.items()}
+    )
+
+
+def open_store(path):
+    return TrajectoryStore(path)
+
+
+_sources = {}  # открытые источники траекторий: путь -> (время изменения, хранилище)
+
+
+def open_source(path):
+    """
+    Источник траекторий для выборок (см. handler.bin_source): хранилище открывается через memory-map,
+    JSON читается по частицам прямо в колонки (см. read_columns). Открытые источники переиспользуются, пока файл не изменился.
+    """
+    stamp_file = os.path.join(path, 'meta.json') if is_store(path) else path
+    key = os.path.abspath(path)
+    stamp = os.path.getmtime(stamp_file)
+    if key not in _sources or _sources[key][0] != stamp:
+        if is_store(path):
+            source = open_store(path)
+        else:
+            source = TrajectoryStore.from_columns(path=path, **read_columns(path))
+        _sources[key] = (stamp, source)
+    return _sources[key][1]
+
+
+def load_data(path):
+    """
+    Загружает данные о частицах из хранилища или из JSON (определяется по пути).
+    """
+    if is_store(path):
+        return open_store(path).to_data()
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def convert_json_to_store(input_filename='particles_dist_final.json', output_path='particles_dist_final.traj'):
+    columns = read_columns(input_filename)
+    write_columns(output_path, **columns)
+    print(f'Хранилище траекторий сохранено в {output_path} ({len(columns["offsets"]) - 1} частиц)')
+
+
+if __name__ == "__main__":
+    convert_json_to_store()
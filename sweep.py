@@ -0,0 +1,132 @@
+## Перебор параметров обработки: количество выборок, фильтр частиц по ударам, шаг решателя, метод дифференцирования скоростей
+## Каждая конфигурация считается в отдельном процессе и пишет результаты в свою папку _SWEEP/<конфигурация>/,
+## хранилище траекторий открывается один раз на процесс и только читается
+## В конце собирается общая таблица summary.json / summary.csv по всем конфигурациям и выборкам
+import csv
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import diameter_index
+import plotter
+import store
+
+HIT_FILTERS = {
+    'all': (True, True),
+    'hit': (True, False),
+    'nohit': (False, True),
+}
+
+_data = None  # источник траекторий (store.TrajectoryStore), общий для всех конфигураций процесса
+_particles_file = None
+
+
+def _init_worker(particles_file):
+    global _data, _particles_file
+    plotter.set_headless(True)  # в рабочих процессах окна не открываются
+    _particles_file = particles_file
+    if _data is None:  # при fork источник уже открыт родительским процессом
+        _data = store.open_source(particles_file)
+
+
+def config_name(config):
+    name = f"bins{config['bins']}_{config['hit_filter']}_dt{config['dt_poly']:g}"
+    method = config.get('speed_method', 'forward')
+    return name if method == 'forward' else f'{name}_{method}'  # прежние имена папок для метода по умолчанию
+
+
+def make_grid(bins_list=(5, 10, 20), hit_filters=('all', 'nohit', 'hit'), dt_polys=(0.001,), speed_methods=('forward',)):
+    """
+    Все сочетания параметров в виде списка словарей-конфигураций.
+    speed_methods - методы дифференцирования (см. differentiation.METHODS) для сравнения Cd при разных способах получения скоростей.
+    """
+    return [
+        {'bins': bins, 'hit_filter': hit_filter, 'dt_poly': dt_poly, 'speed_method': speed_method}
+        for bins, hit_filter, dt_poly, speed_method in itertools.product(bins_list, hit_filters, dt_polys, speed_methods)
+    ]
+
+
+def _run_config(config, output_root, save_plots, inverse_fit=None, use_index=False):
+    import ALL_RUN
+
+    use_hitted, use_not_hitted = HIT_FILTERS[config['hit_filter']]
+    output_dir = os.path.join(output_root, config_name(config))
+    files = ALL_RUN.full_processing(
+        particles_intup_file=_particles_file,
+        use_hitted_particles=use_hitted,
+        use_not_hitted_particles=use_not_hitted,
+        bins=config['bins'],
+        show_plots=False,
+        save_plots=save_plots,
+        dt_poly=config['dt_poly'],
+        output_dir=output_dir,
+        data=_data,
+        inverse_fit=inverse_fit,
+        speed_method=config.get('speed_method', 'forward'),
+        use_index=use_index
+    )
+    if save_plots:
+        plotter.pyplot().close('all')
+
+    with open(files['results_file'], 'r', encoding='utf-8') as f:
+        results = json.load(f)
+
+    rows = []
+    for i, entry in enumerate(results):
+        rows.append({
+            'config': config_name(config),
+            **config,
+            'bin': i + 1,
+            'D_min': entry['D'][0],
+            'D_max': entry['D'][1],
+            'D_avg': entry['D'][2],
+            'Re_min': entry['Re'][0],
+            'Re_max': entry['Re'][1],
+            'Cd_poly': entry['avgCd']['poly'],
+            'Cd_disc': entry['avgCd']['disc'],
+            'A_poly': entry['avgA']['poly'],
+            'A_disc': entry['avgA']['disc'],
+            'Cd_inverse_quadratic': entry['inverse']['Cd'] if entry.get('inverse') else None,
+        })
+    return rows
+
+
+def run_sweep(grid=None, particles_file='particles_dist_final.traj', output_root='_SWEEP', workers=None, save_plots=False,
+              inverse_fit=None, use_index=False):
+    """
+    Запускает все конфигурации grid (см. make_grid) в пуле процессов.
+    Возвращает строки общей таблицы (по одной на выборку каждой конфигурации).
+    inverse_fit - закон сопротивления для обратной задачи (см. inverse.py), тогда в таблице есть Cd_inverse_quadratic:
+    Cd квадратичного закона (½ Cd ro_g S u²), в отличие от линейного Cd_poly и Cd_disc (½ Cd ro_g S u).
+    use_index - выборки из индекса по диаметрам (см. diameter_index.py): траектории не перебираются заново для каждой конфигурации.
+    """
+    global _data, _particles_file
+    if grid is None:
+        grid = make_grid()
+    os.makedirs(output_root, exist_ok=True)
+
+    _data = store.open_source(particles_file)  # один раз; рабочие процессы получают его через fork или initializer
+    _particles_file = particles_file
+    if use_index:
+        for speed_method in sorted({config.get('speed_method', 'forward') for config in grid}):
+            diameter_index.open_index(particles_file, speed_method)  # по файлу на метод, строятся до запуска процессов
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(particles_file,)) as executor:
+        futures = [executor.submit(_run_config, config, output_root, save_plots, inverse_fit, use_index) for config in grid]
+        summary = [row for future in futures for row in future.result()]
+
+    with open(os.path.join(output_root, 'summary.json'), 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=4)
+
+    if summary:
+        with open(os.path.join(output_root, 'summary.csv'), 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(summary[0].keys()))
+            writer.writeheader()
+            writer.writerows(summary)
+
+    print(f'\033[92mПеребор завершён: {len(grid)} конфигураций, сводная таблица в {output_root}/summary.csv\033[0m')
+    return summary
+
+
+if __name__ == "__main__":
+    run_sweep(make_grid(bins_list=(5, 10, 15, 20), hit_filters=('all', 'nohit', 'hit'), dt_polys=(0.001,)))
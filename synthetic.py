@@ -0,0 +1,177 @@
+## Генератор синтетических траекторий частиц для проверки масштабирования конвейера
+## Траектории получаются интегрированием того же уравнения, которое обращает solver (solver.drag_acceleration):
+##   m du/dt = m g - 1/2 Cd ro_g S u,  Cd = Cd(Re, D)
+## с теми же константами ro, ro_g, mu, g. Результат - хранилище траекторий (store.py) или словарь как particles_dist_final.json,
+## а для замеров предобработки - сырые particles.json и txt с ударами о поддон в формате ВСЕ.txt (write_raw)
+import math
+import numpy as np
+import jsonstream
+import solver
+import store
+
+CHUNK_SIZE = 100_000  # частиц за один шаг генерации (ограничивает память)
+
+
+def cd_power_law(Re, D_um, a=4e-4):
+    """
+    Cd = A / Re, A = a * D^2 (D в мкм) - грубо повторяет A = Re * Cd из results.json по реальным данным.
+    """
+    return a * D_um ** 2 / np.maximum(Re, 1e-12)
+
+
+def sample_diameters(rng, n, distribution='normal', mean=480.0, std=110.0, low=180.0, high=700.0):
+    """
+    Диаметры (мкм, целые): 'normal' (обрезанное), 'lognormal' или 'uniform' в [low, high].
+    """
+    if distribution == 'uniform':
+        d = rng.uniform(low, high, n)
+    elif distribution == 'lognormal':
+        sigma = math.sqrt(math.log(1 + (std / mean) ** 2))
+        d = rng.lognormal(math.log(mean) - sigma ** 2 / 2, sigma, n)
+    elif distribution == 'normal':
+        d = rng.normal(mean, std, n)
+    else:
+        raise ValueError(f'Неизвестное распределение диаметров: {distribution}')
+    return np.clip(np.round(d), low, high).astype(np.int64)
+
+
+def integrate_trajectories(D_um, v0_cm, x0_cm, n_frames, spf=0.04, cd_law=cd_power_law, substeps=4):
+    """
+    Векторное интегрирование (РК4) для всех частиц сразу. Возвращает расстояния (см), массив (n, n_frames).
+    """
+    D = D_um * 1e-6
+    m = solver.ro * math.pi / 6 * D ** 3
+    S = math.pi * D ** 2 / 4
+
+    def acceleration(u):
+        Re = solver.ro_g * np.abs(u) * D / solver.mu
+        return solver.drag_acceleration(u, cd_law(Re, D_um), m, S)
+
+    u = v0_cm * 1e-2
+    x = x0_cm * 1e-2
+    h = spf / substeps
+    out = np.empty((len(D_um), n_frames))
+    out[:, 0] = x
+    for frame in range(1, n_frames):
+        for _ in range(substeps):
+            k1u = acceleration(u)
+            k2u = acceleration(u + h / 2 * k1u)
+            k3u = acceleration(u + h / 2 * k2u)
+            k4u = acceleration(u + h * k3u)
+            x = x + h / 6 * (u + 2 * (u + h / 2 * k1u) + 2 * (u + h / 2 * k2u) + (u + h * k3u))
+            u = u + h / 6 * (k1u + 2 * k2u + 2 * k3u + k4u)
+        out[:, frame] = x
+    return out * 1e2
+
+
+def generate_columns(n_particles, seed=0, spf=0.04, diameter_distribution='normal', hit_fraction=0.5,
+                     noise_cm=0.3, cd_law=cd_power_law, chunk_size=CHUNK_SIZE):
+    """
+    Синтетические частицы в виде колонок хранилища: name, burn_time, diameter, hit, offsets, distance.
+    Время горения растёт с диаметром; частицы с ударом (доля hit_fraction) обрезаются в случайный момент полёта.
+    """
+    rng = np.random.default_rng(seed)
+    diameter = sample_diameters(rng, n_particles, diameter_distribution)
+    burn_time = np.round(np.clip(diameter / 420 + rng.normal(0, 0.12, n_particles), 0.2, None) / spf) * spf
+    n_frames = np.round(burn_time / spf).astype(np.int64) + 1
+
+    hit = np.where(rng.random(n_particles) < hit_fraction, 1, -1).astype(np.int8)
+    cut = np.where(hit == 1, np.maximum(2, np.round(n_frames * rng.uniform(0.5, 1.0, n_particles))), n_frames)
+    lengths = np.minimum(n_frames, cut).astype(np.int64)
+
+    offsets = np.zeros(n_particles + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    distance = np.empty(offsets[-1], dtype=np.float64)
+
+    for start in range(0, n_particles, chunk_size):
+        stop = min(start + chunk_size, n_particles)
+        count = stop - start
+        v0 = rng.normal(120, 20, count)
+        x0 = rng.uniform(3, 8, count)
+        paths = integrate_trajectories(diameter[start:stop].astype(np.float64), v0, x0, int(lengths[start:stop].max()), spf, cd_law)
+        paths += rng.normal(0, noise_cm, paths.shape)
+
+        # Рваная раскладка: из каждой строки берутся первые lengths[i] кадров
+        chunk_lengths = lengths[start:stop]
+        keep = np.arange(paths.shape[1]) < chunk_lengths[:, None]
+        distance[offsets[start]:offsets[stop]] = np.round(paths[keep], 2)
+
+    name = np.char.add('syn_Частица №', np.arange(1, n_particles + 1).astype(str))
+    return {
+        'name': name,
+        'burn_time': np.round(burn_time, 2),
+        'diameter': diameter,
+        'hit': hit,
+        'offsets': offsets,
+        'distance': distance,
+        'description': {'spf': spf, 'fps': round(1 / spf), 'synthetic': {'seed': seed, 'hit_fraction': hit_fraction,
+                                                                          'noise_cm': noise_cm,
+                                                                          'diameters': diameter_distribution}},
+    }
+
+
+def generate_store(path, n_particles, **kwargs):
+    """
+    Генерирует частицы сразу в хранилище траекторий (без словарей и JSON).
+    """
+    store.write_columns(path, **generate_columns(n_particles, **kwargs))
+    return path
+
+
+def generate(n_particles, **kwargs):
+    """
+    Синтетические частицы в формате particles_dist_final.json (для небольших объёмов).
+    """
+    columns = generate_columns(n_particles, **kwargs)
+    offsets = columns['offsets']
+    particles = []
+    for i in range(n_particles):
+        particle = {
+            'name': str(columns['name'][i]),
+            'burn_time': float(columns['burn_time'][i]),
+            'diameter': int(columns['diameter'][i]),
+            'distance': columns['distance'][offsets[i]:offsets[i + 1]].tolist(),
+        }
+        if columns['hit'][i] == 1:
+            particle['hit'] = True
+        particles.append(particle)
+    return {'description': columns['description'], 'particles': particles}
+
+
+def write_raw(json_filename, txt_filename, n_particles, seed=0, spf=0.04, hit_fraction=0.5, **kwargs):
+    """
+    Сырые данные для helpers.preprocess: particles.json с полными (не обрезанными) траекториями
+    и txt с первым появлением и ударом о поддон в формате ВСЕ.txt для доли hit_fraction частиц.
+    """
+    columns = generate_columns(n_particles, seed=seed, spf=spf, hit_fraction=0.0, **kwargs)
+    offsets = columns['offsets']
+    lengths = np.diff(offsets)
+    rng = np.random.default_rng(seed + 1)
+    hit_frames = np.where(rng.random(n_particles) < hit_fraction,
+                          np.maximum(1, np.round((lengths - 1) * rng.uniform(0.5, 1.0, n_particles))), -1).astype(np.int64)
+
+    def particles():
+        for i in range(n_particles):
+            yield {
+                'name': str(columns['name'][i]),
+                'burn_time': float(columns['burn_time'][i]),
+                'diameter': int(columns['diameter'][i]),
+                'distance': columns['distance'][offsets[i]:offsets[i + 1]].tolist(),
+            }
+
+    jsonstream.write_particles(json_filename, columns['description'], particles())
+    with open(txt_filename, 'w', encoding='utf-8') as f:
+        for i in np.flatnonzero(hit_frames >= 0).tolist():
+            experiment, particle = str(columns['name'][i]).split('_', 1)
+            distances = columns['distance'][offsets[i]:offsets[i + 1]]
+            f.write(f'{experiment}_______{particle}_______\n'
+                    f'Время горения: {columns["burn_time"][i]} (с)\n'
+                    f'Диаметр: {columns["diameter"][i]} (мкм)\n'
+                    f'0.00    {distances[0]:.2f} (Первое появление)\n'
+                    f'{round(hit_frames[i] * spf, 5)}    {distances[hit_frames[i]]:.2f} (Удар о поддон)\n\n')
+    return json_filename, txt_filename
+
+
+if __name__ == "__main__":
+    generate_store('synthetic_10000.traj', 10_000)
+    print('Синтетические траектории сохранены в synthetic_10000.traj')
@@ -0,0 +1,131 @@
+## Замеры этапов конвейера: настенное и процессорное время, пик памяти и счётчики (частицы, выборки, шаги решателя)
+## Этапы размечаются в коде через with telemetry.stage('имя'): ... и telemetry.count('имя', n), вложенные этапы
+## записываются с путём 'handler/average'. Пока запуск не начат (telemetry.start), разметка ничего не делает.
+## В конце запуска telemetry.finish() пишет трассу в JSON и (по желанию) печатает сводную таблицу
+## Память - пик tracemalloc (объекты Python и массивы numpy) сверх занятой на входе в этап
+import contextlib
+import json
+import time
+import tracemalloc
+
+_run = None  # текущий запуск: {'name', 'started', 'wall', 'cpu', 'memory', 'stages', 'stack', 'counters'}
+
+
+def active():
+    return _run is not None
+
+
+def start(name='run', memory=True):
+    """
+    Начинает запись трассы. memory=False - без замеров памяти (tracemalloc замедляет код).
+    """
+    global _run
+    _run = {
+        'name': name,
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'wall': time.perf_counter(),
+        'cpu': time.process_time(),
+        'memory': memory and not tracemalloc.is_tracing(),
+        'stages': [],
+        'stack': [],
+        'counters': {},
+    }
+    if _run['memory']:
+        tracemalloc.start()
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Замер этапа name (вложенный в текущий этап, если он есть).
+    """
+    if _run is None:
+        yield
+        return
+
+    stack = _run['stack']
+    record = {
+        'stage': '/'.join([parent['stage'] for parent in stack[-1:]] + [name]),
+        'depth': len(stack),
+        'counters': {},
+    }
+    _run['stages'].append(record)
+
+    if _run['memory']:
+        current, peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1]['_peak'] = max(stack[-1]['_peak'], peak)  # пик родителя до вложенного этапа
+        tracemalloc.reset_peak()
+        record['_start_bytes'] = record['_peak'] = current
+
+    stack.append(record)
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        record['wall'] = time.perf_counter() - wall
+        record['cpu'] = time.process_time() - cpu
+        stack.pop()
+        if _run['memory']:
+            peak = max(record.pop('_peak'), tracemalloc.get_traced_memory()[1])
+            record['peak_bytes'] = peak - record.pop('_start_bytes')
+            if stack:
+                stack[-1]['_peak'] = max(stack[-1]['_peak'], peak)
+
+
+def count(name, value=1):
+    """
+    Прибавляет value к счётчику name текущего этапа и к общему счётчику запуска.
+    """
+    if _run is None:
+        return
+    value = int(value)
+    if _run['stack']:
+        counters = _run['stack'][-1]['counters']
+        counters[name] = counters.get(name, 0) + value
+    _run['counters'][name] = _run['counters'].get(name, 0) + value
+
+
+def finish(trace_file=None, summary=True):
+    """
+    Завершает запуск: пишет трассу в trace_file (JSON) и печатает сводку. Возвращает трассу словарём.
+    """
+    global _run
+    if _run is None:
+        return None
+    run, _run = _run, None
+
+    trace = {
+        'name': run['name'],
+        'started': run['started'],
+        'wall': time.perf_counter() - run['wall'],
+        'cpu': time.process_time() - run['cpu'],
+        'counters': run['counters'],
+        'stages': run['stages'],
+    }
+    if run['memory']:
+        trace['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    if trace_file:
+        with open(trace_file, 'w', encoding='utf-8') as f:
+            json.dump(trace, f, ensure_ascii=False, indent=4)
+    if summary:
+        print_summary(trace)
+        if trace_file:
+            print(f'Трасса запуска сохранена в {trace_file}')
+    return trace
+
+
+def print_summary(trace):
+    print('--' * 20)
+    print(f"{'Этап':<32}{'время, с':>10}{'CPU, с':>10}{'память, МБ':>12}  счётчики")
+    for record in trace['stages']:
+        name = '  ' * record['depth'] + record['stage'].rsplit('/', 1)[-1]
+        memory = f"{record['peak_bytes'] / 1024 ** 2:12.1f}" if 'peak_bytes' in record else f"{'-':>12}"
+        counters = ', '.join(f'{key}={value}' for key, value in record['counters'].items())
+        print(f"{name:<32}{record.get('wall', 0):10.3f}{record.get('cpu', 0):10.3f}{memory}  {counters}")
+    memory = f"{trace['peak_bytes'] / 1024 ** 2:12.1f}" if 'peak_bytes' in trace else f"{'-':>12}"
+    counters = ', '.join(f'{key}={value}' for key, value in trace['counters'].items())
+    print(f"{'Всего':<32}{trace['wall']:10.3f}{trace['cpu']:10.3f}{memory}  {counters}")
+    print('--' * 20)